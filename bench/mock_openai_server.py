@@ -0,0 +1,355 @@
+"""
+ローカルで動くOpenAI互換のモックサーバー (標準ライブラリのみ)
+
+gen_query / gen_answer を実際のAPIを使わずに動かすために使う
+    python mock_openai_server.py --port 8000
+    python mock_openai_server.py --latency 0.5 --latency-dist lognormal --rate-limit-rate 0.05 --seed 1
+    OPENAI_BASE_URL=http://127.0.0.1:8000/v1 OPENAI_API_KEY=dummy python main.py wiki.json --async
+
+Batch API (/v1/files, /v1/batches) にも対応しており、gen_answer.py --batch を試せる
+stream=trueのリクエストにはServer-Sent Eventsで少しずつ返し、途中で切断されて送らなかったトークン数を/statsで返す
+"""
+import argparse
+import email.parser
+import email.policy
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def canned_completion(messages, num_queries, ramble_chars=0):
+    """<query>タグ付きのクエリ、または回答 (まとめた質問には<answer>タグ付き) を返す (ramble_charsは最後のクエリの後に続ける余計な文章の文字数)"""
+    last = messages[-1]["content"] if messages else ""
+    if "<query>" in last:
+        topic = last[:20].replace("<", "").replace(">", "")
+        body = "以下のクエリを作成しました。\n"
+        body += "\n".join(f"<query>モッククエリ{i+1}: {topic}について教えてください</query>" for i in range(num_queries))
+        if ramble_chars:
+            ramble = "これらのクエリは作品の知識を幅広く問うように作成しました。"
+            body += "\n\n" + (ramble * (ramble_chars // len(ramble) + 1))[:ramble_chars]
+        return body
+    questions = re.findall(r'<question id="(\d+)">\n(.*?)\n</question>', last, re.DOTALL)
+    if questions:
+        # gen_answer.py --multi-questionのまとめた質問には、質問ごとに<answer id>タグで答える
+        return "\n".join(f'<answer id="{i}">モック回答: {question[:50]}</answer>' for i, question in questions)
+    return f"モック回答: {last[:50]}"
+
+def chat_completion_body(request, num_queries, ramble_chars=0):
+    content = canned_completion(request.get("messages", []), num_queries, ramble_chars)
+    prompt_tokens = sum(len(m.get("content", "")) for m in request.get("messages", []))
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model") or "mock-model",
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(content),
+            "total_tokens": prompt_tokens + len(content),
+        },
+    }
+
+def parse_multipart(content_type, body):
+    """multipart/form-dataを {フィールド名: バイト列} に変換する"""
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + body)
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        fields[name] = part.get_payload(decode=True)
+    return fields
+
+class MockState:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.connections = 0
+        # stream=trueのリクエスト: 送信した・クライアントが切断して送らなかった出力トークン数 (1文字1トークン)
+        self.streams = 0
+        self.streams_cancelled = 0
+        self.stream_tokens_sent = 0
+        self.stream_tokens_unsent = 0
+        self.files = {}
+        self.batches = {}
+        self.random = random.Random(args.seed)
+
+    def add_file(self, data, purpose):
+        file_id = f"file-{uuid.uuid4().hex}"
+        with self.lock:
+            self.files[file_id] = data
+        return {"id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+                "filename": f"{file_id}.jsonl", "purpose": purpose, "status": "processed"}
+
+    def run_batch(self, input_file_id, endpoint):
+        """バッチを即座に処理し、--batch-delay秒後に完了として見せる"""
+        outputs = []
+        errors = []
+        for line in self.files[input_file_id].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            with self.lock:
+                failed = self.random.random() < self.args.batch_failure_rate
+            if failed:
+                errors.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"],
+                               "response": None, "error": {"code": "server_error", "message": "mock failure"}})
+            else:
+                outputs.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"],
+                                "response": {"status_code": 200, "request_id": uuid.uuid4().hex,
+                                             "body": chat_completion_body(request["body"], self.args.num_queries,
+                                                                          self.args.ramble_chars)},
+                                "error": None})
+
+        def to_file(lines):
+            if not lines:
+                return None
+            data = "".join(json.dumps(line, ensure_ascii=False) + "\n" for line in lines).encode("utf-8")
+            return self.add_file(data, "batch_output")["id"]
+
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        batch = {
+            "id": batch_id, "object": "batch", "endpoint": endpoint, "errors": None,
+            "input_file_id": input_file_id, "completion_window": "24h", "status": "in_progress",
+            "output_file_id": to_file(outputs), "error_file_id": to_file(errors),
+            "created_at": int(time.time()), "ready_at": time.time() + self.args.batch_delay,
+            "request_counts": {"total": len(outputs) + len(errors), "completed": len(outputs), "failed": len(errors)},
+        }
+        with self.lock:
+            self.batches[batch_id] = batch
+        return self.batch_view(batch_id)
+
+    def batch_view(self, batch_id):
+        with self.lock:
+            batch = dict(self.batches[batch_id])
+        ready_at = batch.pop("ready_at")
+        if time.time() >= ready_at:
+            batch["status"] = "completed"
+        else:
+            batch["output_file_id"] = None
+            batch["error_file_id"] = None
+        return batch
+
+    def sample_latency(self):
+        """--latency-distに従った応答遅延 (秒)"""
+        args = self.args
+        with self.lock:
+            if args.latency_dist == "uniform":
+                return self.random.uniform(max(0.0, args.latency - args.latency_spread), args.latency + args.latency_spread)
+            if args.latency_dist == "exponential":
+                return self.random.expovariate(1 / args.latency) if args.latency > 0 else 0.0
+            if args.latency_dist == "lognormal":
+                # --latencyを中央値とし、--latency-spreadを対数の標準偏差とする
+                return args.latency * math.exp(self.random.gauss(0, args.latency_spread)) if args.latency > 0 else 0.0
+            return args.latency
+
+    def sample_failure(self):
+        """429・500を返すかどうかを決める (返さない場合はNone)"""
+        with self.lock:
+            value = self.random.random()
+            if value < self.args.rate_limit_rate:
+                self.rate_limited += 1
+                return 429
+            if value < self.args.rate_limit_rate + self.args.error_rate:
+                self.errors += 1
+                return 500
+        return None
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "rate_limited": self.rate_limited, "errors": self.errors,
+                    "connections": self.connections, "streams": self.streams,
+                    "streams_cancelled": self.streams_cancelled, "stream_tokens_sent": self.stream_tokens_sent,
+                    "stream_tokens_unsent": self.stream_tokens_unsent}
+
+class MockHandler(BaseHTTPRequestHandler):
+    # keep-aliveを有効にし、接続の使い回しを確認できるようにする
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def setup(self):
+        super().setup()
+        with self.state.lock:
+            self.state.connections += 1
+
+    def log_message(self, format, *args):
+        if self.state.args.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, payload, headers=None):
+        self.send_bytes(status, json.dumps(payload, ensure_ascii=False).encode("utf-8"), "application/json", headers)
+
+    def send_bytes(self, status, data, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length)
+
+    def read_json(self):
+        return json.loads(self.read_body() or b"{}")
+
+    def send_not_found(self):
+        self.send_json(404, {"error": {"message": "not found"}})
+
+    def do_GET(self):
+        path = self.path.rstrip("/")
+        parts = path.split("/")
+        if path == "/stats":
+            self.send_json(200, self.state.stats())
+        elif path.startswith("/v1/files/") and path.endswith("/content"):
+            data = self.state.files.get(parts[3])
+            if data is None:
+                self.send_not_found()
+            else:
+                self.send_bytes(200, data, "application/octet-stream")
+        elif path.startswith("/v1/batches/"):
+            if parts[3] in self.state.batches:
+                self.send_json(200, self.state.batch_view(parts[3]))
+            else:
+                self.send_not_found()
+        else:
+            self.send_not_found()
+
+    def do_POST(self):
+        path = self.path.rstrip("/")
+        if path.endswith("/chat/completions"):
+            self.handle_chat_completion(self.read_json())
+        elif path == "/v1/files":
+            fields = parse_multipart(self.headers.get("Content-Type"), self.read_body())
+            purpose = fields.get("purpose", b"batch").decode("utf-8")
+            self.send_json(200, self.state.add_file(fields["file"], purpose))
+        elif path == "/v1/batches":
+            request = self.read_json()
+            if request.get("input_file_id") not in self.state.files:
+                self.send_not_found()
+            else:
+                self.send_json(200, self.state.run_batch(request["input_file_id"], request.get("endpoint")))
+        else:
+            self.send_not_found()
+
+    def handle_chat_completion(self, request):
+        args = self.state.args
+        with self.state.lock:
+            self.state.requests += 1
+        latency = self.state.sample_latency()
+        if latency > 0:
+            time.sleep(latency)
+
+        status = self.state.sample_failure()
+        if status == 429:
+            self.send_json(429, {"error": {"message": "mock rate limit", "type": "rate_limit_exceeded"}},
+                           headers={"Retry-After": str(args.retry_after)})
+        elif status == 500:
+            self.send_json(500, {"error": {"message": "mock server error", "type": "server_error"}})
+        elif request.get("stream"):
+            self.send_stream(request)
+        else:
+            self.send_json(200, chat_completion_body(request, args.num_queries, args.ramble_chars))
+
+    def send_chunk(self, payload):
+        """Server-Sent Eventsの1イベントをchunked転送の1チャンクとして送る"""
+        data = b"data: " + (payload if isinstance(payload, bytes)
+                            else json.dumps(payload, ensure_ascii=False).encode("utf-8")) + b"\n\n"
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def send_stream(self, request):
+        """
+        stream=trueのリクエストに --stream-chunk-chars 文字ずつ --stream-interval 秒おきに返す
+        クライアントが途中で切断した場合は、送らなかった文字数を数える
+        """
+        args = self.state.args
+        body = chat_completion_body(request, args.num_queries, args.ramble_chars)
+        content = body["choices"][0]["message"]["content"]
+        base = {"id": body["id"], "object": "chat.completion.chunk", "created": body["created"], "model": body["model"]}
+        with self.state.lock:
+            self.state.streams += 1
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        sent = 0
+        try:
+            self.send_chunk({**base, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""},
+                                                  "finish_reason": None}]})
+            while sent < len(content):
+                if args.stream_interval > 0:
+                    time.sleep(args.stream_interval)
+                piece = content[sent:sent + args.stream_chunk_chars]
+                self.send_chunk({**base, "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+                sent += len(piece)
+            self.send_chunk({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            if (request.get("stream_options") or {}).get("include_usage"):
+                self.send_chunk({**base, "choices": [], "usage": body["usage"]})
+            self.send_chunk(b"[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+            with self.state.lock:
+                self.state.streams_cancelled += 1
+                self.state.stream_tokens_unsent += len(content) - sent
+        with self.state.lock:
+            self.state.stream_tokens_sent += sent
+
+def create_server(args):
+    state = MockState(args)
+    handler = type("BoundMockHandler", (MockHandler,), {"state": state})
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    server.daemon_threads = True
+    return server, state
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="OpenAI互換モックサーバー")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="1リクエストあたりの応答遅延 (秒、分布の中央値・平均)")
+    parser.add_argument("--latency-dist", type=str, default="fixed",
+                        choices=["fixed", "uniform", "exponential", "lognormal"], help="応答遅延の分布")
+    parser.add_argument("--latency-spread", type=float, default=0.5,
+                        help="uniformでは±の幅 (秒)、lognormalでは対数の標準偏差")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="429を返すリクエストの割合")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="500を返すリクエストの割合")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429のRetry-Afterヘッダーの値 (秒)")
+    parser.add_argument("--num-queries", type=int, default=10, help="クエリ生成時に返す<query>の数")
+    parser.add_argument("--ramble-chars", type=int, default=0,
+                        help="クエリ生成時に最後のクエリの後に続ける余計な文章の文字数")
+    parser.add_argument("--stream-chunk-chars", type=int, default=4, help="stream=true時に1チャンクで送る文字数")
+    parser.add_argument("--stream-interval", type=float, default=0.005,
+                        help="stream=true時にチャンクを送る間隔 (秒、出力トークンの生成速度の代わり)")
+    parser.add_argument("--batch-delay", type=float, default=1.0, help="バッチが完了するまでの時間 (秒)")
+    parser.add_argument("--batch-failure-rate", type=float, default=0.0, help="バッチ内で失敗させるリクエストの割合")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--verbose", action="store_true")
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+    server, _ = create_server(args)
+    print(f"モックサーバーを起動しました: http://{args.host}:{server.server_address[1]}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+モックサーバーを使ったオフラインのベンチマーク
+
+合成したknowledgeコーパスに対して gen_query / gen_answer を並列数を変えながら実行し、
+スループット・レイテンシ (p50/p95/p99)・ピークメモリを表示する
+実際のAPIは使わないため、並列数の調整や性能の劣化の検出に使える
+
+    python run_bench.py --articles 200 --latency 0.3 --latency-dist lognormal --rate-limit-rate 0.02 \
+        --query-concurrency 5,10 --answer-workers 20,40 --output bench_result.json
+    python run_bench.py ... --baseline bench_result.json   # 劣化していれば終了コード1
+    python run_bench.py --query-modes thread,stream --max-queries 5 --ramble-chars 300 --stages gen_query
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from mock_openai_server import build_parser as build_server_parser, create_server
+from kirara_common.metrics import load_events, percentile, summarize
+
+WORDS = ["きらら", "まんが", "タイム", "作品", "主人公", "部活", "日常", "アニメ", "連載", "単行本",
+         "キャラクター", "学校", "友達", "先輩", "後輩", "喫茶店", "キャンプ", "音楽", "バンド", "温泉"]
+
+def make_corpus(filename, num_articles, article_chars, seed):
+    """見出しと段落からなる合成記事をJSONLで書き出す"""
+    rng = random.Random(seed)
+    with open(filename, 'w', encoding='utf-8') as f:
+        for i in range(num_articles):
+            lines = [f"合成記事{i}"]
+            length = 0
+            section = 0
+            while length < article_chars:
+                if length == 0 or rng.random() < 0.2:
+                    section += 1
+                    lines.append(f"節{section}")
+                sentence = "".join(rng.choice(WORDS) for _ in range(rng.randint(5, 15))) + "。"
+                lines.append(sentence)
+                length += len(sentence)
+            f.write(json.dumps({"id": str(i), "title": f"合成記事{i}", "text": "\n".join(lines)},
+                               ensure_ascii=False) + '\n')
+
+def copy_stage(stage, work_dir):
+    """
+    ステージのスクリプトを作業ディレクトリにコピーする
+    キャッシュを空の状態から始め、リポジトリ内の.env (実際のAPIキー) を読み込まないようにするため
+    """
+    # 前回の実行のキャッシュや出力を残さない
+    shutil.rmtree(work_dir, ignore_errors=True)
+    stage_dir = work_dir / stage
+    stage_dir.mkdir(parents=True)
+    for path in (ROOT / stage).glob("*.py"):
+        shutil.copy(path, stage_dir)
+    return stage_dir
+
+def run_stage(python, stage_dir, script, args, env, log_filename):
+    """ステージを子プロセスで実行し、(終了コード, 経過時間, ピークRSS (MB)) を返す"""
+    start = time.perf_counter()
+    with open(log_filename, 'w', encoding='utf-8') as log:
+        process = subprocess.Popen([python, script, *args], cwd=stage_dir, env=env, stdout=log, stderr=log)
+        # 子プロセスごとのピークRSSを得るため、Popen.wait()ではなくwait4()で待つ
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = time.perf_counter() - start
+    # Linuxではru_maxrssはKB単位
+    return process.returncode, elapsed, rusage.ru_maxrss / 1024
+
+def server_stats(base_url):
+    with urllib.request.urlopen(base_url.removesuffix("/v1") + "/stats") as response:
+        return json.load(response)
+
+def collect(metrics_filename, stage_name, elapsed, exit_code, peak_rss, stats_before, stats_after, extra):
+    events = [e for e in load_events(metrics_filename) if e.get("cache") == "miss"] \
+        if os.path.exists(metrics_filename) else []
+    summary = summarize(events).get(stage_name, {})
+    totals = [e.get("queue_wait", 0) + e.get("latency", 0) for e in events if e.get("latency") is not None]
+    return {
+        "stage": stage_name,
+        **extra,
+        "exit_code": exit_code,
+        "requests": summary.get("requests", 0),
+        "elapsed": elapsed,
+        "throughput": summary.get("requests", 0) / elapsed if elapsed else 0.0,
+        "latency_p50": summary.get("latency_p50", 0.0),
+        "latency_p95": summary.get("latency_p95", 0.0),
+        "latency_p99": summary.get("latency_p99", 0.0),
+        # 流量制限・再試行の待ち時間を含めたリクエストあたりの時間
+        "total_p99": percentile(totals, 0.99),
+        "retries": summary.get("retries", 0),
+        "errors": summary.get("errors", 0),
+        "rate_limited": stats_after["rate_limited"] - stats_before["rate_limited"],
+        "server_errors": stats_after["errors"] - stats_before["errors"],
+        "peak_rss_mb": peak_rss,
+        # --query-modes streamのみ: 最初のクエリまでの時間と、打ち切りでサーバーが送らなかった出力トークン数
+        "ttfq_p50": summary.get("ttfq_p50", 0.0),
+        "stream_tokens_unsent": stats_after["stream_tokens_unsent"] - stats_before["stream_tokens_unsent"],
+    }
+
+def print_result(result):
+    print(f"{result['stage']:<10} {result['mode']:<6} 並列{result['concurrency']:>3}  "
+          f"{result['requests']:>5}件 {result['elapsed']:7.2f}秒 {result['throughput']:7.2f}件/秒  "
+          f"p50 {result['latency_p50']:.2f} p95 {result['latency_p95']:.2f} p99 {result['latency_p99']:.2f} "
+          f"(待ち込みp99 {result['total_p99']:.2f})  429 {result['rate_limited']:>3}  "
+          f"エラー {result['errors']:>3}  RSS {result['peak_rss_mb']:.0f}MB"
+          + (f"  TTFQ p50 {result['ttfq_p50']:.2f} 未送信 {result['stream_tokens_unsent']}トークン"
+             if result["mode"] == "stream" else "")
+          + ("" if result["exit_code"] == 0 else f"  終了コード {result['exit_code']}"))
+
+def compare(results, baseline, max_regression):
+    """ベースラインと比べてスループットやp99が劣化した実行を返す"""
+    key = lambda r: (r["stage"], r["mode"], r["concurrency"])
+    baseline_by_key = {key(r): r for r in baseline}
+    regressions = []
+    for result in results:
+        base = baseline_by_key.get(key(result))
+        if not base:
+            continue
+        if result["throughput"] < base["throughput"] * (1 - max_regression):
+            regressions.append(f"{key(result)}: スループット {base['throughput']:.2f} → {result['throughput']:.2f}件/秒")
+        if result["total_p99"] > base["total_p99"] * (1 + max_regression):
+            regressions.append(f"{key(result)}: p99 {base['total_p99']:.2f} → {result['total_p99']:.2f}秒")
+        if result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + max_regression):
+            regressions.append(f"{key(result)}: ピークRSS {base['peak_rss_mb']:.0f} → {result['peak_rss_mb']:.0f}MB")
+    return regressions
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+def main():
+    parser = argparse.ArgumentParser(description='モックサーバーを使ったgen_query / gen_answerのベンチマーク')
+    parser.add_argument('--articles', type=int, default=100, help='合成するknowledge記事の数')
+    parser.add_argument('--article-chars', type=int, default=2000, help='1記事あたりの文字数')
+    parser.add_argument('--query-concurrency', type=int_list, default=[5], help='gen_queryの並列数 (カンマ区切り)')
+    parser.add_argument('--query-modes', type=str, default='thread', help='gen_queryの実行方式 (thread,async,stream)')
+    parser.add_argument('--max-queries', type=int, default=None,
+                        help='streamモードで、このクエリ数を受け取った時点で生成を打ち切る')
+    parser.add_argument('--answer-workers', type=int_list, default=[20], help='gen_answerの並列数 (カンマ区切り)')
+    parser.add_argument('--stages', type=str, default='gen_query,gen_answer')
+    parser.add_argument('--python', type=str, default=sys.executable, help='ステージを実行するPython')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', type=str, default=None, help='作業ディレクトリ (省略時は一時ディレクトリ)')
+    parser.add_argument('--output', type=str, default=None, help='結果の出力先 (JSON)')
+    parser.add_argument('--baseline', type=str, default=None, help='比較するベースラインの結果 (JSON)')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='劣化とみなす割合')
+    args, server_args = parser.parse_known_args()
+
+    # 残りの引数 (--latency, --latency-dist, --rate-limit-rate, --error-rate, --num-queries など) はモックサーバーへ
+    server_args = build_server_parser().parse_args(["--port", "0", "--seed", str(args.seed), *server_args])
+    server, _ = create_server(server_args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix="kirara_bench_"))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    corpus = work_dir / "wiki.jsonl"
+    make_corpus(corpus, args.articles, args.article_chars, args.seed)
+    print(f"合成コーパス: {args.articles}記事 × 約{args.article_chars}文字  作業ディレクトリ: {work_dir}")
+
+    base_env = {**os.environ, "OPENAI_BASE_URL": base_url, "OPENAI_API_KEY": "bench",
+                "OPENAI_USE_MODEL": "gpt-4o-mini", "CACHE_BACKEND": "dir"}
+    stages = args.stages.split(',')
+    results = []
+    queries_file = None
+
+    if "gen_query" in stages:
+        for mode in args.query_modes.split(','):
+            for concurrency in args.query_concurrency:
+                run_dir = work_dir / f"gen_query_{mode}_{concurrency}"
+                stage_dir = copy_stage("gen_query", run_dir)
+                metrics_file = run_dir / "metrics.jsonl"
+                script_args = [str(corpus), str(run_dir / "generated_queries.jsonl"),
+                               str(run_dir / "text_and_prompt.jsonl"), "--concurrency", str(concurrency)]
+                if mode == "async":
+                    script_args.append("--async")
+                elif mode == "stream":
+                    script_args.append("--stream-queries")
+                    if args.max_queries:
+                        script_args += ["--max-queries", str(args.max_queries)]
+                before = server_stats(base_url)
+                exit_code, elapsed, peak_rss = run_stage(
+                    args.python, stage_dir, "main.py", script_args,
+                    {**base_env, "METRICS_FILE": str(metrics_file)}, run_dir / "log.txt")
+                result = collect(metrics_file, "gen_query", elapsed, exit_code, peak_rss, before,
+                                 server_stats(base_url), {"mode": mode, "concurrency": concurrency})
+                results.append(result)
+                print_result(result)
+                if queries_file is None and exit_code == 0:
+                    queries_file = run_dir / "generated_queries.jsonl"
+
+    if "gen_answer" in stages:
+        if queries_file is None:
+            # gen_queryを実行しない場合は合成コーパスから直接クエリを作る
+            queries_file = work_dir / "queries.jsonl"
+            with open(queries_file, 'w', encoding='utf-8') as f:
+                for i, article in enumerate(load_events(corpus)):
+                    for j in range(server_args.num_queries):
+                        f.write(json.dumps({"id": f"{i}-{j}", "text": article["text"],
+                                            "query": f"{article['title']}について質問{j}"}, ensure_ascii=False) + '\n')
+        for workers in args.answer_workers:
+            run_dir = work_dir / f"gen_answer_{workers}"
+            stage_dir = copy_stage("gen_answer", run_dir)
+            metrics_file = run_dir / "metrics.jsonl"
+            before = server_stats(base_url)
+            exit_code, elapsed, peak_rss = run_stage(
+                args.python, stage_dir, "gen_answer.py",
+                ["--input", str(queries_file), "--output", str(run_dir / "generated_answers.jsonl"),
+                 "--workers", str(workers)],
+                {**base_env, "METRICS_FILE": str(metrics_file)}, run_dir / "log.txt")
+            result = collect(metrics_file, "gen_answer", elapsed, exit_code, peak_rss, before,
+                             server_stats(base_url), {"mode": "thread", "concurrency": workers})
+            results.append(result)
+            print_result(result)
+
+    server.shutdown()
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"結果を '{args.output}' に保存しました。")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"劣化: {regression}")
+        if regressions:
+            sys.exit(1)
+        print("ベースラインからの劣化はありません")
+    if any(result["exit_code"] != 0 for result in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
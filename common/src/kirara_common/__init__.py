@@ -0,0 +1 @@
+"""get_knowledge_text / gen_query / gen_answer と、リポジトリ直下のpipeline.py / merge_shards.pyで共有するモジュール"""
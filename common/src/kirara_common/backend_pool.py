@@ -0,0 +1,510 @@
+"""
+複数のOpenAI互換バックエンド (vLLMのレプリカやホスティングされたAPI) にリクエストを振り分けるプール
+
+環境変数OPENAI_BACKENDSに設定ファイル (JSON) のパスを指定すると有効になる
+
+    {
+      "hedge_after": "p95",
+      "max_hedge_ratio": 0.1,
+      "backends": [
+        {"name": "vllm-1", "base_url": "http://10.0.0.1:8000/v1", "api_key": "EMPTY", "model": "Qwen/Qwen2.5-72B-Instruct",
+         "weight": 2, "max_concurrency": 32},
+        {"name": "vllm-2", "base_url": "http://10.0.0.2:8000/v1", "api_key": "EMPTY", "model": "Qwen/Qwen2.5-72B-Instruct",
+         "weight": 2, "max_concurrency": 32},
+        {"name": "openai", "api_key_env": "OPENAI_API_KEY", "model": "gpt-4o-mini", "max_concurrency": 8, "fallback": true}
+      ]
+    }
+
+- 振り分け: 処理中のリクエスト数 / weight が最も小さいバックエンドを選ぶ (max_concurrencyに達したものは除く)
+- 受動的なヘルスチェック: 接続エラー・タイムアウト・5xx・429が連続すると回路を開き、一定時間そのバックエンドを使わない
+  時間が経つと1件だけ試し、成功すれば戻す (失敗すれば開いている時間を倍にする)
+- fallback: trueのバックエンドは、それ以外の全てのバックエンドの回路が開いているときだけ使う
+- ヘッジ: hedge_after秒 ("p95"などの場合は最近のレイテンシの分位点) 経っても応答が無ければ、
+  別のバックエンドにも同じリクエストを送り、先に返った方を使う (送る数はmax_hedge_ratioの割合まで)
+  負けた方のストリームは閉じる
+- stream=Trueのリクエストは、最後まで受信するか閉じるまで処理中として数える
+
+OpenAIクライアントと同じく chat.completions.create() で呼び出せる
+"""
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from kirara_common.scheduler import _wake, is_retryable_error
+
+# 回路を開くまでの連続失敗回数と、最初に開いておく秒数 (繰り返し開くたびに倍、最大MAX_COOLDOWN秒)
+FAILURE_THRESHOLD = 5
+COOLDOWN = 10.0
+MAX_COOLDOWN = 300.0
+# ヘッジの待ち時間を分位点で決める場合に使う最近のレイテンシの数
+LATENCY_WINDOW = 200
+MIN_LATENCY_SAMPLES = 20
+
+class Backend:
+    """1つのエンドポイントの設定と状態"""
+
+    def __init__(self, name, base_url=None, api_key=None, model=None, weight=1.0, max_concurrency=16,
+                 fallback=False, timeout=600.0):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.weight = float(weight)
+        self.max_concurrency = max_concurrency
+        self.fallback = fallback
+        self.timeout = timeout
+        self.outstanding = 0
+        # 回路の状態 (open_untilが未来なら開いている、trialは半開状態で試しているリクエストの有無)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.trips_in_row = 0
+        self.trial = False
+        # 集計
+        self.requests = 0
+        self.failures = 0
+        self.trips = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.latency_sum = 0.0
+        self.successes = 0
+        self._client = None
+        self._async_client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import OpenAI
+            # 再試行はRequestSchedulerで行う (再試行のたびにプールが振り分け直す)
+            self._client = OpenAI(base_url=self.base_url, api_key=self.api_key, max_retries=0, timeout=self.timeout)
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            import httpx
+            from openai import AsyncOpenAI
+            self._async_client = AsyncOpenAI(
+                base_url=self.base_url, api_key=self.api_key, max_retries=0,
+                http_client=httpx.AsyncClient(
+                    limits=httpx.Limits(max_connections=self.max_concurrency,
+                                        max_keepalive_connections=self.max_concurrency, keepalive_expiry=60),
+                    timeout=httpx.Timeout(self.timeout, connect=10),
+                ),
+            )
+        return self._async_client
+
+    def is_open(self, now):
+        return now < self.open_until
+
+    def can_accept(self, now):
+        """新しいリクエストを送れるか (半開状態では試しのリクエスト1件だけ)"""
+        if self.outstanding >= self.max_concurrency or self.is_open(now):
+            return False
+        return not (self.open_until and self.trial)
+
+class _PooledStream:
+    """
+    stream=Trueの応答 (openai.Stream) を包み、最後まで受信するか閉じた時点でバックエンドの枠を返す
+    (ヘッダーを受け取った時点で返すと、受信中のリクエストがmax_concurrencyと振り分けで数えられなくなる)
+    レイテンシは最後まで受信した場合だけ記録する
+    """
+
+    def __init__(self, pool, backend, stream, start):
+        self._pool = pool
+        self._backend = backend
+        self._stream = stream
+        self._start = start
+        self._released = False
+
+    def _finish(self, healthy, latency=None):
+        if not self._released:
+            self._released = True
+            self._pool._release(self._backend, healthy, latency)
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                yield chunk
+        except Exception:
+            # 受信中の切断はバックエンドの失敗とみなす
+            self._finish(False)
+            raise
+        self._finish(True, time.perf_counter() - self._start)
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            self._finish(True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+class _AsyncPooledStream(_PooledStream):
+    """_PooledStreamの非同期版 (openai.AsyncStream)"""
+
+    def __iter__(self):
+        raise TypeError("async for で受信してください")
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        except asyncio.CancelledError:
+            self._finish(None)
+            raise
+        except Exception:
+            self._finish(False)
+            raise
+        self._finish(True, time.perf_counter() - self._start)
+
+    async def close(self):
+        try:
+            await self._stream.close()
+        finally:
+            self._finish(True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+def _discard(future):
+    """ヘッジで使わなかった方のリクエストが応答を返していれば、ストリームを閉じて枠を返す"""
+    if future.cancelled() or future.exception() is not None:
+        return
+    response = future.result()
+    if isinstance(response, _AsyncPooledStream):
+        asyncio.ensure_future(response.close())
+    elif isinstance(response, _PooledStream):
+        response.close()
+
+class _Completions:
+    def __init__(self, create):
+        self.create = create
+
+class _Chat:
+    def __init__(self, create):
+        self.completions = _Completions(create)
+
+class AsyncPoolClient:
+    """BackendPoolの非同期版のクライアント (AsyncOpenAIと同じく async with で使う)"""
+
+    def __init__(self, pool):
+        self._pool = pool
+        self.chat = _Chat(pool.acreate)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._pool.aclose()
+
+class BackendPool:
+    """
+    複数のバックエンドへの振り分け・回路遮断・ヘッジを行うクライアント
+    複数スレッドから同時に呼び出してよい
+    """
+
+    def __init__(self, backends, hedge_after=None, max_hedge_ratio=0.1):
+        if not backends:
+            raise ValueError("バックエンドが1つも設定されていません")
+        self.backends = backends
+        self.hedge_after = hedge_after
+        self.max_hedge_ratio = max_hedge_ratio
+        self.chat = _Chat(self.create)
+        self._condition = threading.Condition()
+        # 空きを待っているコルーチン (ループ, Future)
+        self._async_waiters = []
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._requests = 0
+        self._hedges = 0
+        self._executor = None
+
+    @classmethod
+    def from_config(cls, filename):
+        with open(filename, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        backends = []
+        for i, entry in enumerate(config["backends"]):
+            api_key = entry.get("api_key") or os.environ.get(entry.get("api_key_env", "OPENAI_API_KEY"))
+            backends.append(Backend(
+                name=entry.get("name", f"backend-{i}"),
+                base_url=entry.get("base_url") or os.environ.get("OPENAI_BASE_URL"),
+                api_key=api_key or "EMPTY",
+                model=entry.get("model"),
+                weight=entry.get("weight", 1.0),
+                max_concurrency=entry.get("max_concurrency", 16),
+                fallback=entry.get("fallback", False),
+                timeout=entry.get("timeout", 600.0),
+            ))
+        return cls(backends, hedge_after=config.get("hedge_after"),
+                   max_hedge_ratio=config.get("max_hedge_ratio", 0.1))
+
+    def _pick(self, now, exclude=()):
+        """処理中のリクエスト数 / weight が最も小さいバックエンド (送れるものが無ければNone)"""
+        candidates = [b for b in self.backends if b not in exclude]
+        # fallbackは、それ以外の全てのバックエンドの回路が開いているときだけ使う
+        # (回路が開いているか、半開状態で試しのリクエストの結果を待っているものを停止中とみなす)
+        primaries = [b for b in candidates if not b.fallback]
+        if all(b.is_open(now) or (b.open_until and b.trial) for b in primaries):
+            pool = candidates
+        else:
+            pool = primaries
+        available = [b for b in pool if b.can_accept(now)]
+        if not available:
+            return None
+        best = min((b.outstanding + 1) / b.weight for b in available)
+        return random.choice([b for b in available if (b.outstanding + 1) / b.weight == best])
+
+    def _acquire(self, exclude=(), block=True):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                backend = self._pick(now, exclude)
+                if backend is not None:
+                    if backend.open_until:
+                        # 回路が開いた後の試しのリクエスト
+                        backend.trial = True
+                    backend.outstanding += 1
+                    backend.requests += 1
+                    return backend
+                if not block:
+                    return None
+                # 回路が半開になる時刻か、処理中のリクエストが終わるまで待つ
+                self._condition.wait(timeout=self._reopen_delay(now))
+
+    def _reopen_delay(self, now):
+        """次に回路が半開になるまでの秒数 (最大1秒)"""
+        return min([b.open_until - now for b in self.backends if b.is_open(now)] + [1.0])
+
+    async def _aacquire(self):
+        """_acquire()の非同期版 (空きが無ければ_release()で起こされるまで待つ)"""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                backend = self._acquire(block=False)
+                if backend is not None:
+                    return backend
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+                timeout = self._reopen_delay(time.monotonic())
+            try:
+                await asyncio.wait({waiter}, timeout=timeout)
+            finally:
+                with self._condition:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+
+    def _release(self, backend, healthy, latency=None):
+        """
+        healthy: Trueなら成功 (バックエンドが応答した)、Falseなら失敗、Noneなら中断 (ヘッジで不要になった)
+        """
+        with self._condition:
+            backend.outstanding -= 1
+            if healthy:
+                backend.consecutive_failures = 0
+                if backend.open_until:
+                    print(f"バックエンド '{backend.name}' が回復しました")
+                backend.open_until = 0.0
+                backend.trips_in_row = 0
+                backend.trial = False
+                if latency is not None:
+                    backend.successes += 1
+                    backend.latency_sum += latency
+                    self._latencies.append(latency)
+            elif healthy is False:
+                backend.failures += 1
+                backend.consecutive_failures += 1
+                if backend.trial or backend.consecutive_failures >= FAILURE_THRESHOLD:
+                    cooldown = min(MAX_COOLDOWN, COOLDOWN * 2 ** backend.trips_in_row)
+                    backend.open_until = time.monotonic() + cooldown
+                    backend.trips_in_row += 1
+                    backend.trips += 1
+                    backend.consecutive_failures = 0
+                    # 開いている時間が過ぎたら、もう一度1件だけ試せるようにする
+                    backend.trial = False
+                    print(f"バックエンド '{backend.name}' を{cooldown:.0f}秒間使いません (連続して失敗しました)")
+            elif backend.trial:
+                backend.trial = False
+            self._condition.notify_all()
+            for loop, waiter in self._async_waiters:
+                loop.call_soon_threadsafe(_wake, waiter)
+            self._async_waiters.clear()
+
+    def _hedge_delay(self):
+        """ヘッジを送るまでの秒数 (ヘッジしない場合はNone)"""
+        if self.hedge_after is None or len(self.backends) < 2:
+            return None
+        if isinstance(self.hedge_after, str):
+            # "p95" のように最近のレイテンシの分位点で決める
+            with self._condition:
+                latencies = sorted(self._latencies)
+            if len(latencies) < MIN_LATENCY_SAMPLES:
+                return None
+            quantile = float(self.hedge_after.lstrip('p')) / 100
+            return latencies[min(len(latencies) - 1, int(len(latencies) * quantile))]
+        return float(self.hedge_after)
+
+    def _acquire_hedge(self, exclude):
+        """ヘッジ用のバックエンド (送れる割合を超えている場合や空きが無い場合はNone)"""
+        with self._condition:
+            if self._hedges >= self.max_hedge_ratio * self._requests:
+                return None
+        backend = self._acquire(exclude, block=False)
+        if backend is not None:
+            with self._condition:
+                self._hedges += 1
+                backend.hedges += 1
+        return backend
+
+    def _request_kwargs(self, backend, kwargs):
+        # バックエンドごとにモデル名が違う場合はバックエンドの設定を使う
+        return {**kwargs, "model": backend.model or kwargs.get("model")}
+
+    def _send(self, backend, kwargs):
+        start = time.perf_counter()
+        try:
+            response = backend.client.chat.completions.create(**self._request_kwargs(backend, kwargs))
+        except Exception as e:
+            self._release(backend, False if is_retryable_error(e) else True)
+            raise
+        if kwargs.get("stream"):
+            return _PooledStream(self, backend, response, start)
+        self._release(backend, True, time.perf_counter() - start)
+        return response
+
+    def create(self, **kwargs):
+        """chat.completions.create() と同じ引数でリクエストを送る"""
+        backend = self._acquire()
+        with self._condition:
+            self._requests += 1
+        delay = self._hedge_delay()
+        if delay is None:
+            return self._send(backend, kwargs)
+
+        # ヘッジする場合は呼び出し元のスレッドでは待つだけにし、先に返った方を使う
+        with self._condition:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=sum(b.max_concurrency for b in self.backends), thread_name_prefix="backend_pool")
+        futures = {self._executor.submit(self._send, backend, kwargs): backend}
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            hedge = self._acquire_hedge(exclude={backend})
+            if hedge is not None:
+                futures[self._executor.submit(self._send, hedge, kwargs)] = hedge
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if futures[future] is not backend:
+                        with self._condition:
+                            futures[future].hedge_wins += 1
+                    # 負けた方のリクエストは、応答が返った時点でストリームを閉じる
+                    for other in futures:
+                        if other is not future:
+                            other.add_done_callback(_discard)
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def _asend(self, backend, kwargs):
+        start = time.perf_counter()
+        try:
+            response = await backend.async_client.chat.completions.create(**self._request_kwargs(backend, kwargs))
+        except asyncio.CancelledError:
+            self._release(backend, None)
+            raise
+        except Exception as e:
+            self._release(backend, False if is_retryable_error(e) else True)
+            raise
+        if kwargs.get("stream"):
+            return _AsyncPooledStream(self, backend, response, start)
+        self._release(backend, True, time.perf_counter() - start)
+        return response
+
+    async def acreate(self, **kwargs):
+        """create()の非同期版 (ヘッジで不要になった方のリクエストは取り消す)"""
+        backend = await self._aacquire()
+        with self._condition:
+            self._requests += 1
+        delay = self._hedge_delay()
+        if delay is None:
+            return await self._asend(backend, kwargs)
+
+        primary = asyncio.ensure_future(self._asend(backend, kwargs))
+        tasks = {primary: backend}
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if not done:
+            hedge = self._acquire_hedge(exclude={backend})
+            if hedge is not None:
+                tasks[asyncio.ensure_future(self._asend(hedge, kwargs))] = hedge
+        pending = set(tasks)
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            with self._condition:
+                                tasks[task].hedge_wins += 1
+                        # 負けた方は取り消す (取り消す前に応答が返っていればストリームを閉じる)
+                        for other in tasks:
+                            if other is not task:
+                                other.add_done_callback(_discard)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def async_client(self):
+        """asyncio用のクライアント (async with を抜けるとバックエンドごとの接続を閉じる)"""
+        return AsyncPoolClient(self)
+
+    async def aclose(self):
+        for backend in self.backends:
+            if backend._async_client is not None:
+                await backend._async_client.close()
+                backend._async_client = None
+
+    def report(self):
+        print(f"バックエンド: {self._requests}件のリクエスト  ヘッジ: {self._hedges}件")
+        for b in self.backends:
+            mean = b.latency_sum / b.successes if b.successes else 0.0
+            state = "停止中" if b.is_open(time.monotonic()) else "正常"
+            print(f"  {b.name:<16} 送信 {b.requests:>6}件  失敗 {b.failures:>4}件  回路遮断 {b.trips:>3}回  "
+                  f"ヘッジ {b.hedges:>4}件 (先着 {b.hedge_wins}件)  平均レイテンシ {mean:.2f}秒  {state}"
+                  + ("  (fallback)" if b.fallback else ""))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """OPENAI_BACKENDSで指定したバックエンドプール (プロセス全体で共有、未設定ならNone)"""
+    global _pool
+    filename = os.environ.get("OPENAI_BACKENDS")
+    if not filename:
+        return None
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = BackendPool.from_config(Path(filename))
+    return _pool
@@ -0,0 +1,163 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+class DirectoryCache:
+    """1キー1ファイルのキャッシュ (従来の cache/<id>.json / cache/<id>.jsonl)"""
+
+    def __init__(self, directory, suffix=".json"):
+        self.directory = Path(directory)
+        self.suffix = suffix
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key):
+        return self.directory / f"{key}{self.suffix}"
+
+    def get(self, key):
+        path = self._path(key)
+        if not path.exists():
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            if self.suffix == ".jsonl":
+                return json.loads(f.readline())
+            return json.load(f)
+
+    def get_many(self, keys):
+        return {key: value for key in keys if (value := self.get(key)) is not None}
+
+    def put(self, key, value):
+        with open(self._path(key), 'w', encoding='utf-8') as f:
+            if self.suffix == ".jsonl":
+                f.write(json.dumps(value, ensure_ascii=False) + '\n')
+            else:
+                json.dump(value, f, ensure_ascii=False)
+
+    def existing(self, keys):
+        """keysのうちキャッシュ済みのものを返す (ディレクトリを1度だけ走査する)"""
+        names = set(os.listdir(self.directory))
+        return {key for key in keys if f"{key}{self.suffix}" in names}
+
+    def items(self):
+        for path in self.directory.glob(f"*{self.suffix}"):
+            key = path.name[:-len(self.suffix)]
+            yield key, self.get(key)
+
+class SQLiteCache:
+    """
+    SQLite (WALモード) の単一ファイルキャッシュ
+
+    キーはステージごとの名前空間で区切られる
+    接続はスレッドごとに作り、複数スレッド・複数プロセスからの書き込みに対応する
+    """
+
+    # SQLiteのバインド変数の上限を超えないように分割する
+    BATCH_SIZE = 500
+
+    def __init__(self, path, namespace):
+        self.path = str(path)
+        self.namespace = namespace
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute(
+            "SELECT value FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _select_many(self, columns, keys):
+        keys = list(keys)
+        conn = self._conn()
+        for i in range(0, len(keys), self.BATCH_SIZE):
+            batch = keys[i:i + self.BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            yield from conn.execute(
+                f"SELECT {columns} FROM cache WHERE namespace = ? AND key IN ({placeholders})",
+                (self.namespace, *batch),
+            )
+
+    def get_many(self, keys):
+        return {key: json.loads(value) for key, value in self._select_many("key, value", keys)}
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def put_many(self, items):
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO cache (namespace, key, value) VALUES (?, ?, ?)",
+                ((self.namespace, key, json.dumps(value, ensure_ascii=False)) for key, value in items),
+            )
+
+    def existing(self, keys):
+        """keysのうちキャッシュ済みのものを返す (まとめて問い合わせる)"""
+        return {row[0] for row in self._select_many("key", keys)}
+
+    def items(self):
+        cursor = self._conn().execute("SELECT key, value FROM cache WHERE namespace = ?", (self.namespace,))
+        for key, value in cursor:
+            yield key, json.loads(value)
+
+def open_cache(namespace, directory="cache", suffix=".json"):
+    """
+    環境変数CACHE_BACKENDに応じたキャッシュを開く
+
+    - dir (デフォルト): directory以下に1キー1ファイル
+    - sqlite: CACHE_DB (デフォルト cache.sqlite3) の単一ファイル、namespaceで区切る
+    """
+    backend = os.environ.get("CACHE_BACKEND", "dir")
+    if backend == "sqlite":
+        return SQLiteCache(os.environ.get("CACHE_DB", "cache.sqlite3"), namespace)
+    if backend == "dir":
+        return DirectoryCache(directory, suffix)
+    raise ValueError(f"未対応のキャッシュバックエンドです: {backend}")
+
+def migrate(directory, suffix, db_path, namespace, batch_size=1000):
+    """既存のキャッシュディレクトリをSQLiteキャッシュに移行する"""
+    source = DirectoryCache(directory, suffix)
+    target = SQLiteCache(db_path, namespace)
+    batch = []
+    count = 0
+    for key, value in source.items():
+        batch.append((key, value))
+        if len(batch) >= batch_size:
+            target.put_many(batch)
+            count += len(batch)
+            batch = []
+            print(f"移行済み: {count}件")
+    target.put_many(batch)
+    count += len(batch)
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description='キャッシュディレクトリをSQLiteキャッシュに移行する')
+    parser.add_argument('directory', type=str, help='移行元のキャッシュディレクトリ')
+    parser.add_argument('--namespace', type=str, required=True, help='名前空間 (gen_query / gen_answer)')
+    parser.add_argument('--suffix', type=str, default='.json', help='キャッシュファイルの拡張子 (gen_answerは.jsonl)')
+    parser.add_argument('--db', type=str, default='cache.sqlite3')
+    args = parser.parse_args()
+
+    count = migrate(args.directory, args.suffix, args.db, args.namespace)
+    print(f"{count}件のキャッシュを '{args.db}' (名前空間: {args.namespace}) に移行しました。")
+
+if __name__ == "__main__":
+    main()
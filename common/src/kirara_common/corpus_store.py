@@ -0,0 +1,302 @@
+"""
+メモリマップで読み込むknowledgeコーパス (.kcorpus)
+
+wiki.json / wiki.jsonl / syudou.json を1度だけ変換しておくと、各ステージは
+ファイル全体を読み込まずに、N番目の記事をゼロコピーで、内容ハッシュから記事をO(1)で引ける
+
+ファイルの構成 (リトルエンディアン):
+    ヘッダー | インデックス (記事ごとの固定長レコード) | ハッシュ表 | メタデータ | トークンID | 本文 (UTF-8)
+
+    python -m kirara_common.corpus_store build wiki.jsonl wiki.kcorpus [--tokens]
+    python -m kirara_common.corpus_store info wiki.kcorpus
+    python -m kirara_common.corpus_store get wiki.kcorpus 0
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+from collections.abc import Mapping
+from pathlib import Path
+
+try:
+    import tiktoken  # 任意
+except ImportError:
+    tiktoken = None
+
+MAGIC = b"KCORPUS\0"
+VERSION = 1
+FLAG_TOKENS = 1
+# magic, version, flags, 記事数, ハッシュ表のスロット数, 各セクションの開始位置 (インデックス, ハッシュ表, メタデータ, トークンID, 本文), トークナイザー名
+HEADER = struct.Struct("<8sIIQQQQQQQ16s")
+# 内容ハッシュ (sha256), 本文の位置と長さ, メタデータの位置と長さ, トークンIDの位置とトークン数
+RECORD = struct.Struct("<32sQQQQQQ")
+SLOT = struct.Struct("<Q")
+ENCODING_NAME = "o200k_base"
+TOKEN_BATCH = 256
+
+def tokenizer_name():
+    """このプロセスでトークン数を数える方法 (gen_queryのchunking.count_tokensと同じ)"""
+    return ENCODING_NAME if tiktoken is not None else "chars"
+
+def iter_articles(input_filename):
+    """記事を1件ずつ読み込む (JSONLなら1行ずつ、.jsonなら全体を読み込む)"""
+    with open(input_filename, 'r', encoding='utf-8') as f:
+        if Path(input_filename).suffix == '.jsonl':
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(f)
+
+def iter_batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def build_corpus(input_filename, output_filename, with_tokens=False):
+    """
+    記事ファイルから.kcorpusを作る
+
+    本文・メタデータ・トークンIDは一時ファイルに逐次書き出し、メモリには
+    記事ごとの固定長レコードだけを保持する
+    with_tokens=Trueではtiktokenで数えたトークンIDも保存する (トークン数は常に保存する)
+
+    Returns:
+        記事数
+    """
+    if with_tokens and tiktoken is None:
+        raise RuntimeError("トークンIDを保存するにはtiktokenをインストールしてください")
+    if tiktoken is None:
+        print("警告: tiktokenがインストールされていないため、トークン数の代わりに文字数を保存します")
+    encoding = tiktoken.get_encoding(ENCODING_NAME) if tiktoken is not None else None
+    output_dir = Path(output_filename).resolve().parent
+    records = []
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+        text_path, meta_path, tokens_path = (Path(tmp_dir) / name for name in ("text", "meta", "tokens"))
+        with open(text_path, 'wb') as text_file, open(meta_path, 'wb') as meta_file, \
+                open(tokens_path, 'wb') as tokens_file:
+            for batch in iter_batches(iter_articles(input_filename), TOKEN_BATCH):
+                texts = [article["text"] for article in batch]
+                if encoding is not None:
+                    token_lists = encoding.encode_batch(texts, disallowed_special=())
+                else:
+                    token_lists = [None] * len(texts)
+                for article, text, tokens in zip(batch, texts, token_lists):
+                    text_bytes = text.encode('utf-8')
+                    meta = json.dumps({k: v for k, v in article.items() if k != "text"},
+                                      ensure_ascii=False).encode('utf-8')
+                    token_offset = tokens_file.tell()
+                    if with_tokens:
+                        token_array = array('I', tokens)
+                        if sys.byteorder == 'big':
+                            token_array.byteswap()
+                        token_array.tofile(tokens_file)
+                    records.append((
+                        hashlib.sha256(text_bytes).digest(),
+                        text_file.tell(), len(text_bytes),
+                        meta_file.tell(), len(meta),
+                        token_offset, len(tokens) if tokens is not None else len(text),
+                    ))
+                    text_file.write(text_bytes)
+                    meta_file.write(meta)
+
+        # 負荷率が0.5以下になる2のべき乗のスロット数で、線形探索のハッシュ表を作る
+        table_size = 1
+        while table_size < max(2 * len(records), 2):
+            table_size *= 2
+        table = array('Q', bytes(8 * table_size))
+        for index, record in enumerate(records):
+            slot = int.from_bytes(record[0][:8], 'little') & (table_size - 1)
+            while table[slot]:
+                # 同じ本文の記事は最初のものを引く
+                if records[table[slot] - 1][0] == record[0]:
+                    break
+                slot = (slot + 1) & (table_size - 1)
+            else:
+                table[slot] = index + 1
+        if sys.byteorder == 'big':
+            table.byteswap()
+
+        index_offset = HEADER.size
+        table_offset = index_offset + RECORD.size * len(records)
+        meta_offset = table_offset + SLOT.size * table_size
+        # トークンIDはmemoryview.cast('I')で読めるよう4バイト境界に置く
+        tokens_offset = meta_offset + meta_path.stat().st_size
+        tokens_offset += -tokens_offset % 4
+        text_offset = tokens_offset + tokens_path.stat().st_size
+
+        tmp_output = f"{output_filename}.tmp"
+        with open(tmp_output, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, FLAG_TOKENS if with_tokens else 0, len(records), table_size,
+                                index_offset, table_offset, meta_offset, tokens_offset, text_offset,
+                                tokenizer_name().encode('ascii')))
+            for record in records:
+                f.write(RECORD.pack(*record))
+            table.tofile(f)
+            for path, offset in ((meta_path, meta_offset), (tokens_path, tokens_offset), (text_path, text_offset)):
+                f.write(bytes(offset - f.tell()))
+                with open(path, 'rb') as src:
+                    shutil.copyfileobj(src, f)
+        os.replace(tmp_output, output_filename)
+    return len(records)
+
+class HashIndex(Mapping):
+    """内容ハッシュ (16進数) から本文を引く読み取り専用のマッピング"""
+
+    def __init__(self, corpus):
+        self._corpus = corpus
+
+    def __getitem__(self, key):
+        index = self._corpus.find(key)
+        if index is None:
+            raise KeyError(key)
+        return self._corpus.text(index)
+
+    def __contains__(self, key):
+        return self._corpus.find(key) is not None
+
+    def __iter__(self):
+        return (self._corpus.content_hash(i) for i in range(len(self._corpus)))
+
+    def __len__(self):
+        return len(self._corpus)
+
+class CorpusStore:
+    """
+    .kcorpusの読み込み (メモリマップ)
+
+    記事のリストと同じように len() / [i] / for で使える ([i]はその記事の本文だけをデコードする)
+    text_bytes() / tokens() はコピーせずにmemoryviewを返す
+    複数スレッドから同時に読んでよい
+    """
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+        self._file = open(filename, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mm)
+        (magic, version, self.flags, self._count, self._table_size, self._index_offset, self._table_offset,
+         self._meta_offset, self._tokens_offset, self._text_offset, tokenizer) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"'{filename}' は対応している形式の.kcorpusではありません")
+        self.tokenizer = tokenizer.rstrip(b"\0").decode('ascii')
+        self.by_hash = HashIndex(self)
+
+    def __len__(self):
+        return self._count
+
+    def _record(self, index):
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        return RECORD.unpack_from(self._mm, self._index_offset + RECORD.size * index)
+
+    def text_bytes(self, index):
+        """本文 (UTF-8) のmemoryview (コピーしない)"""
+        _, offset, length, *_ = self._record(index)
+        start = self._text_offset + offset
+        return self._view[start:start + length]
+
+    def text(self, index):
+        return str(self.text_bytes(index), 'utf-8')
+
+    def meta(self, index):
+        """本文以外のフィールド (id, title, sourceなど)"""
+        _, _, _, offset, length, _, _ = self._record(index)
+        start = self._meta_offset + offset
+        return json.loads(self._view[start:start + length].tobytes())
+
+    def token_count(self, index):
+        """ビルド時に数えたトークン数 (tokenizerが"chars"なら文字数)"""
+        return self._record(index)[6]
+
+    def known_token_count(self, index):
+        """このプロセスと同じ方法で数えたトークン数 (方法が違えばNone)"""
+        return self.token_count(index) if self.tokenizer == tokenizer_name() else None
+
+    def tokens(self, index):
+        """トークンIDのmemoryview (コピーしない、ビルド時に--tokensを付けていなければNone)"""
+        if not self.flags & FLAG_TOKENS:
+            return None
+        _, _, _, _, _, offset, count = self._record(index)
+        start = self._tokens_offset + offset
+        return self._view[start:start + 4 * count].cast('I')
+
+    def content_hash(self, index):
+        """本文の内容ハッシュ (16進数、gen_query / gen_answerのknowledge_idと同じ値)"""
+        return self._record(index)[0].hex()
+
+    def find(self, key):
+        """内容ハッシュ (16進数またはバイト列) の記事のインデックス (無ければNone)"""
+        digest = bytes.fromhex(key) if isinstance(key, str) else key
+        if len(digest) != 32:
+            return None
+        mask = self._table_size - 1
+        slot = int.from_bytes(digest[:8], 'little') & mask
+        while True:
+            (value,) = SLOT.unpack_from(self._mm, self._table_offset + SLOT.size * slot)
+            if not value:
+                return None
+            if self._record(value - 1)[0] == digest:
+                return value - 1
+            slot = (slot + 1) & mask
+
+    def __getitem__(self, index):
+        """記事のレコード (wiki.jsonの1件と同じ形式)"""
+        if index < 0:
+            index += self._count
+        return {**self.meta(index), "text": self.text(index)}
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield self[index]
+
+    def close(self):
+        self.by_hash = None
+        self._view.release()
+        self._mm.close()
+        self._file.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='メモリマップで読み込むknowledgeコーパス (.kcorpus) を作成・確認する')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='記事ファイル (JSON / JSONL) から.kcorpusを作る')
+    build_parser.add_argument('input', type=str)
+    build_parser.add_argument('output', type=str)
+    build_parser.add_argument('--tokens', action='store_true', help='トークンIDも保存する (tiktokenが必要)')
+    info_parser = subparsers.add_parser('info', help='記事数・トークン数を表示する')
+    info_parser.add_argument('corpus', type=str)
+    get_parser = subparsers.add_parser('get', help='インデックスまたは内容ハッシュで記事を表示する')
+    get_parser.add_argument('corpus', type=str)
+    get_parser.add_argument('key', type=str)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        count = build_corpus(args.input, args.output, args.tokens)
+        print(f"{count}件の記事を '{args.output}' に保存しました。")
+    elif args.command == 'info':
+        corpus = CorpusStore(args.corpus)
+        total_tokens = sum(corpus.token_count(i) for i in range(len(corpus)))
+        print(f"記事数: {len(corpus)}  トークン数: {total_tokens} ({corpus.tokenizer})  "
+              f"トークンID: {'あり' if corpus.flags & FLAG_TOKENS else 'なし'}  "
+              f"サイズ: {os.path.getsize(args.corpus) / 1024 / 1024:.2f}MB")
+    else:
+        corpus = CorpusStore(args.corpus)
+        index = int(args.key) if args.key.isdigit() else corpus.find(args.key)
+        if index is None:
+            print(f"エラー: 内容ハッシュ '{args.key}' の記事が見つかりません。")
+            sys.exit(1)
+        print(json.dumps(corpus[index], ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
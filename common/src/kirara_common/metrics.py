@@ -0,0 +1,242 @@
+import argparse
+import json
+import os
+import threading
+import time
+
+# 1Mトークンあたりの料金 (USD): 入力, 出力, キャッシュ済み入力
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.60, 0.075),
+    "gpt-4o": (2.50, 10.00, 1.25),
+    "gpt-4.1-mini": (0.40, 1.60, 0.10),
+    "gpt-4.1": (2.00, 8.00, 0.50),
+}
+# Batch APIは通常の半額
+BATCH_DISCOUNT = 0.5
+
+class MetricsRecorder:
+    """
+    1リクエストごとのメトリクスをJSONLに追記する
+    filenameがNoneの場合は何もしない
+    複数のプロセス (gen_queryとgen_answer) から同じファイルに追記してよい
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._file = open(filename, 'a', encoding='utf-8') if filename else None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self._file is not None
+
+    def record(self, **fields):
+        if not self.enabled:
+            return
+        line = json.dumps({"ts": time.time(), **fields}, ensure_ascii=False) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+def get_recorder():
+    """プロセス全体で共有するMetricsRecorder (環境変数METRICS_FILEが出力先)"""
+    global _recorder
+    if _recorder is None:
+        with _recorder_lock:
+            if _recorder is None:
+                _recorder = MetricsRecorder(os.environ.get("METRICS_FILE"))
+    return _recorder
+
+def usage_fields(usage):
+    """レスポンスのusage (オブジェクトまたはdict) からトークン数を取り出す"""
+    if usage is None:
+        return {}
+    if isinstance(usage, dict):
+        details = usage.get("prompt_tokens_details") or {}
+        cached_tokens = details.get("cached_tokens")
+        prompt_tokens = usage.get("prompt_tokens")
+        completion_tokens = usage.get("completion_tokens")
+    else:
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) if details else None
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        completion_tokens = getattr(usage, "completion_tokens", None)
+    return {
+        "prompt_tokens": prompt_tokens or 0,
+        "completion_tokens": completion_tokens or 0,
+        "cached_tokens": cached_tokens or 0,
+    }
+
+def record_request(stage, item_id, model=None, response=None, timing=None, status="ok", **extra):
+    """
+    API呼び出し1回分のメトリクスを記録する
+
+    timingはRequestScheduler.call()に渡したdict (queue_wait, latency, retries)
+    statusは ok / error / parse_failure
+    """
+    recorder = get_recorder()
+    if not recorder.enabled:
+        return
+    recorder.record(
+        stage=stage,
+        id=item_id,
+        model=model,
+        cache="miss",
+        status=status,
+        **(timing or {}),
+        **usage_fields(getattr(response, "usage", None)),
+        **extra,
+    )
+
+def record_cache_hit(stage, item_id):
+    get_recorder().record(stage=stage, id=item_id, cache="hit", status="ok")
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def estimate_cost(event, prices=None):
+    """1リクエストの推定料金 (USD)"""
+    price = prices or PRICES.get(event.get("model"))
+    if not price:
+        return 0.0
+    input_price, output_price, cached_price = price
+    cached = event.get("cached_tokens", 0)
+    cost = ((event.get("prompt_tokens", 0) - cached) * input_price
+            + cached * cached_price
+            + event.get("completion_tokens", 0) * output_price) / 1_000_000
+    return cost * BATCH_DISCOUNT if event.get("batch") else cost
+
+def summarize(events, prices=None):
+    """ステージごとの集計"""
+    stages = {}
+    for event in events:
+        stages.setdefault(event["stage"], []).append(event)
+
+    summary = {}
+    for stage, stage_events in stages.items():
+        requests = [e for e in stage_events if e.get("cache") == "miss"]
+        latencies = [e["latency"] for e in requests if e.get("latency") is not None]
+        waits = [e["queue_wait"] for e in requests if e.get("queue_wait") is not None]
+        timestamps = [e["ts"] for e in requests]
+        duration = max(timestamps) - min(timestamps) if len(timestamps) > 1 else 0.0
+        # gen_queryの--stream-queries: 打ち切った応答と最後まで生成された応答の出力トークン数の差を節約量とする
+        streamed = [e for e in requests if e.get("stream")]
+        stopped = [e for e in streamed if e.get("stream_stop")]
+        full = [e["completion_tokens"] for e in requests
+                if e.get("status") == "ok" and not e.get("stream_stop") and e.get("completion_tokens")]
+        ttfqs = [e["ttfq"] for e in streamed if e.get("ttfq") is not None]
+        summary[stage] = {
+            "events": len(stage_events),
+            "cache_hits": len(stage_events) - len(requests),
+            "cache_hit_rate": (len(stage_events) - len(requests)) / len(stage_events),
+            "requests": len(requests),
+            "errors": sum(1 for e in requests if e.get("status") == "error"),
+            "parse_failures": sum(1 for e in requests if e.get("status") == "parse_failure"),
+            "retries": sum(e.get("retries", 0) for e in requests),
+            "latency_p50": percentile(latencies, 0.5),
+            "latency_p95": percentile(latencies, 0.95),
+            "latency_p99": percentile(latencies, 0.99),
+            "latency_sum": sum(latencies),
+            "latency_count": len(latencies),
+            "queue_wait_p50": percentile(waits, 0.5),
+            "queue_wait_p95": percentile(waits, 0.95),
+            "throughput": len(requests) / duration if duration else 0.0,
+            "prompt_tokens": sum(e.get("prompt_tokens", 0) for e in requests),
+            "completion_tokens": sum(e.get("completion_tokens", 0) for e in requests),
+            "cached_tokens": sum(e.get("cached_tokens", 0) for e in requests),
+            "cost": sum(estimate_cost(e, prices) for e in requests),
+            "streamed": len(streamed),
+            "ttfq_p50": percentile(ttfqs, 0.5),
+            "ttfq_p95": percentile(ttfqs, 0.95),
+            "stream_stops_target": sum(1 for e in stopped if e["stream_stop"] == "target"),
+            "stream_stops_format": sum(1 for e in stopped if e["stream_stop"] == "format"),
+            # 最後まで生成された応答が無い場合は推定できない (None)
+            "tokens_saved": sum(max(0.0, sum(full) / len(full) - e.get("completion_tokens", 0)) for e in stopped)
+                            if full else None,
+        }
+    return summary
+
+def print_summary(summary):
+    for stage, s in summary.items():
+        print(f"=== {stage} ===")
+        print(f"リクエスト: {s['requests']}件  キャッシュヒット: {s['cache_hits']}件 ({s['cache_hit_rate']*100:.1f}%)  "
+              f"エラー: {s['errors']}件  解析失敗: {s['parse_failures']}件  再試行: {s['retries']}回")
+        print(f"APIレイテンシ: p50 {s['latency_p50']:.2f}秒  p95 {s['latency_p95']:.2f}秒  p99 {s['latency_p99']:.2f}秒")
+        print(f"待ち時間 (流量制限・再試行): p50 {s['queue_wait_p50']:.2f}秒  p95 {s['queue_wait_p95']:.2f}秒")
+        print(f"スループット: {s['throughput']:.2f}リクエスト/秒")
+        print(f"トークン: 入力 {s['prompt_tokens']} (キャッシュ済み {s['cached_tokens']})  出力 {s['completion_tokens']}")
+        print(f"推定料金: ${s['cost']:.4f}")
+        if s["streamed"]:
+            saved = "推定できません" if s["tokens_saved"] is None else f"{s['tokens_saved']:.0f}"
+            print(f"ストリーミング: {s['streamed']}件  最初のクエリまで p50 {s['ttfq_p50']:.2f}秒  "
+                  f"p95 {s['ttfq_p95']:.2f}秒  打ち切り: 目標数 {s['stream_stops_target']}件 / "
+                  f"形式外れ {s['stream_stops_format']}件  節約した出力トークン数 (推定): {saved}")
+
+def to_prometheus(summary):
+    """Prometheusのテキスト形式に変換する"""
+    lines = [
+        "# HELP kirara_request_latency_seconds API latency per request",
+        "# TYPE kirara_request_latency_seconds summary",
+    ]
+    for stage, s in summary.items():
+        for quantile, key in (("0.5", "latency_p50"), ("0.95", "latency_p95"), ("0.99", "latency_p99")):
+            lines.append(f'kirara_request_latency_seconds{{stage="{stage}",quantile="{quantile}"}} {s[key]}')
+        lines.append(f'kirara_request_latency_seconds_sum{{stage="{stage}"}} {s["latency_sum"]}')
+        lines.append(f'kirara_request_latency_seconds_count{{stage="{stage}"}} {s["latency_count"]}')
+    counters = [
+        ("kirara_requests_total", "API requests", lambda s: [({}, s["requests"])]),
+        ("kirara_cache_hits_total", "Cache hits", lambda s: [({}, s["cache_hits"])]),
+        ("kirara_errors_total", "Failed requests", lambda s: [({"kind": "error"}, s["errors"]),
+                                                              ({"kind": "parse_failure"}, s["parse_failures"])]),
+        ("kirara_retries_total", "Retried attempts", lambda s: [({}, s["retries"])]),
+        ("kirara_tokens_total", "Tokens", lambda s: [({"kind": "prompt"}, s["prompt_tokens"]),
+                                                     ({"kind": "cached"}, s["cached_tokens"]),
+                                                     ({"kind": "completion"}, s["completion_tokens"])]),
+        ("kirara_estimated_cost_usd_total", "Estimated cost in USD", lambda s: [({}, s["cost"])]),
+        ("kirara_stream_stops_total", "Streamed completions cancelled early",
+         lambda s: [({"reason": "target"}, s["stream_stops_target"]), ({"reason": "format"}, s["stream_stops_format"])]),
+    ]
+    for name, help_text, values in counters:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for stage, s in summary.items():
+            for labels, value in values(s):
+                label_text = ",".join(f'{k}="{v}"' for k, v in {"stage": stage, **labels}.items())
+                lines.append(f"{name}{{{label_text}}} {value}")
+    return "\n".join(lines) + "\n"
+
+def load_events(filename):
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='リクエストごとのメトリクス (METRICS_FILE) を集計する')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    summary_parser = subparsers.add_parser('summary', help='ステージごとのレイテンシ・スループット・推定料金を表示する')
+    summary_parser.add_argument('input', type=str, nargs='?', default='metrics.jsonl')
+    summary_parser.add_argument('--prometheus', type=str, default=None, help='Prometheusのテキスト形式の出力先')
+    summary_parser.add_argument('--json', type=str, default=None, help='集計結果の出力先 (JSON)')
+    summary_parser.add_argument('--price', type=float, nargs=3, default=None,
+                                metavar=('INPUT', 'OUTPUT', 'CACHED'),
+                                help='1Mトークンあたりの料金 (USD、未指定ならモデル名から決める)')
+    args = parser.parse_args()
+
+    summary = summarize(load_events(args.input), args.price)
+    print_summary(summary)
+    if args.prometheus:
+        with open(args.prometheus, 'w', encoding='utf-8') as f:
+            f.write(to_prometheus(summary))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+APIを呼ばずに実行前の見積もりを出す (各ステージの plan サブコマンド)
+
+- 完了済み (--resumeの進捗ジャーナル) とキャッシュ済みのアイテムを除いた未処理のリクエスト数
+  (キャッシュはまとめて問い合わせ、1件ずつ開かない)
+- 未処理のプロンプトの入力トークン数 (tiktokenがあれば複数スレッドで数え、同じ本文は1度だけ数える)
+- 出力トークン数・料金・所要時間の推定 (METRICS_FILEに過去の実績があればその平均を使う)
+
+openaiなどの重いパッケージは読み込まない
+"""
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from kirara_common.metrics import PRICES, BATCH_DISCOUNT, estimate_cost, load_events
+
+ENCODING_NAME = "o200k_base"
+# 1回のタスクで数えるテキストの数 (スレッドへの受け渡しの回数を減らす)
+COUNT_BATCH = 64
+# METRICS_FILEに実績が無い場合の1件あたりの出力トークン数と1リクエストあたりのレイテンシ (秒)
+DEFAULT_OUTPUT_TOKENS = {"gen_query": 500, "gen_answer": 600}
+DEFAULT_LATENCY = {"gen_query": 15.0, "gen_answer": 15.0}
+_warned = False
+
+def tokenizer_name():
+    try:
+        import tiktoken  # 任意
+    except ImportError:
+        return "chars"
+    return ENCODING_NAME
+
+def count_tokens_many(texts, workers=None):
+    """
+    テキストごとのトークン数を {テキスト: トークン数} で返す (同じテキストは1度だけ数える)
+
+    tiktokenがあれば複数スレッドで数える (エンコード中はGILを解放するため並列に動く)
+    無ければ1文字1トークンで概算する (chunking.count_tokens / scheduler.estimate_tokensと同じ)
+    """
+    global _warned
+    unique = list(dict.fromkeys(texts))
+    try:
+        import tiktoken  # 任意
+    except ImportError:
+        if not _warned:
+            _warned = True
+            print("警告: tiktokenがインストールされていないため、入力トークン数を1文字1トークンで概算します")
+        return {text: len(text) for text in unique}
+    encoding = tiktoken.get_encoding(ENCODING_NAME)
+
+    def count_batch(batch):
+        return [len(encoding.encode_ordinary(text)) for text in batch]
+
+    batches = [unique[i:i + COUNT_BATCH] for i in range(0, len(unique), COUNT_BATCH)]
+    counts = {}
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for batch, batch_counts in zip(batches, executor.map(count_batch, batches)):
+            counts.update(zip(batch, batch_counts))
+    return counts
+
+def iter_journal(filename):
+    """
+    進捗ジャーナル (JSONL) のレコードを読み取り専用で返す
+    異常終了で途中まで書かれた最後の行は読まない (ファイルは変更しない)
+    """
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'rb') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                return
+
+def load_history(stage, metrics_file=None):
+    """
+    METRICS_FILEに記録された過去のリクエストから、1リクエストあたりの出力トークン数とレイテンシの平均を返す
+    実績が無ければNone
+    """
+    metrics_file = metrics_file or os.environ.get("METRICS_FILE")
+    if not metrics_file or not os.path.exists(metrics_file):
+        return None
+    completions = []
+    latencies = []
+    for event in load_events(metrics_file):
+        if event.get("stage") != stage or event.get("cache") != "miss" or event.get("status") != "ok":
+            continue
+        # ストリーミングで打ち切った応答は最後まで生成した場合より短いため使わない
+        if event.get("stream_stop"):
+            continue
+        if event.get("completion_tokens"):
+            completions.append(event["completion_tokens"])
+        if event.get("latency") is not None:
+            latencies.append(event["latency"])
+    if not completions or not latencies:
+        return None
+    return {
+        "requests": len(completions),
+        "output_tokens": sum(completions) / len(completions),
+        "latency": sum(latencies) / len(latencies),
+    }
+
+def pop_plan_options(args):
+    """
+    planの見積もりの設定を引数のリストから取り出す (main.py / jimba.pyの引数解析用)
+    --output-tokens N: 1件あたりの出力トークン数
+    --latency 秒: 1リクエストあたりのレイテンシ
+    """
+    options = {}
+    for flag, key, convert in (("--output-tokens", "output_tokens", int), ("--latency", "latency", float)):
+        if flag in args:
+            i = args.index(flag)
+            options[key] = convert(args[i + 1])
+            del args[i:i + 2]
+    return options
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds}秒"
+    if seconds < 3600:
+        return f"{seconds // 60}分{seconds % 60}秒"
+    return f"{seconds // 3600}時間{seconds % 3600 // 60}分"
+
+class WorkPlan:
+    """
+    1つのステージの見積もり
+
+    アイテムを完了済み・キャッシュ済み・未処理に分け、未処理のリクエストのプロンプトを
+    (共通部分のトークン数, 可変部分のテキストのタプル) で受け取って入力トークン数を数える
+    """
+
+    def __init__(self, stage, model=None):
+        self.stage = stage
+        self.model = model
+        # アイテム数 (チャンク分割などの後に決まるため、呼び出し元で設定する)
+        self.total = 0
+        self.started = time.perf_counter()
+        # (説明, 件数): 完了済み・キャッシュ済みなど、リクエストを送らないアイテム
+        self.skipped = []
+        self.pending_items = 0
+        self.requests = 0
+        self.prompt_tokens = 0
+        # プレフィックスキャッシュで割引される見込みの入力トークン数 (--group-by-knowledge)
+        self.cached_tokens = 0
+        self.notes = []
+
+    def skip(self, label, count):
+        self.skipped.append((label, count))
+
+    def count_prompts(self, overhead_tokens, parts, workers=None, known_tokens=None):
+        """
+        未処理のリクエストの入力トークン数を数える
+
+        overhead_tokens: プロンプトのテンプレート部分のトークン数 (リクエストごとに同じ)
+        parts: リクエストごとの可変部分 (knowledgeやクエリの本文) のタプルのリスト
+        known_tokens: 数え済みのトークン数 {テキスト: トークン数} (.kcorpusの保存済みのトークン数など)
+        戻り値は {テキスト: トークン数}
+        """
+        known_tokens = known_tokens or {}
+        counts = count_tokens_many((text for texts in parts for text in texts if text not in known_tokens), workers)
+        counts.update(known_tokens)
+        self.requests += len(parts)
+        self.prompt_tokens += sum(overhead_tokens + sum(counts[text] for text in texts) for texts in parts)
+        return counts
+
+    def report(self, concurrency=1, output_tokens=None, latency=None, batch=False):
+        """見積もりを表示する (output_tokens / latencyを省略するとMETRICS_FILEの実績、無ければ既定値を使う)"""
+        history = load_history(self.stage)
+        source = (f"METRICS_FILEの実績 {history['requests']}件の平均" if history else "既定値")
+        output_source = latency_source = "指定値"
+        if output_tokens is None:
+            output_tokens = history["output_tokens"] if history else DEFAULT_OUTPUT_TOKENS[self.stage]
+            output_source = source
+        if latency is None:
+            latency = history["latency"] if history else DEFAULT_LATENCY[self.stage]
+            latency_source = source
+        # --multi-question では1リクエストで複数の回答を生成するため、出力はアイテム数で見積もる
+        completion_tokens = self.pending_items * output_tokens
+
+        print(f"=== 見積もり ({self.stage}) ===")
+        skipped = "  ".join(f"{label}: {count}件" for label, count in self.skipped)
+        print(f"アイテム: {self.total}件  {skipped}  未処理: {self.pending_items}件 ({self.requests}リクエスト)")
+        print(f"入力トークン: {self.prompt_tokens:,} ({'1文字1トークンで概算' if tokenizer_name() == 'chars' else ENCODING_NAME})"
+              + (f"  うちプレフィックスキャッシュの対象 (最大): {self.cached_tokens:,}" if self.cached_tokens else ""))
+        print(f"出力トークン (推定): {completion_tokens:,.0f} (1件あたり{output_tokens:.0f}、{output_source})")
+
+        price = PRICES.get(self.model)
+        if price:
+            cost = estimate_cost({"model": self.model, "prompt_tokens": self.prompt_tokens,
+                                  "cached_tokens": self.cached_tokens, "completion_tokens": completion_tokens,
+                                  "batch": batch})
+            print(f"推定料金 ({self.model}{'、Batch API' if batch else ''}): ${cost:.4f}")
+        else:
+            print(f"推定料金: モデル '{self.model}' の料金が分からないため表示しません (kirara_common.metricsのPRICES)")
+
+        if batch:
+            print(f"推定時間: Batch APIのため見積もりません (通常の{BATCH_DISCOUNT:.0%}の料金で、24時間以内に完了します)")
+        elif self.requests:
+            concurrency = max(1, min(concurrency, int(os.environ.get("OPENAI_MAX_CONCURRENCY") or concurrency)))
+            seconds = self.requests * latency / concurrency
+            limits = [f"並列{concurrency} x レイテンシ{latency:.1f}秒 ({latency_source})"]
+            # 流量制限 (kirara_common.schedulerと同じ環境変数) があれば、それより速くは終わらない
+            rpm = os.environ.get("OPENAI_RPM")
+            tpm = os.environ.get("OPENAI_TPM")
+            if rpm and self.requests / int(rpm) * 60 > seconds:
+                seconds = self.requests / int(rpm) * 60
+                limits.append(f"OPENAI_RPM={rpm}で制限")
+            if tpm and self.prompt_tokens / int(tpm) * 60 > seconds:
+                seconds = self.prompt_tokens / int(tpm) * 60
+                limits.append(f"OPENAI_TPM={tpm}で制限")
+            print(f"推定時間: {format_duration(seconds)} ({', '.join(limits)})")
+        for note in self.notes:
+            print(note)
+        print(f"見積もりにかかった時間: {time.perf_counter() - self.started:.2f}秒 (APIは呼んでいません)")
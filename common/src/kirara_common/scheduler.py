@@ -0,0 +1,282 @@
+import asyncio
+import email.utils
+import os
+import random
+import threading
+import time
+
+def estimate_tokens(text):
+    """トークン数の概算 (日本語はおおよそ1文字1トークン)"""
+    return len(text)
+
+class TokenBucket:
+    """
+    1分あたりの上限を持つトークンバケット
+    予約した分だけ残量を減らし (負になってもよい)、残量が回復するまでの待ち時間を返す
+    """
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.available = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+            self.updated = now
+            self.available -= min(amount, self.capacity)
+            if self.available >= 0:
+                return 0.0
+            return -self.available / self.rate
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD方式で同時実行数を調整するリミッター
+    initialから始め、最初に429を受けるまでは成功ごとに上限を1ずつ増やす (スロースタート)
+    429を受けたら上限を半分にし、その後は上限1つ分の成功ごとにおよそ1ずつ増やす
+    上限はmaximumを超えない
+    """
+
+    def __init__(self, initial, minimum=1, maximum=None):
+        self.minimum = minimum
+        self.maximum = maximum or initial
+        self.limit = float(min(initial, self.maximum))
+        self.slow_start = True
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        # acquire_async()で待っている (イベントループ, Future)
+        # 別のスレッドのrelease()からも起こせるように、ループ経由でFutureを完了させる
+        self._async_waiters = []
+
+    def try_acquire(self):
+        with self.condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self.condition:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+                raise
+
+    def _notify(self):
+        """空きを待っているスレッドとコルーチンを起こす (self.conditionを取得した状態で呼ぶ)"""
+        self.condition.notify_all()
+        for loop, waiter in self._async_waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+        self._async_waiters.clear()
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self._notify()
+
+    def on_success(self):
+        with self.condition:
+            if self.slow_start:
+                self.limit = min(self.maximum, self.limit + 1.0)
+            else:
+                # 上限1つ分の成功でおよそ+1
+                self.limit = min(self.maximum, self.limit + 1.0 / max(self.limit, 1.0))
+            self._notify()
+
+    def on_throttle(self):
+        with self.condition:
+            self.slow_start = False
+            self.limit = max(self.minimum, self.limit / 2)
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+def is_rate_limit_error(e):
+    # openaiの読み込みは重いため、使うときに読み込む (plan サブコマンドはAPIを呼ばない)
+    import openai
+    return isinstance(e, openai.RateLimitError) or getattr(e, 'status_code', None) == 429
+
+def is_retryable_error(e):
+    import openai
+    if isinstance(e, openai.APIConnectionError):
+        return True
+    status_code = getattr(e, 'status_code', None)
+    return status_code in (408, 409, 429) or (status_code is not None and status_code >= 500)
+
+def get_retry_after(e):
+    """例外のレスポンスヘッダーからRetry-After (秒) を取り出す"""
+    response = getattr(e, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    # HTTP-date形式
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def _set_timing(timing, started, request_start, attempt):
+    if timing is not None:
+        timing["queue_wait"] = request_start - started
+        timing["latency"] = time.perf_counter() - request_start
+        timing["retries"] = attempt
+
+class RequestScheduler:
+    """
+    APIリクエストのスケジューラー
+
+    - リクエスト数/分・トークン数/分のトークンバケットによる流量制限
+    - 指数バックオフ (ジッター付き) とRetry-Afterに従った再試行
+    - AIMD方式による同時実行数の自動調整
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_retries=6,
+                 base_delay=1.0, max_delay=60.0, max_concurrency=64, initial_concurrency=None):
+        """
+        max_concurrency: 同時実行数の上限 (AIMDで増やすときの天井)
+        initial_concurrency: 同時実行数の初期値 (省略時は上限の1/4)
+        """
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limiter = AdaptiveConcurrencyLimiter(initial_concurrency or max(1, max_concurrency // 4),
+                                                  maximum=max_concurrency)
+
+    @classmethod
+    def from_env(cls):
+        """
+        環境変数 (OPENAI_RPM, OPENAI_TPM, OPENAI_MAX_RETRIES, OPENAI_MAX_CONCURRENCY,
+        OPENAI_INITIAL_CONCURRENCY) から生成する
+        """
+        def env_int(name, default=None):
+            value = os.environ.get(name)
+            return int(value) if value else default
+        return cls(
+            requests_per_minute=env_int("OPENAI_RPM"),
+            tokens_per_minute=env_int("OPENAI_TPM"),
+            max_retries=env_int("OPENAI_MAX_RETRIES", 6),
+            max_concurrency=env_int("OPENAI_MAX_CONCURRENCY", 64),
+            initial_concurrency=env_int("OPENAI_INITIAL_CONCURRENCY"),
+        )
+
+    def _capacity_delay(self, estimated_tokens):
+        delay = 0.0
+        if self.request_bucket:
+            delay = max(delay, self.request_bucket.reserve(1))
+        if self.token_bucket and estimated_tokens:
+            delay = max(delay, self.token_bucket.reserve(estimated_tokens))
+        return delay
+
+    def _retry_delay(self, e, attempt):
+        retry_after = get_retry_after(e)
+        if retry_after is not None:
+            return retry_after
+        # フルジッター付き指数バックオフ
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _on_error(self, e, attempt):
+        """再試行する場合は待ち時間を、しない場合はNoneを返す"""
+        if is_rate_limit_error(e):
+            self.limiter.on_throttle()
+        if not is_retryable_error(e) or attempt >= self.max_retries:
+            return None
+        return self._retry_delay(e, attempt)
+
+    def call(self, func, estimated_tokens=0, timing=None):
+        """
+        funcを流量制限・再試行付きで呼び出す (最後まで失敗した場合は例外を送出)
+
+        timingにdictを渡すと、最後の試行を始めるまでの待ち時間 (流量制限・失敗した試行・バックオフを含む)、
+        最後の試行のレイテンシ、再試行の回数を書き込む
+        """
+        attempt = 0
+        started = time.perf_counter()
+        while True:
+            delay = self._capacity_delay(estimated_tokens)
+            if delay > 0:
+                time.sleep(delay)
+            self.limiter.acquire()
+            request_start = time.perf_counter()
+            try:
+                # 取り消し (CancelledError) やKeyboardInterruptでも枠は必ず返す
+                try:
+                    result = func()
+                finally:
+                    self.limiter.release()
+            except Exception as e:
+                retry_delay = self._on_error(e, attempt)
+                if retry_delay is None:
+                    _set_timing(timing, started, request_start, attempt)
+                    raise
+                print(f"再試行します ({attempt+1}/{self.max_retries}, {retry_delay:.1f}秒後): {e}")
+                time.sleep(retry_delay)
+                attempt += 1
+                continue
+            self.limiter.on_success()
+            _set_timing(timing, started, request_start, attempt)
+            return result
+
+    async def acall(self, func, estimated_tokens=0, timing=None):
+        """call()の非同期版 (funcはコルーチンを返す関数)"""
+        attempt = 0
+        started = time.perf_counter()
+        while True:
+            delay = self._capacity_delay(estimated_tokens)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.limiter.acquire_async()
+            request_start = time.perf_counter()
+            try:
+                # 取り消し (CancelledError) やKeyboardInterruptでも枠は必ず返す
+                try:
+                    result = await func()
+                finally:
+                    self.limiter.release()
+            except Exception as e:
+                retry_delay = self._on_error(e, attempt)
+                if retry_delay is None:
+                    _set_timing(timing, started, request_start, attempt)
+                    raise
+                print(f"再試行します ({attempt+1}/{self.max_retries}, {retry_delay:.1f}秒後): {e}")
+                await asyncio.sleep(retry_delay)
+                attempt += 1
+                continue
+            self.limiter.on_success()
+            _set_timing(timing, started, request_start, attempt)
+            return result
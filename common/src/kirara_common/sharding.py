@@ -0,0 +1,89 @@
+"""
+複数のマシンで1つの実行を分担するためのシャード分割 (--shard i/N、iは0からN-1)
+
+アイテムは内容から決まるキーでシャードに割り当てる
+- 記事・クエリ・回答: knowledgeの内容ハッシュ (sha256、compact形式のknowledge_idと同じ値)
+  同じknowledgeのクエリは同じシャードに入るため、プレフィックスキャッシュも効く
+- wiki.py --stream: parquetファイルのパス
+キーのsha256でシャードを決めるため (Pythonのhash()と違い実行ごとに変わらない)、
+再実行しても同じアイテムは同じシャードに入る
+
+シャードごとの出力はリポジトリ直下のmerge_shards.pyで入力順に結合する
+"""
+import hashlib
+import re
+from collections.abc import Sequence
+from pathlib import Path
+
+def content_key(text):
+    """本文の内容ハッシュ (knowledge_idと同じ値)"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def record_key(record, field="text"):
+    """レコードのシャードキー (compact形式ならknowledge_id、それ以外はfieldの本文の内容ハッシュ)"""
+    return record.get("knowledge_id") or content_key(record[field])
+
+def shard_of(key, count):
+    """キーが入るシャードの番号"""
+    digest = hashlib.sha256(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+def shard_filename(filename, index, count):
+    """シャードごとの出力ファイル名 (generated_queries.json -> generated_queries.shard0-of-4.json)"""
+    path = Path(filename)
+    return str(path.with_name(f"{path.stem}.shard{index}-of-{count}{path.suffix}"))
+
+def sources_filename(filename):
+    """wiki.py --stream --shard で処理したparquetファイルと記事数を記録するファイル"""
+    return f"{filename}.sources.json"
+
+class Shard:
+    """--shard i/N で指定したシャード (keyがこのシャードに入るかを key in shard で判定する)"""
+
+    def __init__(self, index, count):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"シャードの指定が不正です: {index}/{count} (iは0からN-1)")
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def parse(cls, value):
+        match = re.fullmatch(r'(\d+)/(\d+)', value.strip())
+        if not match:
+            raise ValueError(f"シャードは i/N の形式で指定してください: {value}")
+        return cls(int(match.group(1)), int(match.group(2)))
+
+    def __contains__(self, key):
+        return shard_of(key, self.count) == self.index
+
+    def filename(self, filename):
+        return shard_filename(filename, self.index, self.count)
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+class ShardView(Sequence):
+    """元のデータのうち、indicesのアイテムだけを元の順で見せる"""
+
+    def __init__(self, data, indices):
+        self.data = data
+        self.indices = indices
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.data[i] for i in self.indices[index]]
+        return self.data[self.indices[index]]
+
+    def __len__(self):
+        return len(self.indices)
+
+def select_shard(data, shard):
+    """
+    記事のリスト (または.kcorpusのCorpusStore) のうちshardに入る記事のShardViewを返す
+    CorpusStoreでは保存済みの内容ハッシュを使い、本文を読まない
+    """
+    if hasattr(data, "content_hash"):
+        keys = (data.content_hash(i) for i in range(len(data)))
+    else:
+        keys = (record_key(item) for item in data)
+    return ShardView(data, [i for i, key in enumerate(keys) if key in shard])
@@ -0,0 +1,211 @@
+import argparse
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import unicodedata
+
+def normalize(text):
+    """全角・半角の違い (NFKC) と空白の違いを吸収する"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+def content_key(model, system_prompt, query):
+    """(モデル, システムプロンプト (knowledgeを含む), クエリ) のハッシュ"""
+    return hashlib.sha256(json.dumps([model, system_prompt, query], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def prefix_hasher(model, system_prompt):
+    """
+    content_key()の (モデル, システムプロンプト) までをハッシュしたもの
+    同じシステムプロンプトの多数のクエリのキーを求めるときは、これをcopy()してクエリの部分だけを足す
+    """
+    prefix = json.dumps([model, system_prompt], ensure_ascii=False)[:-1] + ", "
+    return hashlib.sha256(prefix.encode("utf-8"))
+
+def content_key_from(hasher, query):
+    """prefix_hasher()からcontent_key()と同じ値を求める"""
+    hasher = hasher.copy()
+    hasher.update((json.dumps(query, ensure_ascii=False) + "]").encode("utf-8"))
+    return hasher.hexdigest()
+
+class AnswerCache:
+    """
+    内容から決まるキーで回答本文をキャッシュする (SQLite、WALモード)
+
+    クエリのIDが違っても、同じモデル・システムプロンプト・クエリなら同じ回答を使い回す
+    normalize=Trueでは正規化したテキストのキーも別名として登録し、空白や全角・半角だけが違う
+    クエリにもヒットさせる
+    エントリ数・合計サイズが上限を超えると、最後に使われたのが古いものから削除する (LRU)
+    (上限の確認は開いたときとEVICT_INTERVAL回の書き込みごとに行い、上限の90%まで減らす)
+    """
+
+    EVICT_INTERVAL = 100
+    LOW_WATERMARK = 0.9
+    # まとめて問い合わせるときに1回で渡すキーの数 (SQLiteのバインド変数の上限を超えないように分割する)
+    BATCH_SIZE = 500
+
+    def __init__(self, path, normalize=False, max_entries=None, max_bytes=None):
+        self.path = str(path)
+        self.normalize = normalize
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.normalized_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._puts = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "key TEXT PRIMARY KEY, answer TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS answers_last_access ON answers (last_access)")
+        conn.execute("CREATE TABLE IF NOT EXISTS aliases (alias TEXT PRIMARY KEY, key TEXT NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS aliases_key ON aliases (key)")
+        conn.commit()
+        # 前回の実行で上限を超えた分を開いたときに削る
+        if max_entries or max_bytes:
+            self.evict(self.LOW_WATERMARK)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _keys(self, model, system_prompt, query):
+        key = content_key(model, system_prompt, query)
+        alias = content_key(model, normalize(system_prompt), normalize(query)) if self.normalize else None
+        return key, alias
+
+    def get(self, model, system_prompt, query):
+        """キャッシュ済みの回答本文 (無ければNone)"""
+        key, alias = self._keys(model, system_prompt, query)
+        conn = self._conn()
+        row = conn.execute("SELECT key, answer FROM answers WHERE key = ?", (key,)).fetchone()
+        normalized = False
+        if row is None and alias:
+            row = conn.execute(
+                "SELECT answers.key, answers.answer FROM aliases JOIN answers ON aliases.key = answers.key "
+                "WHERE aliases.alias = ?", (alias,)
+            ).fetchone()
+            normalized = row is not None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            elif normalized:
+                self.normalized_hits += 1
+            else:
+                self.hits += 1
+        if row is None:
+            return None
+        with conn:
+            conn.execute("UPDATE answers SET last_access = ? WHERE key = ?", (time.time(), row[0]))
+        return row[1]
+
+    def existing(self, model, requests):
+        """
+        (システムプロンプト, クエリ) のリストのうち、回答がキャッシュ済みのもののインデックスを返す
+        まとめて問い合わせる (ヒット数と最後に使った時刻は更新しない)
+        """
+        # 同じシステムプロンプト (knowledge) の共通部分は1度だけハッシュする
+        prefixes = {}
+        keys = []
+        for system_prompt, query in requests:
+            if system_prompt not in prefixes:
+                prefixes[system_prompt] = (prefix_hasher(model, system_prompt),
+                                           prefix_hasher(model, normalize(system_prompt)) if self.normalize else None)
+            hasher, normalized_hasher = prefixes[system_prompt]
+            keys.append((content_key_from(hasher, query),
+                         content_key_from(normalized_hasher, normalize(query)) if normalized_hasher else None))
+        found = self._select_existing("SELECT key FROM answers WHERE key IN ({})", [key for key, _ in keys])
+        aliases = set()
+        if self.normalize:
+            aliases = self._select_existing(
+                "SELECT aliases.alias FROM aliases JOIN answers ON aliases.key = answers.key "
+                "WHERE aliases.alias IN ({})", [alias for _, alias in keys])
+        return {index for index, (key, alias) in enumerate(keys) if key in found or alias in aliases}
+
+    def _select_existing(self, sql, values):
+        conn = self._conn()
+        found = set()
+        for i in range(0, len(values), self.BATCH_SIZE):
+            batch = values[i:i + self.BATCH_SIZE]
+            found.update(row[0] for row in conn.execute(sql.format(",".join("?" * len(batch))), batch))
+        return found
+
+    def put(self, model, system_prompt, query, answer):
+        key, alias = self._keys(model, system_prompt, query)
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO answers (key, answer, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, answer, len(answer.encode("utf-8")), time.time()),
+            )
+            if alias:
+                conn.execute("INSERT OR REPLACE INTO aliases (alias, key) VALUES (?, ?)", (alias, key))
+        if self.max_entries or self.max_bytes:
+            with self._lock:
+                self._puts += 1
+                check = self._puts % self.EVICT_INTERVAL == 0
+            if check:
+                self.evict(self.LOW_WATERMARK)
+
+    def evict(self, watermark=1.0):
+        """上限 (のwatermark倍) を超えた分を、最後に使われたのが古いエントリから削除する"""
+        max_entries = int(self.max_entries * watermark) if self.max_entries else None
+        max_bytes = int(self.max_bytes * watermark) if self.max_bytes else None
+        conn = self._conn()
+        with conn:
+            count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM answers").fetchone()
+            if (not self.max_entries or count <= self.max_entries) and (not self.max_bytes or total <= self.max_bytes):
+                return 0
+            removed = 0
+            cursor = conn.execute("SELECT key, size FROM answers ORDER BY last_access")
+            victims = []
+            for key, size in cursor:
+                if (not max_entries or count <= max_entries) and (not max_bytes or total <= max_bytes):
+                    break
+                victims.append((key,))
+                count -= 1
+                total -= size
+                removed += 1
+            if victims:
+                conn.executemany("DELETE FROM answers WHERE key = ?", victims)
+                conn.executemany("DELETE FROM aliases WHERE key = ?", victims)
+        with self._lock:
+            self.evictions += removed
+        return removed
+
+    def size(self):
+        return self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM answers").fetchone()
+
+    def report(self):
+        lookups = self.hits + self.normalized_hits + self.misses
+        if not lookups:
+            return
+        rate = (self.hits + self.normalized_hits) / lookups
+        print(f"回答キャッシュ: ヒット {self.hits}件 + 正規化ヒット {self.normalized_hits}件 / {lookups}件 "
+              f"({rate*100:.1f}%)  削除 {self.evictions}件")
+
+def main():
+    parser = argparse.ArgumentParser(description='内容ベースの回答キャッシュの状態を表示・削減する')
+    parser.add_argument('path', type=str, nargs='?', default='answer_cache.sqlite3')
+    parser.add_argument('--max-entries', type=int, default=None, help='エントリ数の上限まで削減する')
+    parser.add_argument('--max-mb', type=float, default=None, help='回答の合計サイズ (MB) の上限まで削減する')
+    args = parser.parse_args()
+
+    cache = AnswerCache(args.path, max_entries=args.max_entries,
+                        max_bytes=int(args.max_mb * 1024 * 1024) if args.max_mb else None)
+    if args.max_entries or args.max_mb:
+        print(f"{cache.evict()}件を削除しました")
+    count, total = cache.size()
+    print(f"エントリ数: {count}  合計サイズ: {total / 1024 / 1024:.2f}MB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import time
+from kirara_common.scheduler import estimate_tokens
+from kirara_common.metrics import record_request
+
+def build_system_prompt(knowledge):
+    """knowledgeを埋め込んだシステムプロンプト (同じknowledgeなら常にバイト単位で同一)"""
+    return f"""あなたは親切なAIアシスタントです。一般常識のほかに、以下の知識を考慮して、質問に答えてください。
+
+<knowledge>
+{knowledge}
+</knowledge>
+
+# 注意点
+- あなたはインターネットにアクセスできないため、最新の状況を取得することはできません。
+- たまにあなたの知らないことを聞かれることがあります。知らない場合は知らないということを述べ、そのうえで回答を行ってください。
+    """
+
+def has_content(response):
+    return bool(response.choices and response.choices[0].message.content)
+
+def request_answer(client, use_model, system_prompt, prompt, scheduler=None, item_id=None, validate=has_content):
+    """
+    チャット補完APIを呼び出し、レスポンスをそのまま返す
+    METRICS_FILEを設定している場合は、validate(response)が偽なら解析失敗としてメトリクスを記録する
+    """
+    def request():
+        return client.chat.completions.create(
+            model=use_model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt}
+            ]
+        )
+
+    timing = {}
+    start = time.perf_counter()
+    try:
+        # 429やタイムアウトはスケジューラーがバックオフして再試行する
+        if scheduler:
+            response = scheduler.call(request, estimated_tokens=estimate_tokens(system_prompt + prompt), timing=timing)
+        else:
+            response = request()
+            timing = {"queue_wait": 0.0, "latency": time.perf_counter() - start, "retries": 0}
+    except Exception:
+        record_request("gen_answer", item_id, use_model, timing=timing, status="error")
+        raise
+    record_request("gen_answer", item_id, use_model, response, timing,
+                   status="ok" if validate(response) else "parse_failure")
+    return response
+
+def make_answer_record(query_data, answer, knowledge):
+    result = {
+        "id": query_data["id"],
+        "query": query_data["query"],
+        "answer": answer,
+    }
+    if "chunk_id" in query_data:
+        result["chunk_id"] = query_data["chunk_id"]
+    # compact形式の場合はknowledgeを複製せずIDだけを持つ
+    if "knowledge_id" in query_data:
+        result["knowledge_id"] = query_data["knowledge_id"]
+    else:
+        result["knowledge"] = knowledge
+    return result
@@ -0,0 +1,214 @@
+import json
+import time
+from types import SimpleNamespace
+from pathlib import Path
+from knowledge_store import KnowledgeTable, MissingKnowledge
+from answering import build_system_prompt, make_answer_record
+from kirara_common.metrics import record_request
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+# Batch APIの1バッチあたりの上限 (リクエスト数と入力ファイルのサイズ)
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_BYTES = 200 * 1024 * 1024
+
+def build_batch_request(query_data, knowledge, use_model):
+    """Batch APIの入力JSONLの1行 (process_single_query()と同じメッセージ)"""
+    return {
+        "custom_id": query_data["id"],
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": use_model,
+            "messages": [
+                {"role": "system", "content": build_system_prompt(knowledge)},
+                {"role": "user", "content": f"""{query_data["query"]}
+"""}
+            ],
+        },
+    }
+
+def write_batch_inputs(queries, work_dir, prefix, use_model, knowledge_table,
+                       max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES):
+    """
+    Batch APIの入力JSONLを、1ファイルあたりmax_requests件・max_bytesバイト以下に分けて書き出す
+
+    Returns:
+        ([(ファイル名, クエリIDのリスト), ...], 1件だけでmax_bytesを超えるクエリのリスト)
+    """
+    parts = []
+    oversized = []
+    f = None
+    ids = []
+    size = 0
+    for query_data in queries:
+        request = build_batch_request(query_data, knowledge_table.resolve(query_data), use_model)
+        line = (json.dumps(request, ensure_ascii=False) + '\n').encode('utf-8')
+        if len(line) > max_bytes:
+            oversized.append(query_data)
+            continue
+        if f is None or len(ids) >= max_requests or size + len(line) > max_bytes:
+            if f is not None:
+                f.close()
+            filename = Path(work_dir) / f"{prefix}_{len(parts)}.jsonl"
+            f = open(filename, 'wb')
+            ids = []
+            size = 0
+            parts.append((filename, ids))
+        f.write(line)
+        ids.append(query_data["id"])
+        size += len(line)
+    if f is not None:
+        f.close()
+    return parts, oversized
+
+def submit_batch(client, input_filename):
+    with open(input_filename, 'rb') as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    return client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window="24h",
+    )
+
+def check_batch(client, batch_id):
+    """バッチの状態を取得して表示する"""
+    batch = client.batches.retrieve(batch_id)
+    counts = getattr(batch, "request_counts", None)
+    if counts:
+        print(f"バッチ {batch_id}: {batch.status} (完了 {counts.completed}/{counts.total}, 失敗 {counts.failed})")
+    else:
+        print(f"バッチ {batch_id}: {batch.status}")
+    return batch
+
+def iter_file_lines(client, file_id):
+    if not file_id:
+        return
+    for line in client.files.content(file_id).text.splitlines():
+        if line.strip():
+            yield json.loads(line)
+
+def collect_batch_results(client, batch, queries_by_id, knowledge_table):
+    """
+    バッチの出力ファイルとエラーファイルを読み、成功した回答と失敗したIDを返す
+    出力に現れなかったIDも失敗として扱う
+    """
+    answers = []
+    failed = set(queries_by_id)
+    for line in iter_file_lines(client, batch.output_file_id):
+        query_data = queries_by_id.get(line["custom_id"])
+        response = line.get("response") or {}
+        if query_data is None or response.get("status_code") != 200:
+            continue
+        try:
+            answer = response["body"]["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            continue
+        answers.append(make_answer_record(query_data, answer, knowledge_table.resolve(query_data)))
+        failed.discard(line["custom_id"])
+        # バッチではリクエストごとのレイテンシは分からないため、トークン数だけを記録する
+        record_request("gen_answer", line["custom_id"], response["body"].get("model"),
+                       SimpleNamespace(usage=response["body"].get("usage")), status="ok", batch=True)
+    for line in iter_file_lines(client, batch.error_file_id):
+        error = line.get("error") or (line.get("response") or {}).get("body", {}).get("error")
+        print(f"エラー: バッチ内のクエリ {line.get('custom_id')} が失敗しました: {error}")
+    return answers, failed
+
+def load_batch_state(state_file):
+    """投入済みのバッチ {バッチID: クエリIDのリスト} (1バッチだけを記録していた形式も読む)"""
+    if not state_file.exists():
+        return {}
+    with open(state_file, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    if "batch_id" in state:
+        return {state["batch_id"]: state["ids"]}
+    return {batch["batch_id"]: batch["ids"] for batch in state["batches"]}
+
+def save_batch_state(state_file, batches):
+    if not batches:
+        state_file.unlink(missing_ok=True)
+        return
+    tmp_file = state_file.with_suffix(".tmp")
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump({"batches": [{"batch_id": batch_id, "ids": ids} for batch_id, ids in batches.items()]}, f)
+    tmp_file.replace(state_file)
+
+def run_batch(queries, client, use_model, on_result, knowledge_table=None, work_dir="batch",
+              max_rounds=3, poll_interval=30, max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES):
+    """
+    未処理のクエリをBatch APIで処理する
+
+    入力は1バッチあたりmax_requests件・max_bytesバイト以下に分けて複数のバッチとして投入し、
+    完了したバッチから順にon_result(answer)を呼ぶ (キャッシュと出力への書き込みは呼び出し側)
+    失敗したIDだけを集めて最大max_rounds回まで再投入する
+    投入中のバッチIDはバッチごとにwork_dir/state.jsonに保存し、中断後の再実行ではポーリングから再開する
+
+    Returns:
+        最後まで失敗したクエリのリスト
+    """
+    knowledge_table = knowledge_table or KnowledgeTable()
+    work_dir = Path(work_dir)
+    work_dir.mkdir(exist_ok=True)
+    state_file = work_dir / "state.json"
+
+    # knowledgeが見つからないクエリはバッチに入れず、失敗として返す
+    remaining = []
+    missing = []
+    for query_data in queries:
+        try:
+            knowledge_table.resolve(query_data)
+        except MissingKnowledge as e:
+            print(f"エラー: クエリ '{query_data['query']}' のknowledgeが見つかりません: {e}")
+            missing.append(query_data)
+            continue
+        remaining.append(query_data)
+    for round_index in range(max_rounds):
+        if not remaining:
+            break
+        queries_by_id = {query_data["id"]: query_data for query_data in remaining}
+
+        # 前回の実行で投入したバッチのうち、今回の未処理クエリを含むものは再利用する
+        batches = {batch_id: ids for batch_id, ids in load_batch_state(state_file).items()
+                   if any(query_id in queries_by_id for query_id in ids)}
+        for batch_id, ids in batches.items():
+            print(f"投入済みのバッチ {batch_id} の完了を待ちます ({len(ids)}件)")
+        submitted = {query_id for ids in batches.values() for query_id in ids}
+
+        parts, oversized = write_batch_inputs(
+            [query_data for query_data in remaining if query_data["id"] not in submitted],
+            work_dir, f"batch_input_{round_index}", use_model, knowledge_table, max_requests, max_bytes)
+        for query_data in oversized:
+            print(f"エラー: クエリ '{query_data['query']}' のリクエストが1バッチのサイズの上限を超えています")
+            missing.append(query_data)
+            del queries_by_id[query_data["id"]]
+        for input_filename, ids in parts:
+            batch = submit_batch(client, input_filename)
+            batches[batch.id] = ids
+            # 1つ投入するたびに記録し、途中で中断しても投入済みのバッチを失わない
+            save_batch_state(state_file, batches)
+            print(f"バッチ {batch.id} を投入しました ({len(ids)}件)")
+
+        # 全てのバッチが終わるまでポーリングし、終わったバッチから結果を取り込む
+        succeeded = 0
+        failed = set()
+        waiting = dict(batches)
+        while waiting:
+            for batch_id in list(waiting):
+                batch = check_batch(client, batch_id)
+                if batch.status not in FINAL_STATUSES:
+                    continue
+                batch_queries = {query_id: queries_by_id[query_id] for query_id in waiting.pop(batch_id)
+                                 if query_id in queries_by_id}
+                answers, batch_failed = collect_batch_results(client, batch, batch_queries, knowledge_table)
+                for answer in answers:
+                    on_result(answer)
+                succeeded += len(answers)
+                failed |= batch_failed
+                save_batch_state(state_file, waiting)
+            if waiting:
+                time.sleep(poll_interval)
+
+        print(f"ラウンド{round_index+1}: {len(batches)}個のバッチ  成功 {succeeded}件  失敗 {len(failed)}件")
+        remaining = [queries_by_id[query_id] for query_id in queries_by_id if query_id in failed]
+
+    return missing + remaining
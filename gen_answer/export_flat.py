@@ -0,0 +1,46 @@
+import argparse
+import json
+from pathlib import Path
+from knowledge_store import KnowledgeTable
+
+def iter_records(input_filename):
+    with open(input_filename, 'r', encoding='utf-8') as f:
+        if Path(input_filename).suffix == '.jsonl':
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(f)
+
+def rehydrate(record, knowledge_table, field):
+    """knowledge_idをknowledgeテキストに置き換えたflat形式のレコードを返す"""
+    if "knowledge_id" not in record:
+        return record
+    flat = {}
+    for key, value in record.items():
+        if key == "knowledge_id":
+            flat[field] = knowledge_table.get(value)
+        else:
+            flat[key] = value
+    return flat
+
+def main():
+    parser = argparse.ArgumentParser(description='compact形式の出力を学習用のflat形式に戻す')
+    parser.add_argument('input', type=str, help='compact形式の回答 (JSONL) またはクエリ (JSON)')
+    parser.add_argument('--knowledge', type=str, required=True, help='knowledgeテーブル (JSONL)')
+    parser.add_argument('--output', type=str, default='generated_answers_flat.jsonl')
+    parser.add_argument('--field', type=str, default='knowledge',
+                        help="knowledgeテキストを入れるフィールド名 (回答は'knowledge'、クエリは'text')")
+    args = parser.parse_args()
+
+    knowledge_table = KnowledgeTable(args.knowledge)
+    count = 0
+    with open(args.output, 'w', encoding='utf-8') as f:
+        for record in iter_records(args.input):
+            f.write(json.dumps(rehydrate(record, knowledge_table, args.field), ensure_ascii=False) + '\n')
+            count += 1
+
+    print(f"{count}件のレコードを '{args.output}' に書き出しました (knowledge: {len(knowledge_table)}件)")
+
+if __name__ == "__main__":
+    main()
@@ -2,131 +2,372 @@ import json
 import os
 from pathlib import Path
 from dotenv import load_dotenv
-from openai import OpenAI
+from kirara_common.scheduler import RequestScheduler
+from kirara_common.backend_pool import get_pool
+from answering import build_system_prompt, request_answer, make_answer_record
+from knowledge_store import KnowledgeTable, MissingKnowledge
+from kirara_common.cache_store import open_cache
+from batch_mode import run_batch
+from prefix_batching import GroupStats, group_by_knowledge, process_query_group, build_multi_question_prompt, single_prompt
+from progress_journal import ProgressJournal
+from kirara_common.metrics import record_cache_hit
+from answer_cache import AnswerCache
+from streaming import iter_queries, stream_answers
+from kirara_common.sharding import Shard, record_key
+from kirara_common.planning import WorkPlan, count_tokens_many, iter_journal
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import argparse
 import random
 
+# キャッシュの設定 (CACHE_BACKEND=sqliteで単一ファイルのキャッシュを使う)
 CACHE_DIR = Path("cache")
+CACHE_NAMESPACE = "gen_answer"
 
 def load_queries(input_filename):
-    with open(input_filename, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    return list(iter_queries(input_filename))
 
-def process_single_query(query_data, client, use_model):
-    """単一クエリを処理"""
-    query = query_data["query"]
-    knowledge = query_data["text"]
+def create_client(use_pool=True):
+    """
+    OpenAIクライアントとモデル名を返す
+    OPENAI_BACKENDSを設定している場合は複数のバックエンドに振り分けるBackendPoolを返す
+    (use_pool=FalseではOPENAI_BASE_URLのクライアント。Batch APIはプールでは使えない)
+    """
+    load_dotenv(override=True)
+    api_key = os.environ.get("OPENAI_API_KEY")
+    base_url = os.environ.get("OPENAI_BASE_URL")
+    use_model = os.environ.get("OPENAI_USE_MODEL", "gpt-4o-mini")
 
-    system_prompt = f"""あなたは親切なAIアシスタントです。一般常識のほかに、以下の知識を考慮して、質問に答えてください。
+    pool = get_pool() if use_pool else None
+    if pool:
+        return pool, use_model
+    # openaiの読み込みは重いため、クライアントを作るときに読み込む (planでは読み込まない)
+    from openai import OpenAI
+    # 再試行はRequestSchedulerで行う
+    client = OpenAI(base_url=base_url, api_key=api_key, max_retries=0)
+    return client, use_model
 
-<knowledge>
-{knowledge}
-</knowledge>
+def report_backends():
+    """バックエンドプールを使っている場合は、バックエンドごとの集計を表示する"""
+    pool = get_pool()
+    if pool:
+        pool.report()
 
-# 注意点
-- あなたはインターネットにアクセスできないため、最新の状況を取得することはできません。
-- たまにあなたの知らないことを聞かれることがあります。知らない場合は知らないということを述べ、そのうえで回答を行ってください。
-    """
+def process_single_query(query_data, client, use_model, scheduler=None, knowledge_table=None, answer_cache=None):
+    """単一クエリを処理 (answer_cacheがあれば同じ内容のリクエストの回答を使い回す)"""
+    query = query_data["query"]
+    try:
+        # compact形式のクエリはknowledge_idからknowledgeテーブルを引く
+        knowledge = (knowledge_table or KnowledgeTable()).resolve(query_data)
+    except MissingKnowledge as e:
+        # 実行全体を止めず、このクエリだけを失敗として扱う
+        print(f"エラー: クエリ '{query}' のknowledgeが見つかりません: {e}")
+        return None
+
+    system_prompt = build_system_prompt(knowledge)
     
     prompt = f"""{query}
 """
-    
+
+    if answer_cache:
+        answer = answer_cache.get(use_model, system_prompt, prompt)
+        if answer is not None:
+            return make_answer_record(query_data, answer, knowledge)
+
     try:
-        response = client.chat.completions.create(
-            model=use_model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt}
-            ]
-        )
+        response = request_answer(client, use_model, system_prompt, prompt, scheduler, query_data["id"])
         answer = response.choices[0].message.content
-        
-        return {
-            "id": query_data["id"],
-            "query": query,
-            "answer": answer,
-            "knowledge": knowledge
-        }
+        if answer_cache and answer:
+            answer_cache.put(use_model, system_prompt, prompt, answer)
+        return make_answer_record(query_data, answer, knowledge)
         
     except Exception as e:
         print(f"エラー: クエリ '{query}' の処理中にエラーが発生しました: {e}")
         return None
 
-def generate_answers(queries):
-    load_dotenv(override=True)
-    api_key = os.environ.get("OPENAI_API_KEY")
-    base_url = os.environ.get("OPENAI_BASE_URL")
-    use_model = os.environ.get("OPENAI_USE_MODEL", "gpt-4o-mini")
-
-    client = OpenAI(base_url=base_url, api_key=api_key)
+def generate_answers(queries, knowledge_table=None, group_mode=False, multi_question=False, group_report=None,
+                     batch_mode=False, batch_poll_interval=30, journal=None, workers=20, answer_cache=None):
+    """
+    クエリに回答を生成し、入力順に並べた回答のリストを返す
+    journalを渡すと、記録済みのクエリはキャッシュも読まずにスキップし、完了した回答を順に追記する
+    """
+    client, use_model = create_client(use_pool=not batch_mode)
+    scheduler = RequestScheduler.from_env()
     
-    # キャッシュディレクトリ作成
-    CACHE_DIR.mkdir(exist_ok=True)
+    cache = open_cache(CACHE_NAMESPACE, CACHE_DIR, ".jsonl")
     
-    results = []
+    # クエリID -> 回答 (最後に入力順に並べ直すため、完了順に依存しない出力になる)
+    answers_by_id = dict(journal.records) if journal else {}
+
+    def add_result(answer):
+        answers_by_id[answer['id']] = answer
+        if journal:
+            journal.append(answer)
     
     # 進捗表示用カウンタ
     progress_counter = 0
     total_queries = len(queries)
     
-    # スキップ済みクエリと未処理クエリを分離
+    # ジャーナルに記録済みのクエリを除き、スキップ済みクエリと未処理クエリを分離 (キャッシュの有無はまとめて確認する)
+    unfinished_queries = [query_data for query_data in queries if query_data['id'] not in answers_by_id]
+    cached_ids = cache.existing(query_data['id'] for query_data in unfinished_queries)
+    cached_results = cache.get_many(cached_ids)
     pending_queries = []
-    for query_data in queries:
-        cache_file = CACHE_DIR / f"{query_data['id']}.jsonl"
-        
-        if cache_file.exists():
-            print(f"キャッシュから読み込み中: {query_data['id']}")
-            with open(cache_file, 'r', encoding='utf-8') as f:
-                for line in f:
-                    results.append(json.loads(line))
+    for query_data in unfinished_queries:
+        if query_data['id'] in cached_results:
+            record_cache_hit(CACHE_NAMESPACE, query_data['id'])
+            add_result(cached_results[query_data['id']])
         else:
             pending_queries.append(query_data)
+    if journal:
+        print(f"進捗ジャーナルから再開: {len(queries) - len(unfinished_queries)}件")
+    print(f"キャッシュから読み込み: {len(cached_results)}件  未処理: {len(pending_queries)}件")
     
-    # 並列処理 (20並列)
-    with ThreadPoolExecutor(max_workers=20) as executor:
-        futures = [
-            executor.submit(process_single_query, query_data, client, use_model)
-            for query_data in pending_queries
-        ]
+    if batch_mode:
+        # Batch APIで処理し、完了した回答から順にキャッシュへ保存する
+        def on_result(answer):
+            cache.put(answer['id'], answer)
+            add_result(answer)
+
+        failed = run_batch(pending_queries, client, use_model, on_result, knowledge_table,
+                           poll_interval=batch_poll_interval)
+        if failed:
+            print(f"エラー: {len(failed)}件のクエリが再投入後も失敗しました")
+        return [answers_by_id[query_data['id']] for query_data in queries if query_data['id'] in answers_by_id]
+
+    # 並列処理 (デフォルト20並列)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if group_mode:
+            # 同じknowledgeのクエリを1つのワーカーで連続して送り、プレフィックスキャッシュを効かせる
+            group_stats = GroupStats()
+            futures = {
+                executor.submit(process_query_group, group, client, use_model, scheduler, knowledge_table,
+                                multi_question, group_stats, answer_cache): len(group)
+                for group in group_by_knowledge(pending_queries, knowledge_table)
+            }
+        else:
+            futures = {
+                executor.submit(process_single_query, query_data, client, use_model, scheduler, knowledge_table,
+                                answer_cache): 1
+                for query_data in pending_queries
+            }
         
         for future in as_completed(futures):
-            progress_counter += 1
+            progress_counter += futures[future]
             print(f"処理中: {progress_counter}/{total_queries} ({progress_counter/total_queries*100:.1f}%)")
             result = future.result()
-            if result:
-                # 結果をキャッシュに保存
-                cache_file = CACHE_DIR / f"{result['id']}.jsonl"
-                with open(cache_file, 'w', encoding='utf-8') as f:
-                    f.write(json.dumps(result, ensure_ascii=False) + '\n')
-                
-                results.append(result)
+            for answer in (result if group_mode else [result]):
+                if answer:
+                    # 結果をキャッシュに保存
+                    cache.put(answer['id'], answer)
+                    
+                    add_result(answer)
+
+    if group_mode:
+        group_stats.report()
+        if group_report:
+            group_stats.write(group_report)
+    report_backends()
     
-    return results
+    return [answers_by_id[query_data['id']] for query_data in queries if query_data['id'] in answers_by_id]
+
+def generate_answers_stream(input_filename, output_file, knowledge_table=None, max_pending=100, resume=False,
+                            workers=20, answer_cache=None, shard=None):
+    """入力を1件ずつ読み、完了した回答から出力ファイルに追記する (ストリーミングモード)"""
+    client, use_model = create_client()
+    scheduler = RequestScheduler.from_env()
+    cache = open_cache(CACHE_NAMESPACE, CACHE_DIR, ".jsonl")
+    queries = iter_queries(input_filename)
+    if shard:
+        queries = (query_data for query_data in queries if record_key(query_data) in shard)
+
+    generated, cached, failed = stream_answers(
+        queries, output_file,
+        lambda query_data: process_single_query(query_data, client, use_model, scheduler, knowledge_table,
+                                                answer_cache),
+        cache, workers=workers, max_pending=max_pending, resume=resume)
+    print(f"生成: {generated}件  キャッシュから読み込み: {cached}件  失敗: {failed}件")
+    report_backends()
+
+def plan_answers(args, output_file, shard=None):
+    """
+    APIを呼ばずに、未処理のクエリ数・入力トークン数・料金・時間を見積もって表示する (plan サブコマンド)
+    キャッシュはまとめて問い合わせ、同じknowledgeのトークン数は1度だけ数える
+    """
+    load_dotenv(override=True)
+    use_model = os.environ.get("OPENAI_USE_MODEL", "gpt-4o-mini")
+    plan = WorkPlan(CACHE_NAMESPACE, use_model)
+    queries = iter_queries(args.input)
+    if shard:
+        queries = (query_data for query_data in queries if record_key(query_data) in shard)
+    queries = list(queries)
+    if args.test:
+        queries = random.sample(queries, min(10, len(queries)))
+    plan.total = len(queries)
+
+    done = set()
+    if args.resume:
+        # --streamでは出力ファイル、それ以外は進捗ジャーナルに完了済みの回答がある
+        done = {record["id"] for record in iter_journal(output_file if args.stream else f"{output_file}.journal")}
+        plan.skip("完了済み", sum(1 for query_data in queries if query_data["id"] in done))
+    unfinished = [query_data for query_data in queries if query_data["id"] not in done]
+    cached = open_cache(CACHE_NAMESPACE, CACHE_DIR, ".jsonl").existing(query_data["id"] for query_data in unfinished)
+    pending = [query_data for query_data in unfinished if query_data["id"] not in cached]
+    plan.skip("キャッシュ済み", len(unfinished) - len(pending))
+
+    knowledge_table = KnowledgeTable(args.knowledge) if args.knowledge else KnowledgeTable()
+    # knowledgeが見つからないクエリは実行時に失敗するため、見積もりから除く
+    resolvable = []
+    knowledges = []
+    for query_data in pending:
+        try:
+            knowledges.append(knowledge_table.resolve(query_data))
+        except MissingKnowledge:
+            continue
+        resolvable.append(query_data)
+    if len(resolvable) < len(pending):
+        plan.notes.append(f"knowledgeが見つからないクエリ: {len(pending) - len(resolvable)}件 (実行時には失敗します)")
+    pending = resolvable
+    # 内容ベースの回答キャッシュは、既にある場合だけ開く (planで新しく作らない)
+    if args.answer_cache and os.path.exists(args.answer_cache):
+        system_prompts = {knowledge: build_system_prompt(knowledge) for knowledge in set(knowledges)}
+        hits = AnswerCache(args.answer_cache, normalize=args.normalize_cache).existing(
+            use_model, [(system_prompts[knowledge], single_prompt(query_data))
+                        for query_data, knowledge in zip(pending, knowledges)])
+        pending = [query_data for index, query_data in enumerate(pending) if index not in hits]
+        knowledges = [knowledge for index, knowledge in enumerate(knowledges) if index not in hits]
+        plan.skip("回答キャッシュ", len(hits))
+    plan.pending_items = len(pending)
+
+    # システムプロンプトのknowledge以外の部分
+    template = build_system_prompt("")
+    overhead = count_tokens_many([template])[template]
+    if args.group_by_knowledge or args.multi_question:
+        groups = group_by_knowledge(pending, knowledge_table)
+        group_knowledges = [knowledge_table.resolve(group[0]) for group in groups]
+        if args.multi_question:
+            # グループごとに1回のリクエストで全質問に答えさせる
+            plan.count_prompts(overhead, [
+                (knowledge, build_multi_question_prompt(group) if len(group) > 1 else single_prompt(group[0]))
+                for group, knowledge in zip(groups, group_knowledges)])
+        else:
+            counts = plan.count_prompts(overhead, [(knowledge, single_prompt(query_data))
+                                                   for group, knowledge in zip(groups, group_knowledges)
+                                                   for query_data in group])
+            # グループの2件目以降はシステムプロンプトがプレフィックスキャッシュに載る見込み
+            plan.cached_tokens = sum((len(group) - 1) * (overhead + counts[knowledge])
+                                     for group, knowledge in zip(groups, group_knowledges))
+        plan.notes.append(f"knowledgeのグループ: {len(groups)}個")
+    else:
+        plan.count_prompts(overhead, [(knowledge, single_prompt(query_data))
+                                      for query_data, knowledge in zip(pending, knowledges)])
+    plan.report(args.workers, args.output_tokens, args.latency, batch=args.batch)
 
 def main():
     import argparse
     import random
     
     parser = argparse.ArgumentParser()
+    parser.add_argument('command', nargs='?', choices=['plan'],
+                       help='plan: APIを呼ばずに、未処理のクエリ数・入力トークン数・料金・時間の見積もりだけを表示する')
     parser.add_argument('--input', type=str, default="../gen_query/generated_queries.json", 
-                       help='入力JSONファイルのパス')
+                       help='入力ファイルのパス (JSONまたはJSONL)')
+    parser.add_argument('--output', type=str, default="generated_answers.jsonl", help='出力JSONLファイルのパス')
     parser.add_argument('--test', action='store_true', help='テストモード: ランダムに10個のクエリだけ処理')
+    parser.add_argument('--knowledge', type=str, default=None,
+                       help='compact形式のknowledgeテーブル (gen_queryの--compactで出力したJSONL、または.kcorpus)')
+    parser.add_argument('--group-by-knowledge', action='store_true',
+                       help='同じknowledgeのクエリをまとめて連続で送る (プレフィックスキャッシュ向け)')
+    parser.add_argument('--multi-question', action='store_true',
+                       help='--group-by-knowledge時に、1回のリクエストでグループ内の全質問に答えさせる')
+    parser.add_argument('--batch', action='store_true',
+                       help='Batch APIで未処理のクエリをまとめて処理する')
+    parser.add_argument('--batch-poll-interval', type=float, default=30,
+                       help='--batch時にバッチの状態を確認する間隔 (秒)')
+    parser.add_argument('--group-report', type=str, default=None,
+                       help='グループごとのレイテンシ・キャッシュ済みトークン数の出力先 (JSONL)')
+    parser.add_argument('--resume', action='store_true',
+                       help='前回中断した実行の進捗ジャーナルから再開する')
+    parser.add_argument('--workers', type=int, default=20, help='並列数')
+    parser.add_argument('--answer-cache', type=str, default=None,
+                       help='内容ベースの回答キャッシュ (SQLite) のパス。同じモデル・knowledge・クエリの回答を使い回す')
+    parser.add_argument('--normalize-cache', action='store_true',
+                       help='--answer-cacheで空白や全角・半角だけが違うクエリにもヒットさせる')
+    parser.add_argument('--answer-cache-max-entries', type=int, default=None, help='回答キャッシュのエントリ数の上限')
+    parser.add_argument('--answer-cache-max-mb', type=float, default=None, help='回答キャッシュの合計サイズ (MB) の上限')
+    parser.add_argument('--stream', action='store_true',
+                       help='入力を1件ずつ読み、完了した回答から出力に追記する (入力はJSONLを推奨)')
+    parser.add_argument('--max-pending', type=int, default=100,
+                       help='--stream時に処理待ちにしておくクエリの上限')
+    parser.add_argument('--shard', type=str, default=None,
+                       help='複数のマシンで分担する (i/N)。knowledgeの内容ハッシュがこのシャードに入るクエリだけを処理し、'
+                            'シャードごとのファイルに出力する')
+    parser.add_argument('--output-tokens', type=int, default=None,
+                       help='plan: 1件あたりの出力トークン数 (省略時はMETRICS_FILEの実績の平均、無ければ既定値)')
+    parser.add_argument('--latency', type=float, default=None,
+                       help='plan: 1リクエストあたりのレイテンシ (秒、省略時はMETRICS_FILEの実績の平均、無ければ既定値)')
     args = parser.parse_args()
     
-    output_file = "generated_answers.jsonl"
+    output_file = args.output
+    shard = None
+    if args.shard:
+        try:
+            shard = Shard.parse(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+        output_file = shard.filename(output_file)
+        if args.group_report:
+            args.group_report = shard.filename(args.group_report)
+    if args.command == 'plan':
+        plan_answers(args, output_file, shard)
+        return
+    answer_cache = None
+    if args.answer_cache:
+        answer_cache = AnswerCache(
+            args.answer_cache, normalize=args.normalize_cache, max_entries=args.answer_cache_max_entries,
+            max_bytes=int(args.answer_cache_max_mb * 1024 * 1024) if args.answer_cache_max_mb else None)
+    
+    if args.stream:
+        if args.test or args.group_by_knowledge or args.multi_question or args.batch:
+            parser.error('--streamは--test / --group-by-knowledge / --multi-question / --batchと併用できません')
+        knowledge_table = KnowledgeTable(args.knowledge) if args.knowledge else None
+        # 出力ファイル自体を進捗として使う (--resumeで記録済みのIDをスキップする)
+        generate_answers_stream(args.input, output_file, knowledge_table, args.max_pending, args.resume,
+                                args.workers, answer_cache, shard)
+        if answer_cache:
+            answer_cache.report()
+        print(f"生成された回答を '{output_file}' に保存しました。")
+        return
     
     queries = load_queries(args.input)
+    knowledge_table = KnowledgeTable(args.knowledge) if args.knowledge else None
+    if shard:
+        total_queries = len(queries)
+        queries = [query_data for query_data in queries if record_key(query_data) in shard]
+        print(f"シャード {shard}: {total_queries}件中{len(queries)}件のクエリを処理します")
     
     if args.test:
         queries = random.sample(queries, min(10, len(queries)))
         print(f"テストモード: {len(queries)}個のクエリを処理します")
     
-    answers = generate_answers(queries)
+    # 完了した回答を追記する進捗ジャーナル (正常に終了したら削除する)
+    journal = ProgressJournal(f"{output_file}.journal", resume=args.resume)
+    
+    answers = generate_answers(queries, knowledge_table,
+                               group_mode=args.group_by_knowledge or args.multi_question,
+                               multi_question=args.multi_question,
+                               group_report=args.group_report,
+                               batch_mode=args.batch,
+                               batch_poll_interval=args.batch_poll_interval,
+                               journal=journal,
+                               workers=args.workers,
+                               answer_cache=answer_cache)
+    if answer_cache:
+        answer_cache.report()
     
     with open(output_file, 'w', encoding='utf-8') as f:
         for answer in answers:
             f.write(json.dumps(answer, ensure_ascii=False) + '\n')
+    journal.close(remove=True)
     
     print(f"生成された回答を '{output_file}' に保存しました。")
 
@@ -0,0 +1,49 @@
+import hashlib
+import json
+from pathlib import Path
+from kirara_common.corpus_store import CorpusStore
+
+def knowledge_id(text):
+    """knowledgeテキストの内容ハッシュ (gen_queryのcompact形式と同じID)"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class MissingKnowledge(KeyError):
+    """レコードのknowledge_idの本文がknowledgeテーブルに無い"""
+
+class KnowledgeTable:
+    """
+    compact形式のknowledgeテーブル (1行1文書のJSONL: {"id": ..., "text": ...})
+    各文書をメモリ上に1度だけ保持し、レコードのknowledge_idから本文を引く
+    .kcorpusを指定した場合はメモリマップで開き、必要な本文だけを読み込む
+    """
+
+    def __init__(self, filename=None):
+        self.texts = {}
+        if filename and Path(filename).suffix == '.kcorpus':
+            # kirara_common.corpus_storeで作ったコーパスは読み込まず、内容ハッシュから本文を引く
+            self.texts = CorpusStore(filename).by_hash
+        elif filename:
+            with open(filename, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        doc = json.loads(line)
+                        self.texts[doc["id"]] = doc["text"]
+
+    def __len__(self):
+        return len(self.texts)
+
+    def get(self, doc_id):
+        return self.texts[doc_id]
+
+    def resolve(self, record, field="text"):
+        """
+        レコードのknowledgeテキストを返す (flat形式ならfieldの値をそのまま使う)
+        本文が見つからない場合はMissingKnowledgeを送出する
+        """
+        if field in record:
+            return record[field]
+        doc_id = record.get("knowledge_id")
+        try:
+            return self.texts[doc_id]
+        except KeyError:
+            raise MissingKnowledge(f"knowledge_id '{doc_id}' の本文がknowledgeテーブルにありません") from None
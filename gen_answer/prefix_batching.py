@@ -0,0 +1,155 @@
+import json
+import re
+import time
+from knowledge_store import KnowledgeTable, MissingKnowledge, knowledge_id
+from answering import build_system_prompt, request_answer, make_answer_record
+
+def group_by_knowledge(queries, knowledge_table=None):
+    """未処理のクエリをknowledge文書ごとにまとめる (グループ内は入力順)"""
+    knowledge_table = knowledge_table or KnowledgeTable()
+    groups = {}
+    for query_data in queries:
+        try:
+            key = query_data.get("knowledge_id") or knowledge_id(knowledge_table.resolve(query_data))
+        except MissingKnowledge:
+            # knowledgeの無いクエリはprocess_query_group()で失敗として扱う
+            key = None
+        groups.setdefault(key, []).append(query_data)
+    return list(groups.values())
+
+def get_cached_tokens(usage):
+    details = getattr(usage, "prompt_tokens_details", None)
+    return (getattr(details, "cached_tokens", None) or 0) if details else 0
+
+def build_multi_question_prompt(group):
+    questions = "\n".join(
+        f'<question id="{i+1}">\n{query_data["query"]}\n</question>' for i, query_data in enumerate(group)
+    )
+    return f"""以下の{len(group)}個の質問にそれぞれ独立して答えてください。
+各回答は対応する質問と同じidを付けた<answer id="番号">タグで囲み、タグの外には何も書かないでください。
+
+{questions}
+"""
+
+def split_multi_answers(text):
+    """<answer id="n">...</answer>をidごとの回答に分割する"""
+    return {
+        int(m.group(1)): m.group(2).strip()
+        for m in re.finditer(r'<answer id="(\d+)">(.*?)</answer>', text, re.DOTALL)
+    }
+
+def single_prompt(query_data):
+    """1つの質問だけを送るときのユーザープロンプト (process_single_query()と同じ)"""
+    return f"""{query_data["query"]}
+"""
+
+class GroupStats:
+    """knowledgeグループごとのレイテンシとプロンプトキャッシュのヒット状況"""
+
+    def __init__(self):
+        self.groups = []
+
+    def add(self, group_key, num_queries, num_requests, latency, prompt_tokens, cached_tokens):
+        self.groups.append({
+            "knowledge_id": group_key,
+            "queries": num_queries,
+            "requests": num_requests,
+            "latency": latency,
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+        })
+
+    def write(self, filename):
+        with open(filename, 'w', encoding='utf-8') as f:
+            for group in self.groups:
+                f.write(json.dumps(group, ensure_ascii=False) + '\n')
+
+    def report(self):
+        if not self.groups:
+            return
+        prompt_tokens = sum(g["prompt_tokens"] for g in self.groups)
+        cached_tokens = sum(g["cached_tokens"] for g in self.groups)
+        latencies = sorted(g["latency"] for g in self.groups)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        ratio = cached_tokens / prompt_tokens if prompt_tokens else 0.0
+        print(f"グループ数: {len(self.groups)}  リクエスト数: {sum(g['requests'] for g in self.groups)}")
+        print(f"キャッシュ済みプロンプトトークン: {cached_tokens}/{prompt_tokens} ({ratio*100:.1f}%)")
+        print(f"グループあたりのレイテンシ: 平均 {sum(latencies)/len(latencies):.2f}秒  p95 {p95:.2f}秒")
+
+def process_query_group(group, client, use_model, scheduler=None, knowledge_table=None,
+                        multi_question=False, stats=None, answer_cache=None):
+    """
+    同じknowledgeを持つクエリをまとめて処理する
+
+    システムプロンプト (knowledgeを含む共通プレフィックス) は全リクエストで同一にし、
+    グループ内のリクエストを連続して送ることでプロバイダー側のプレフィックスキャッシュを効かせる
+    multi_question=Trueの場合は1回のリクエストで全質問に答えさせ、回答を分割する
+    (分割できなかった質問は個別に再リクエストする)
+    answer_cacheにある質問はリクエストせずにキャッシュの回答を使う
+    """
+    knowledge_table = knowledge_table or KnowledgeTable()
+    try:
+        knowledge = knowledge_table.resolve(group[0])
+    except MissingKnowledge as e:
+        # 実行全体を止めず、このグループのクエリだけを失敗として扱う
+        print(f"エラー: {len(group)}件のクエリのknowledgeが見つかりません: {e}")
+        return []
+    system_prompt = build_system_prompt(knowledge)
+    group_key = group[0].get("knowledge_id") or knowledge_id(knowledge)
+
+    start = time.perf_counter()
+    results = []
+    remaining = []
+    for query_data in group:
+        answer = answer_cache.get(use_model, system_prompt, single_prompt(query_data)) if answer_cache else None
+        if answer is not None:
+            results.append(make_answer_record(query_data, answer, knowledge))
+        else:
+            remaining.append(query_data)
+    num_requests = 0
+    prompt_tokens = 0
+    cached_tokens = 0
+
+    def record_usage(response):
+        nonlocal num_requests, prompt_tokens, cached_tokens
+        num_requests += 1
+        usage = getattr(response, "usage", None)
+        if usage:
+            prompt_tokens += usage.prompt_tokens or 0
+            cached_tokens += get_cached_tokens(usage)
+
+    if multi_question and len(remaining) > 1:
+        pending = remaining
+        try:
+            response = request_answer(
+                client, use_model, system_prompt, build_multi_question_prompt(pending), scheduler, group_key,
+                validate=lambda response: len(split_multi_answers(response.choices[0].message.content or "")) == len(pending))
+            record_usage(response)
+            answers = split_multi_answers(response.choices[0].message.content)
+            remaining = []
+            for i, query_data in enumerate(pending):
+                if answers.get(i + 1):
+                    # 次回は個別の質問としてキャッシュを引くので、1問ずつのプロンプトをキーに保存する
+                    if answer_cache:
+                        answer_cache.put(use_model, system_prompt, single_prompt(query_data), answers[i + 1])
+                    results.append(make_answer_record(query_data, answers[i + 1], knowledge))
+                else:
+                    remaining.append(query_data)
+        except Exception as e:
+            print(f"エラー: まとめて質問する処理中にエラーが発生しました: {e}")
+
+    for query_data in remaining:
+        prompt = single_prompt(query_data)
+        try:
+            response = request_answer(client, use_model, system_prompt, prompt, scheduler, query_data["id"])
+            record_usage(response)
+            answer = response.choices[0].message.content
+            if answer_cache and answer:
+                answer_cache.put(use_model, system_prompt, prompt, answer)
+            results.append(make_answer_record(query_data, answer, knowledge))
+        except Exception as e:
+            print(f"エラー: クエリ '{query_data['query']}' の処理中にエラーが発生しました: {e}")
+
+    if stats is not None:
+        stats.add(group_key, len(group), num_requests, time.perf_counter() - start, prompt_tokens, cached_tokens)
+    return results
@@ -0,0 +1,52 @@
+import json
+import os
+import threading
+
+class ProgressJournal:
+    """
+    完了した回答を1件ずつ追記する進捗ジャーナル (JSONL)
+
+    resume=Trueで開くと既存のジャーナルから完了済みの回答を読み込み、続きから追記する
+    異常終了で途中まで書かれた最後の行は切り捨てる
+    resume=Falseでは既存のジャーナルを空にして始める
+    """
+
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        self.records = {}
+        self._lock = threading.Lock()
+        if resume and os.path.exists(filename):
+            self._file = open(filename, 'r+b')
+            self._load()
+        else:
+            self._file = open(filename, 'w+b')
+
+    def _load(self):
+        offset = 0
+        for line in self._file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            self.records[record["id"]] = record
+            offset += len(line)
+        self._file.truncate(offset)
+        print(f"進捗ジャーナルから{len(self.records)}件の完了済み回答を読み込みました")
+
+    def __contains__(self, query_id):
+        return query_id in self.records
+
+    def append(self, record):
+        """回答を追記してディスクに書き出す (複数スレッドから呼び出してよい)"""
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        with self._lock:
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.records[record["id"]] = record
+
+    def close(self, remove=False):
+        self._file.close()
+        if remove:
+            os.remove(self.filename)
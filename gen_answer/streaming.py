@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from kirara_common.metrics import record_cache_hit
+
+def iter_queries(input_filename):
+    """
+    クエリを1件ずつ読み込む
+    JSONLなら1行ずつ読むため、入力全体をメモリに載せない (.jsonの場合は全体を読み込む)
+    """
+    with open(input_filename, 'r', encoding='utf-8') as f:
+        if Path(input_filename).suffix == '.jsonl':
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(f)
+
+class AnswerAppender:
+    """
+    完了した回答を出力ファイル (JSONL) に到着順で追記する
+
+    resume=Trueでは既存の出力ファイルのIDだけを読み込み (回答本文は保持しない)、
+    途中まで書かれた最後の行を切り捨ててから続きを追記する
+    """
+
+    def __init__(self, output_filename, resume=False):
+        self.done_ids = set()
+        self._lock = threading.Lock()
+        if resume and os.path.exists(output_filename):
+            self._file = open(output_filename, 'r+b')
+            offset = 0
+            for line in self._file:
+                try:
+                    self.done_ids.add(json.loads(line)["id"])
+                except json.JSONDecodeError:
+                    break
+                offset += len(line)
+            self._file.truncate(offset)
+            self._file.seek(offset)
+            print(f"出力ファイルから{len(self.done_ids)}件の完了済み回答を読み込みました")
+        else:
+            self._file = open(output_filename, 'wb')
+
+    def write(self, answer):
+        line = (json.dumps(answer, ensure_ascii=False) + '\n').encode('utf-8')
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+def stream_answers(queries, output_filename, answer_fn, cache, workers=20, max_pending=100, resume=False):
+    """
+    クエリのイテレータを読みながら回答を生成し、完了した順に出力ファイルへ追記する
+
+    処理中 (キュー待ちを含む) のクエリはmax_pending件までに制限し、
+    それを超えると入力の読み込みを止める (バックプレッシャー)
+    そのためメモリ使用量は入力の件数によらずほぼ一定になる
+
+    Args:
+        queries: クエリのイテレータ
+        answer_fn: クエリ1件の回答レコードを返す関数 (失敗時はNone)
+        cache: 回答キャッシュ (1件ずつ確認・保存する)
+
+    Returns:
+        (生成した件数, キャッシュから読み込んだ件数, 失敗した件数)
+    """
+    appender = AnswerAppender(output_filename, resume)
+    slots = threading.BoundedSemaphore(max_pending)
+    counts = {"generated": 0, "cached": 0, "failed": 0}
+    counts_lock = threading.Lock()
+
+    def count(key):
+        with counts_lock:
+            counts[key] += 1
+            total = sum(counts.values())
+        if total % 100 == 0:
+            print(f"処理中: {total}件 (生成 {counts['generated']}  キャッシュ {counts['cached']}  失敗 {counts['failed']})")
+
+    def work(query_data):
+        try:
+            answer = cache.get(query_data['id'])
+            if answer is not None:
+                record_cache_hit("gen_answer", query_data['id'])
+                appender.write(answer)
+                count("cached")
+                return
+            answer = answer_fn(query_data)
+            if answer:
+                cache.put(answer['id'], answer)
+                appender.write(answer)
+                count("generated")
+            else:
+                count("failed")
+        except Exception as e:
+            print(f"エラー: クエリ '{query_data.get('query')}' の処理中にエラーが発生しました: {e}")
+            count("failed")
+        finally:
+            slots.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for query_data in queries:
+                if query_data['id'] in appender.done_ids:
+                    continue
+                # 処理中のクエリがmax_pending件に達していれば空くまで待つ
+                slots.acquire()
+                executor.submit(work, query_data)
+    finally:
+        appender.close()
+    return counts["generated"], counts["cached"], counts["failed"]
@@ -0,0 +1,118 @@
+import asyncio
+import os
+import time
+from kirara_common.scheduler import estimate_tokens
+from kirara_common.metrics import record_request, record_cache_hit
+from kirara_common.backend_pool import get_pool
+from query_stream import stream_enabled, astream_queries
+from query_utils import get_model, get_scheduler, load_cached_result, save_cached_result, make_result
+
+def create_async_client(concurrency):
+    """
+    全リクエストで共有するAsyncOpenAIクライアントを作成する
+    同時実行数と同じ数のkeep-alive接続を保持し、TLSハンドシェイクを使い回す
+    OPENAI_BACKENDSを設定している場合は、バックエンドごとに接続を保持するプールのクライアントを返す
+    """
+    pool = get_pool()
+    if pool:
+        return pool.async_client()
+    import httpx
+    from openai import AsyncOpenAI
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=concurrency,
+            max_keepalive_connections=concurrency,
+            keepalive_expiry=60,
+        ),
+        timeout=httpx.Timeout(600, connect=10),
+    )
+    return AsyncOpenAI(
+        base_url=os.environ.get("OPENAI_BASE_URL"),
+        api_key=os.environ.get("OPENAI_API_KEY"),
+        http_client=http_client,
+        # 再試行はRequestSchedulerで行う
+        max_retries=0,
+    )
+
+async def generate_queries_async(client, semaphore, build_prompt, item, cache_id):
+    """generate_queries()の非同期版 (キャッシュの読み書きも同じ)"""
+    if cache_id:
+        cached = load_cached_result(cache_id)
+        if cached is not None:
+            record_cache_hit("gen_query", cache_id)
+            return cached
+
+    user_query_prompt = build_prompt(item, cache_id)
+
+    timing = {}
+    waited = time.perf_counter()
+    async with semaphore:
+        acquired = time.perf_counter()
+        if stream_enabled():
+            # <query>タグを受信しながら取り出し、目標数に達したら打ち切る
+            return await astream_queries(client, user_query_prompt, cache_id, extra_wait=acquired - waited)
+        try:
+            response = await get_scheduler().acall(
+                lambda: client.chat.completions.create(
+                    model=get_model(),
+                    messages=[
+                        {"role": "user", "content": user_query_prompt}
+                    ]
+                ),
+                estimated_tokens=estimate_tokens(user_query_prompt),
+                timing=timing,
+            )
+            generated_text = response.choices[0].message.content
+        except Exception as e:
+            print(f"エラー: OpenAI API呼び出し中にエラーが発生しました: {e}")
+            timing["queue_wait"] = timing.get("queue_wait", 0.0) + acquired - waited
+            record_request("gen_query", cache_id, get_model(), timing=timing, status="error")
+            return
+
+    # セマフォの待ち時間も待ち時間に含める
+    timing["queue_wait"] += acquired - waited
+    result = make_result(user_query_prompt, generated_text)
+    record_request("gen_query", cache_id, get_model(), response, timing,
+                   status="ok" if result["queries"] else "parse_failure", queries=len(result["queries"]))
+
+    if cache_id:
+        save_cached_result(cache_id, result)
+
+    return result
+
+async def _run(data, cache_ids, indices, build_prompt, on_result, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    skipped_items = 0
+
+    async with create_async_client(concurrency) as client:
+        async def run_one(index):
+            result = await generate_queries_async(client, semaphore, build_prompt, data[index], cache_ids[index])
+            return index, result
+
+        tasks = [asyncio.create_task(run_one(i)) for i in indices]
+        for task in asyncio.as_completed(tasks):
+            original_index, result = await task
+            if result:
+                on_result(original_index, result)
+                print(f"処理済み: {original_index+1}/{len(data)}")
+            else:
+                skipped_items += 1
+
+    return skipped_items
+
+def run_async_generation(data, cache_ids, indices, build_prompt, on_result, concurrency=5):
+    """
+    asyncioで全アイテムのクエリを生成する
+
+    Args:
+        data: knowledgeアイテムのリスト
+        cache_ids: 各アイテムのキャッシュID
+        indices: 処理するアイテムのインデックス
+        build_prompt: (item, cache_id) からプロンプトを作る関数
+        on_result: 完了したアイテムごとに (index, result) で呼ばれる関数
+        concurrency: 同時に実行するAPIリクエストの上限
+
+    Returns:
+        スキップしたアイテム数
+    """
+    return asyncio.run(_run(data, cache_ids, indices, build_prompt, on_result, concurrency))
@@ -0,0 +1,174 @@
+import re
+import uuid
+
+try:
+    import tiktoken  # 任意
+except ImportError:
+    tiktoken = None
+
+_encoding = None
+_warned = False
+
+# Wikipediaの見出し (wikitextの == 見出し == 形式)
+HEADING_MARKUP = re.compile(r'^=+\s*(.+?)\s*=+$')
+# 文末・括弧閉じで終わる行は本文とみなす
+SENTENCE_END = tuple('。．.、，,」』）)!！?？:：')
+
+def count_tokens(text):
+    """トークン数を数える (tiktokenが無ければ1文字1トークンで概算)"""
+    global _encoding, _warned
+    if tiktoken is None:
+        if not _warned:
+            _warned = True
+            print("警告: tiktokenがインストールされていないため、トークン数を1文字1トークンで概算します "
+                  "(uv sync --extra tiktoken でインストールできます)")
+        return len(text)
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding("o200k_base")
+    return len(_encoding.encode(text, disallowed_special=()))
+
+def is_heading(line, next_line):
+    """本文中の行が節見出しかどうかを推定する"""
+    stripped = line.strip()
+    if HEADING_MARKUP.match(stripped):
+        return True
+    # データセットの本文では見出しは短い独立した行として現れる
+    return (0 < len(stripped) <= 25
+            and not stripped.endswith(SENTENCE_END)
+            and not stripped.startswith(('・', '*', '-', '|'))
+            and bool(next_line.strip()))
+
+def split_sections(text):
+    """見出しの位置で本文を節に分割する (各節は見出し行から始まる)"""
+    lines = text.split('\n')
+    sections = []
+    current = []
+    for i, line in enumerate(lines):
+        next_line = lines[i + 1] if i + 1 < len(lines) else ''
+        if current and is_heading(line, next_line):
+            sections.append('\n'.join(current))
+            current = []
+        current.append(line)
+    if current:
+        sections.append('\n'.join(current))
+    return sections
+
+def split_oversized(section, max_tokens, used_tokens=0):
+    """
+    1つの節が上限を超える場合は段落 (行) 単位、それでも超えれば文字数で分割する
+    最初の断片は、既にused_tokensを使っているチャンクの残りに収まる大きさにする
+    """
+    pieces = []
+    current = []
+    current_tokens = used_tokens
+    for line in section.split('\n'):
+        rest = line
+        while rest:
+            budget = max_tokens - current_tokens - 1
+            rest_tokens = count_tokens(rest)
+            if rest_tokens <= budget:
+                part, rest = rest, ''
+            elif current and budget < max_tokens // 4:
+                # 残りが少なければ新しいチャンクに移る
+                pieces.append('\n'.join(current))
+                current = []
+                current_tokens = 0
+                continue
+            else:
+                # 上限に収まる長さで行を切る
+                length = max(1, len(rest) * max(budget, 1) // rest_tokens)
+                part, rest = rest[:length], rest[length:]
+            current.append(part)
+            current_tokens += count_tokens(part) + 1
+        if not line:
+            if current_tokens + 1 > max_tokens and current:
+                pieces.append('\n'.join(current))
+                current = []
+                current_tokens = 0
+            current.append('')
+            current_tokens += 1
+    if current:
+        pieces.append('\n'.join(current))
+    return pieces
+
+def chunk_text(text, max_tokens, total_tokens=None):
+    """
+    本文を節の境界に沿って、それぞれmax_tokens以下のチャンクにまとめる
+    total_tokens: 本文全体のトークン数 (分かっていれば数え直さない)
+    """
+    if (total_tokens if total_tokens is not None else count_tokens(text)) <= max_tokens:
+        return [text]
+    chunks = []
+    current = []
+    current_tokens = 0
+    for section in split_sections(text):
+        section_tokens = count_tokens(section) + 1
+        if section_tokens <= max_tokens:
+            pieces = [section]
+        else:
+            # 最初の断片は現在のチャンクの残りに詰める
+            pieces = split_oversized(section, max_tokens, current_tokens)
+        for piece in pieces:
+            piece_tokens = count_tokens(piece) + 1
+            if current and current_tokens + piece_tokens > max_tokens:
+                chunks.append('\n'.join(current))
+                current = []
+                current_tokens = 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks
+
+class ChunkStats:
+    """チャンク分割によって削減されたトークン数の集計"""
+
+    def __init__(self):
+        self.articles = 0
+        self.chunked_articles = 0
+        self.chunks = 0
+        self.article_tokens = {}
+        self.chunk_tokens = {}
+
+    def report(self, query_counts):
+        """
+        query_counts: 作業アイテムのインデックス -> 生成されたクエリ数
+        gen_answerで各クエリに記事全体ではなくチャンクだけを送ることで削減される入力トークン数を表示する
+        """
+        saved = sum(
+            (self.article_tokens[index] - self.chunk_tokens[index]) * count
+            for index, count in query_counts.items()
+        )
+        print(f"チャンク分割: {self.chunked_articles}/{self.articles}件の記事を{self.chunks}個のチャンクに分割")
+        print(f"回答生成で削減される入力トークン数 (推定): {saved}")
+
+def expand_chunks(data, max_tokens, token_count=None):
+    """
+    上限を超える記事をチャンクに分割した作業アイテムのリストを返す
+
+    上限以内の記事はそのまま (キャッシュIDも従来どおり) 、分割した記事の
+    各チャンクには chunk_id (記事のキャッシュID#チャンク番号) を付け、textをチャンク本文に置き換える
+    token_count: 記事のインデックスから数え済みのトークン数 (無ければNone) を返す関数
+    (.kcorpusのCorpusStore.known_token_count)
+    """
+    stats = ChunkStats()
+    items = []
+    for index, item in enumerate(data):
+        stats.articles += 1
+        article_tokens = token_count(index) if token_count else None
+        if article_tokens is None:
+            article_tokens = count_tokens(item["text"])
+        chunks = chunk_text(item["text"], max_tokens, article_tokens) if max_tokens else [item["text"]]
+        if len(chunks) == 1:
+            stats.article_tokens[len(items)] = article_tokens
+            stats.chunk_tokens[len(items)] = article_tokens
+            items.append(item)
+            continue
+        stats.chunked_articles += 1
+        stats.chunks += len(chunks)
+        article_id = str(uuid.uuid5(uuid.NAMESPACE_URL, item["text"]))
+        for i, chunk in enumerate(chunks):
+            stats.article_tokens[len(items)] = article_tokens
+            stats.chunk_tokens[len(items)] = count_tokens(chunk)
+            items.append({**item, "text": chunk, "chunk_id": f"{article_id}#{i}"})
+    return items, stats
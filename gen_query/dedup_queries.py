@@ -0,0 +1,213 @@
+import argparse
+import hashlib
+import json
+import operator
+import random
+import time
+import unicodedata
+from array import array
+from pathlib import Path
+from results import dump_records
+
+try:
+    import numpy as np  # 任意 (あれば署名の計算をベクトル化する)
+except ImportError:
+    np = None
+
+# 32bitハッシュより大きい素数
+PRIME = 4294967311
+# 1つのバケットで比較するクラスタ代表の数の上限
+MAX_BUCKET_LEADERS = 32
+
+def normalize(text):
+    """全角・半角や空白の違いを吸収する"""
+    return "".join(unicodedata.normalize("NFKC", text).lower().split())
+
+def shingles(text, n):
+    """文字n-gramの集合 (日本語は空白で単語に分かれないため文字単位で扱う)"""
+    text = normalize(text)
+    if len(text) <= n:
+        return {text}
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+def hash_shingle(shingle):
+    return int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little")
+
+def optimal_bands(threshold, num_perm):
+    """
+    LSHのバンド数bと行数rを選ぶ
+    類似度がthreshold前後で候補になる確率が切り替わるよう、(1/b)^(1/r) がthresholdに最も近いものを使う
+    """
+    best = None
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        error = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+class MinHasher:
+    # numpyが無いときにハッシュ関数を適用した値を覚えておくシングルの数の上限 (1つあたりnum_perm * 8バイト)
+    MAX_CACHED_SHINGLES = 1 << 15
+
+    def __init__(self, num_perm=128, ngram=3, seed=1):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self.ngram = ngram
+        # a*hが64bitに収まるようにaは31bit以下にする
+        self.a = [rng.randrange(1, 1 << 31) for _ in range(num_perm)]
+        self.b = [rng.randrange(0, PRIME) for _ in range(num_perm)]
+        if np is not None:
+            self._a = np.array(self.a, dtype=np.uint64)[:, None]
+            self._b = np.array(self.b, dtype=np.uint64)[:, None]
+        self._permuted = {}
+
+    def permuted(self, h):
+        """シングルのハッシュにnum_perm個のハッシュ関数を適用した値 (クエリ間で共通のシングルは計算し直さない)"""
+        values = self._permuted.get(h)
+        if values is None:
+            if len(self._permuted) >= self.MAX_CACHED_SHINGLES:
+                self._permuted.clear()
+            values = self._permuted[h] = array("Q", [(a * h + b) % PRIME for a, b in zip(self.a, self.b)])
+        return values
+
+    def signature(self, text):
+        hashes = [hash_shingle(s) for s in shingles(text, self.ngram)]
+        if np is not None:
+            values = (self._a * np.array(hashes, dtype=np.uint64)[None, :] + self._b) % PRIME
+            return tuple(values.min(axis=1).tolist())
+        return tuple(map(min, zip(*[self.permuted(h) for h in hashes])))
+
+class UnionFind:
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, x):
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def union(self, x, y):
+        x, y = self.find(x), self.find(y)
+        if x != y:
+            # 代表は入力順で先に出てきたもの
+            self.parent[max(x, y)] = min(x, y)
+
+def estimated_similarity(sig1, sig2):
+    return sum(map(operator.eq, sig1, sig2)) / len(sig1)
+
+def cluster_queries(texts, threshold=0.7, num_perm=128, ngram=3, groups=None, max_leaders=MAX_BUCKET_LEADERS):
+    """
+    MinHash + LSHでほぼ重複したクエリをクラスタリングする
+
+    正規化すると同じになるクエリは署名を計算せずにまとめ、残りを署名のバンドでバケットに分ける
+    同じバケットの候補は、すでに同じクラスタに入っていればそのまま、そうでなければバケット内の
+    クラスタ代表 (最大max_leaders個) とだけ比較する
+    計算量はクエリ数n・署名の長さnum_permに対してO(n * num_perm * (シングル数 + バンド数 * max_leaders))で、
+    似た言い回しのクエリが1つのバケットに大量に集まっても2乗にはならない
+    (署名の計算はnumpyがあればベクトル化し、無ければクエリ間で共通のシングルの値を使い回す)
+    (代表がmax_leaders個を超えたバケットでは、超えた分を新しい代表にしないため、ごく一部の重複を見逃すことがある)
+
+    Args:
+        texts: クエリ文字列のリスト
+        groups: 指定した場合、同じグループ (knowledgeなど) 内のクエリ同士だけを比較する
+        max_leaders: 1つのバケットで比較するクラスタ代表の数の上限
+
+    Returns:
+        各クエリのクラスタ代表のインデックスのリスト
+    """
+    hasher = MinHasher(num_perm, ngram)
+    bands, rows = optimal_bands(threshold, num_perm)
+    uf = UnionFind(len(texts))
+
+    # 正規化後に完全に一致するクエリは同じクラスタにし、署名は最初の1つだけ計算する
+    first_by_text = {}
+    unique = []
+    for i, text in enumerate(texts):
+        key = (groups[i] if groups else None, normalize(text))
+        if key in first_by_text:
+            uf.union(first_by_text[key], i)
+        else:
+            first_by_text[key] = i
+            unique.append(i)
+    signatures = {i: hasher.signature(texts[i]) for i in unique}
+
+    for band in range(bands):
+        buckets = {}
+        for i in unique:
+            key = (groups[i] if groups else None, signatures[i][band * rows:(band + 1) * rows])
+            buckets.setdefault(key, []).append(i)
+        for members in buckets.values():
+            if len(members) < 2:
+                continue
+            # 同じバケットに入った候補だけを、バケット内のクラスタ代表と署名で比較する
+            leaders = []
+            for member in members:
+                root = uf.find(member)
+                for leader in leaders:
+                    # 前のバンドですでに同じクラスタに入っていれば比較しない
+                    if uf.find(leader) == root or estimated_similarity(signatures[leader], signatures[member]) >= threshold:
+                        uf.union(leader, member)
+                        break
+                else:
+                    if len(leaders) < max_leaders:
+                        leaders.append(member)
+    return [uf.find(i) for i in range(len(texts))]
+
+def load_records(filename):
+    with open(filename, 'r', encoding='utf-8') as f:
+        if Path(filename).suffix == '.jsonl':
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+def knowledge_key(record):
+    if "knowledge_id" in record:
+        return record["knowledge_id"]
+    return hashlib.sha256(record["text"].encode("utf-8")).hexdigest()
+
+def main():
+    parser = argparse.ArgumentParser(description='ほぼ重複したクエリを取り除く (MinHash + LSH)')
+    parser.add_argument('input', type=str, nargs='?', default='generated_queries.json')
+    parser.add_argument('output', type=str, nargs='?', default='generated_queries_dedup.json')
+    parser.add_argument('--threshold', type=float, default=0.7, help='重複とみなす類似度 (Jaccard係数の推定値)')
+    parser.add_argument('--num-perm', type=int, default=128)
+    parser.add_argument('--ngram', type=int, default=3)
+    parser.add_argument('--max-bucket-leaders', type=int, default=MAX_BUCKET_LEADERS,
+                        help='LSHの1つのバケットで比較するクラスタ代表の数の上限')
+    parser.add_argument('--per-knowledge', action='store_true', help='同じknowledgeのクエリ同士だけを比較する')
+    parser.add_argument('--clusters', type=str, default=None, help='クラスタの出力先 (JSONL)')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    records = load_records(args.input)
+    groups = [knowledge_key(record) for record in records] if args.per_knowledge else None
+    representatives = cluster_queries([record["query"] for record in records], args.threshold,
+                                      args.num_perm, args.ngram, groups, args.max_bucket_leaders)
+
+    kept = [record for i, record in enumerate(records) if representatives[i] == i]
+    with open(args.output, 'w', encoding='utf-8') as f:
+        dump_records(kept, f, args.output)
+
+    if args.clusters:
+        clusters = {}
+        for i, rep in enumerate(representatives):
+            clusters.setdefault(rep, []).append(i)
+        with open(args.clusters, 'w', encoding='utf-8') as f:
+            for rep, members in clusters.items():
+                if len(members) > 1:
+                    f.write(json.dumps({
+                        "representative": records[rep]["id"],
+                        "queries": [records[i]["query"] for i in members],
+                        "removed": [records[i]["id"] for i in members if i != rep],
+                    }, ensure_ascii=False) + '\n')
+
+    removed = len(records) - len(kept)
+    print(f"{len(records)}個のクエリから{removed}個の重複を削除しました "
+          f"(回答生成の呼び出しを{removed}回削減, {time.time()-start_time:.2f}秒)")
+    print(f"重複を除いたクエリを '{args.output}' に保存しました。")
+
+if __name__ == "__main__":
+    main()
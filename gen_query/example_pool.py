@@ -0,0 +1,128 @@
+import json
+import random
+import sys
+import threading
+import time
+from pathlib import Path
+
+DEFAULT_DATASET_NAME = "Kendamarron/jimba-instuction-1k-beta"
+
+class ExamplePool:
+    """
+    クエリ生成プロンプトに埋め込む例示instructionのプール
+
+    プロセス全体で1度だけ読み込み、複数スレッドから共有して使う
+    """
+
+    def __init__(self, dataset_name=DEFAULT_DATASET_NAME, local_file=None):
+        self.dataset_name = dataset_name
+        self.local_file = local_file
+        self._instructions = None
+        self._lock = threading.Lock()
+        self.load_seconds = 0.0
+        self.sample_seconds = 0.0
+        self.sample_count = 0
+
+    def _load(self):
+        start = time.perf_counter()
+        if self.local_file:
+            instructions = load_instructions_file(self.local_file)
+        else:
+            instructions = load_example_instruction_dataset(self.dataset_name)
+        if not instructions:
+            raise RuntimeError(f"例示が1件もありません ({self.local_file or self.dataset_name})")
+        self.load_seconds = time.perf_counter() - start
+        return instructions
+
+    def instructions(self):
+        # 初回呼び出し時のみロックを取って読み込む
+        # (読み込みに失敗した場合は例外を送出し、空のプールを覚えておかない)
+        if self._instructions is None:
+            with self._lock:
+                if self._instructions is None:
+                    self._instructions = self._load()
+        return self._instructions
+
+    def sample(self, k, seed=None):
+        """
+        k個の例示を取り出す
+        seedを指定した場合は同じseedに対して常に同じ例示を返す
+        """
+        instructions = self.instructions()
+        if len(instructions) < k:
+            # プロンプトは例示をk個提示すると書いているため、足りない場合は続けない
+            raise RuntimeError(f"例示が{len(instructions)}件しかありません ({k}件必要です)")
+        start = time.perf_counter()
+        rng = random.Random(seed) if seed is not None else random
+        examples = rng.sample(instructions, k)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.sample_seconds += elapsed
+            self.sample_count += 1
+        return examples
+
+    def report(self):
+        """読み込み・サンプリングにかかった時間を表示する"""
+        if self._instructions is None:
+            return
+        per_item = self.sample_seconds / self.sample_count if self.sample_count else 0.0
+        print(f"例示プール: {len(self._instructions)}件 読み込み {self.load_seconds:.2f}秒 (1回のみ)")
+        print(f"例示サンプリング: {self.sample_count}回 平均 {per_item*1000:.3f}ミリ秒/件 "
+              f"(削減: 約{self.load_seconds:.2f}秒/件 x {max(self.sample_count - 1, 0)}件)")
+
+def load_example_instruction_dataset(dataset_name=DEFAULT_DATASET_NAME):
+    """Hugging Faceのデータセットからinstructionを読み込む (読み込めなければRuntimeErrorを送出)"""
+    try:
+        from datasets import load_dataset
+        dataset = load_dataset(dataset_name)
+        return [item["instruction"] for item in dataset["train"]]
+    except Exception as e:
+        raise RuntimeError(f"データセット '{dataset_name}' の例示を読み込めませんでした: {e} "
+                           f"(--examplesでローカルの例示ファイルを指定できます)") from e
+
+def load_instructions_file(filename):
+    """ローカルファイル (JSONのリスト / JSONL) からinstructionを読み込む"""
+    with open(filename, 'r', encoding='utf-8') as f:
+        if Path(filename).suffix == '.jsonl':
+            items = [json.loads(line) for line in f if line.strip()]
+        else:
+            items = json.load(f)
+    return [item["instruction"] if isinstance(item, dict) else item for item in items]
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def configure_example_pool(dataset_name=DEFAULT_DATASET_NAME, local_file=None):
+    """プロセス全体で共有する例示プールを設定する"""
+    global _pool
+    with _pool_lock:
+        _pool = ExamplePool(dataset_name, local_file)
+    return _pool
+
+def get_example_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ExamplePool()
+    return _pool
+
+def main():
+    # オフライン実行用に例示をローカルファイルへ書き出す
+    # 使い方: python example_pool.py examples.json [dataset_name]
+    if len(sys.argv) < 2:
+        print("使い方: python example_pool.py 出力ファイル [データセット名]")
+        return
+    output_filename = sys.argv[1]
+    dataset_name = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_DATASET_NAME
+    try:
+        instructions = load_example_instruction_dataset(dataset_name)
+    except RuntimeError as e:
+        print(f"エラー: {e}")
+        return
+    with open(output_filename, 'w', encoding='utf-8') as f:
+        json.dump(instructions, f, ensure_ascii=False, indent=2)
+    print(f"{len(instructions)}件の例示を '{output_filename}' に保存しました。")
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,35 @@
 import json
 import sys
 import os
-import re #正規表現モジュールをインポート
 import uuid
 import random
 from dotenv import load_dotenv
-from openai import OpenAI
+from query_utils import get_client, get_model, get_scheduler, report_backends, load_cached_result, save_cached_result, make_result, plan_generation
 from pathlib import Path
+from async_engine import run_async_generation
+from query_stream import configure_query_stream, stream_enabled, stream_queries, report_stream
+from results import ResultWriter
+from chunking import expand_chunks
+from kirara_common.corpus_store import CorpusStore
+from kirara_common.sharding import Shard, ShardView, select_shard
+from kirara_common.planning import pop_plan_options
+from kirara_common.scheduler import estimate_tokens
+from kirara_common.metrics import record_request, record_cache_hit
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
-from datasets import load_dataset
-
-# キャッシュディレクトリの設定
-CACHE_DIR = Path("cache")
-CACHE_DIR.mkdir(exist_ok=True)
+from example_pool import configure_example_pool, get_example_pool
 
 def load_json_file(input_filename):
+    if Path(input_filename).suffix == '.kcorpus':
+        # kirara_common.corpus_storeで作ったコーパス (全体を読み込まず、記事を必要な時に取り出す)
+        return CorpusStore(input_filename)
     with open(input_filename, 'r', encoding='utf-8') as f:
         try:
-            data_list = json.load(f)
+            if Path(input_filename).suffix == '.jsonl':
+                # wiki.py --stream の出力 (1行1記事)
+                data_list = [json.loads(line) for line in f if line.strip()]
+            else:
+                data_list = json.load(f)
             if not isinstance(data_list, list) or not data_list:
                  print(f"エラー: '{input_filename}' は空か、JSONオブジェクトのリストではありません。リストの最初の要素のみ使用します。")
                  if isinstance(data_list, dict):
@@ -35,19 +46,15 @@ def load_json_file(input_filename):
             return
         return data
 
-def generate_queries(knowledge_text, cache_id=None):
-    # キャッシュチェック
-    if cache_id:
-        cache_file = CACHE_DIR / f"{cache_id}.json"
-        if cache_file.exists():
-            with open(cache_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+# planで例示の長さの平均を取るために作るプロンプトの数
+PLAN_TEMPLATE_SAMPLES = 20
 
-    api_key = os.environ.get("OPENAI_API_KEY")
-    base_url = os.environ.get("OPENAI_BASE_URL")
-    use_model = os.environ.get("OPENAI_USE_MODEL")
-
-    client = OpenAI(base_url=base_url, api_key=api_key)
+def build_user_query_prompt(knowledge_text, cache_id=None, example_seed=None, examples=None):
+    # 例示はプロセス全体で1度だけ読み込んだプールから取り出す
+    # seed指定時はアイテムごとに再現可能なサンプリングを行う
+    if examples is None:
+        seed = f"{example_seed}:{cache_id}" if example_seed is not None else None
+        examples = get_example_pool().sample(3, seed=seed)
 
     user_query_prompt = f"""AIアシスタントに対してユーザーが依頼するであろうクエリを10個ほど作成してください。
 <knowledge>
@@ -57,7 +64,7 @@ def generate_queries(knowledge_text, cache_id=None):
 # 作成してほしいクエリ
 以下に例としてクエリを3つ提示するので、これを参考にしてください
 <example_queries>
-{random.sample(load_example_instruction_dataset(), 3)}
+{examples}
 </example_queries>
 
 これらクエリはひとつひとつを<query>タグで囲んでください。
@@ -67,60 +74,166 @@ def generate_queries(knowledge_text, cache_id=None):
 - クエリには、「この作品」や「この人」といった主語をぼかす表現を使うことは禁止します。
 - 作品名や人名、作中の固有名詞のいずれかは必ずクエリ内で用いてください。また、作品名や人名はかぎかっこで囲わずに記載してください。
 """
-    
+    return user_query_prompt
+
+def generate_queries(knowledge_text, cache_id=None, example_seed=None, on_query=None):
+    # キャッシュチェック
+    if cache_id:
+        cached = load_cached_result(cache_id)
+        if cached is not None:
+            record_cache_hit("gen_query", cache_id)
+            return cached
+
+    user_query_prompt = build_user_query_prompt(knowledge_text, cache_id, example_seed)
+
+    if stream_enabled():
+        # <query>タグを受信しながら取り出し、取り出したものからon_queryに渡す
+        return stream_queries(user_query_prompt, cache_id, on_query)
+
+    timing = {}
     try:
-        response = client.chat.completions.create(
-            model=use_model,
-            messages=[
-                {"role": "user", "content": user_query_prompt}
-            ]
+        # 429やタイムアウトはスケジューラーがバックオフして再試行する
+        response = get_scheduler().call(
+            lambda: get_client().chat.completions.create(
+                model=get_model(),
+                messages=[
+                    {"role": "user", "content": user_query_prompt}
+                ]
+            ),
+            estimated_tokens=estimate_tokens(user_query_prompt),
+            timing=timing,
         )
         generated_text = response.choices[0].message.content
     except Exception as e:
         print(f"エラー: OpenAI API呼び出し中にエラーが発生しました: {e}")
+        record_request("gen_query", cache_id, get_model(), timing=timing, status="error")
         return
-    
-    queries = re.findall(r'<query>(.*?)</query>', generated_text, re.DOTALL)
-    
-    result = {
-        "queries": queries, 
-        "user_query_prompt": user_query_prompt, 
-        "generated_text": generated_text
-    }
-    
+
+    result = make_result(user_query_prompt, generated_text)
+    record_request("gen_query", cache_id, get_model(), response, timing,
+                   status="ok" if result["queries"] else "parse_failure", queries=len(result["queries"]))
+
     # キャッシュ保存
     if cache_id:
-        with open(cache_file, 'w', encoding='utf-8') as f:
-            json.dump(result, f, ensure_ascii=False)
-    
-    return result
+        save_cached_result(cache_id, result)
 
-def process_item(item, cache_id):
-    return generate_queries(item["text"], cache_id)
+    return result
 
-def load_example_instruction_dataset(dataset_name="Kendamarron/jimba-instuction-1k-beta"):
-    """Hugging Faceのデータセットからinstructionを読み込む"""
-    try:
-        dataset = load_dataset(dataset_name)
-        instructions = [item["instruction"] for item in dataset["train"]]
-        return instructions
-    except Exception as e:
-        print(f"エラー: データセットの読み込み中にエラーが発生しました: {e}")
-        return []
+def process_item(item, cache_id, example_seed=None, on_query=None):
+    return generate_queries(item["text"], cache_id, example_seed, on_query)
 
 def main():
     load_dotenv(override=True)
     args = sys.argv[1:]  
     
+    # plan: APIを呼ばずに、処理するアイテム数・入力トークン数・料金・時間の見積もりだけを表示する
+    plan_mode = args[:1] == ['plan']
+    plan_options = {}
+    if plan_mode:
+        del args[0]
+        plan_options = pop_plan_options(args)
+
     # 新しいオプションを解析
     single_mode = False
     if '--single' in args:
         single_mode = True
         args.remove('--single')
+
+    # 前回中断した実行の進捗ジャーナルから再開する
+    resume = False
+    if '--resume' in args:
+        resume = True
+        args.remove('--resume')
+
+    # asyncioエンジンを使う (共有クライアント + 同時実行数の上限)
+    async_mode = False
+    if '--async' in args:
+        async_mode = True
+        args.remove('--async')
+
+    # compact形式: knowledgeテキストを別ファイルに1度だけ保存し、IDで参照する
+    knowledge_filename = None
+    if '--compact' in args:
+        i = args.index('--compact')
+        knowledge_filename = args[i + 1]
+        del args[i:i + 2]
+
+    # 上限トークン数を超える記事を節単位のチャンクに分割する (0で無効)
+    max_chunk_tokens = 0
+    if '--max-chunk-tokens' in args:
+        i = args.index('--max-chunk-tokens')
+        max_chunk_tokens = int(args[i + 1])
+        del args[i:i + 2]
+
+    # 応答をストリーミングで受け取り、<query>タグを受信しながら取り出す
+    stream_mode = False
+    if '--stream-queries' in args:
+        stream_mode = True
+        args.remove('--stream-queries')
+
+    # --stream-queries時に、このクエリ数を受け取った時点で生成を打ち切る
+    max_queries = None
+    if '--max-queries' in args:
+        i = args.index('--max-queries')
+        max_queries = int(args[i + 1])
+        del args[i:i + 2]
+
+    # 複数のマシンで分担する: 内容ハッシュがこのシャードに入る記事だけを処理し、シャードごとのファイルに出力する
+    shard = None
+    if '--shard' in args:
+        i = args.index('--shard')
+        try:
+            shard = Shard.parse(args[i + 1])
+        except ValueError as e:
+            print(f"エラー: {e}")
+            return
+        del args[i:i + 2]
+
+    concurrency = 5
+    if '--concurrency' in args:
+        i = args.index('--concurrency')
+        concurrency = int(args[i + 1])
+        del args[i:i + 2]
+
+    # 例示をローカルファイルから読み込む (オフライン実行用)
+    examples_filename = None
+    if '--examples' in args:
+        i = args.index('--examples')
+        examples_filename = args[i + 1]
+        del args[i:i + 2]
+
+    # 例示サンプリングのseed (指定時はアイテムごとに再現可能)
+    example_seed = None
+    if '--seed' in args:
+        i = args.index('--seed')
+        example_seed = args[i + 1]
+        del args[i:i + 2]
+
+    example_pool = configure_example_pool(local_file=examples_filename)
+    if examples_filename or not plan_mode:
+        # 例示を読み込めない場合は、例示の無いプロンプトで全件を生成せずにここで止める
+        try:
+            example_pool.instructions()
+        except RuntimeError as e:
+            print(f"エラー: {e}")
+            return
+        except (OSError, ValueError, KeyError) as e:
+            print(f"エラー: 例示ファイル '{examples_filename}' を読み込めませんでした: {e}")
+            return
+    if stream_mode:
+        configure_query_stream(max_queries=max_queries)
+    elif max_queries:
+        print("エラー: --max-queriesは--stream-queriesと一緒に指定してください。")
+        return
     
     input_filename = args[0] if args else 'wiki.json'
     output_filename = args[1] if len(args) > 1 else 'generated_queries.json'
     text_and_prompt_filename = args[2] if len(args) > 2 else 'text_and_prompt.json'
+    if shard:
+        output_filename = shard.filename(output_filename)
+        text_and_prompt_filename = shard.filename(text_and_prompt_filename)
+        if knowledge_filename:
+            knowledge_filename = shard.filename(knowledge_filename)
 
     input_file_path = Path(input_filename)
     if not input_file_path.exists():
@@ -133,70 +246,90 @@ def main():
     
     # singleモードの場合、ランダムなアイテム1つを処理
     if single_mode:
-        data = [random.choice(data)] if isinstance(data, list) else [data]
+        data = [random.choice(data)] if not isinstance(data, dict) else [data]
         print(f"単一knowledgeモードで実行します。ランダムに選択されたknowledgeを処理します。")
         print(f"選択されたknowledge: {data[0]['text'][:100]}...")
 
+    if shard:
+        total_items = len(data)
+        data = select_shard(data, shard)
+        print(f"シャード {shard}: {total_items}件中{len(data)}件の記事を処理します")
+
+    corpus = data.data if isinstance(data, ShardView) else data
+    token_count = None
+    if isinstance(corpus, CorpusStore):
+        # シャードの場合は元のコーパスでのインデックスに直して引く
+        token_count = corpus.known_token_count if corpus is data else (
+            lambda index, view=data: corpus.known_token_count(view.indices[index]))
+
+    if plan_mode:
+        if examples_filename:
+            # 例示はアイテムごとに違うため、いくつか作ったプロンプトの平均で数える
+            templates = [build_user_query_prompt("", str(i), "plan") for i in range(PLAN_TEMPLATE_SAMPLES)]
+            notes = []
+        else:
+            # データセットの読み込みは重いため、--examplesが無ければ例示を数えない
+            templates = [build_user_query_prompt("", examples=[])]
+            notes = ["入力トークンには例示の分を含みません (--examplesでローカルの例示を指定すると含めます)"]
+        plan_generation(data, templates, output_filename, resume, concurrency, max_chunk_tokens, token_count,
+                        plan_options, notes)
+        return
+
+    if max_chunk_tokens:
+        data, chunk_stats = expand_chunks(data, max_chunk_tokens, token_count)
+
     # 並列処理
     start_time = time.time()
-    processed_items = []
     skipped_items = 0
 
-    max_workers = 5
+    # 完了したアイテムから順に書き出し、最後に入力順に並べて保存する
+    cache_ids = [str(uuid.uuid5(uuid.NAMESPACE_URL, item["text"])) for item in data]
+    writer = ResultWriter(output_filename, text_and_prompt_filename, knowledge_filename,
+                          resume=resume, cache_ids=cache_ids)
+    # ジャーナルに記録済みのアイテムはキャッシュも読まずにスキップする
+    completed = writer.completed()
+    pending_indices = [index for index in range(len(data)) if index not in completed]
+
+    max_workers = concurrency
     if(single_mode):
         max_workers = 1
-    
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = []
-        for item in data:
-            cache_id = str(uuid.uuid5(uuid.NAMESPACE_URL, item["text"]))
-            futures.append(executor.submit(process_item, item, cache_id))
-        
-        for i, future in enumerate(as_completed(futures)):
-            try:
-                result = future.result()
-                if result:
-                    # 元のアイテムのインデックスを保持
-                    original_index = futures.index(future)
-                    processed_items.append({
-                        "result": result,
-                        "original_index": original_index
-                    })
-                    print(f"処理済み: {original_index+1}/{len(data)}")
-                else:
-                    skipped_items += 1
-            except Exception as e:
-                print(f"エラー: アイテム処理中にエラーが発生しました: {e}")
-    
-    # 結果を結合
-    all_queries = []
-    text_and_prompt = []
-    
-    for item in processed_items:
-        result = item["result"]
-        original_index = item["original_index"]
-        
-        for query in result["queries"]:
-            all_queries.append({
-                "id": str(uuid.uuid4()),
-                "text": data[original_index]["text"],
-                "query": query
-            })
-        
-        text_and_prompt.append({
-            "text": data[original_index]["text"],
-            "user_query_prompt": result["user_query_prompt"],
-            "generated_text": result["generated_text"]
-        })
-    
+
+    if async_mode:
+        skipped_items = run_async_generation(
+            data, cache_ids, pending_indices,
+            lambda item, cache_id: build_user_query_prompt(item["text"], cache_id, example_seed),
+            lambda index, result: writer.add(index, data[index], result, cache_ids[index]),
+            concurrency=max_workers)
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # アイテムはワーカーで取り出す (.kcorpusでは未処理の記事の本文をメモリに溜めない)
+            futures = {
+                executor.submit(lambda index: process_item(data[index], cache_ids[index], example_seed), index): index
+                for index in pending_indices
+            }
+
+            for future in as_completed(futures):
+                original_index = futures[future]
+                try:
+                    result = future.result()
+                    if result:
+                        writer.add(original_index, data[original_index], result, cache_ids[original_index])
+                        print(f"処理済み: {original_index+1}/{len(data)}")
+                    else:
+                        skipped_items += 1
+                except Exception as e:
+                    print(f"エラー: アイテム処理中にエラーが発生しました: {e}")
+
     # 保存
-    with open(output_filename, 'w', encoding='utf-8') as f:
-        json.dump(all_queries, f, ensure_ascii=False, indent=2)
-    with open(text_and_prompt_filename, 'w', encoding='utf-8') as f:
-        json.dump(text_and_prompt, f, ensure_ascii=False, indent=2)
-    
-    print(f"\n完了! {len(all_queries)}個のクエリを生成しました (スキップ: {skipped_items})")
+    writer.finalize()
+
+    print(f"\n完了! {writer.num_queries}個のクエリを生成しました (スキップ: {skipped_items})")
     print(f"所要時間: {time.time()-start_time:.2f}秒")
+    report_backends()
+    report_stream()
+    if max_chunk_tokens:
+        chunk_stats.report(writer.query_counts)
+    example_pool.report()
     print(f"生成されたクエリを '{output_filename}' に保存しました。")
     print(f"生成されたtext_and_promptを '{text_and_prompt_filename}' に保存しました。")
 
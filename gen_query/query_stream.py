@@ -0,0 +1,266 @@
+"""
+クエリ生成のストリーミングモード
+
+応答をストリーミングで受け取りながら<query>タグを取り出し、取り出したクエリから順に呼び出し元へ渡す
+目標のクエリ数に達したとき、または出力が形式から外れたとき (タグの外の文章が続く・タグが閉じない) は
+ストリームを閉じて生成を打ち切り、それ以降の出力トークンの料金と待ち時間を払わない
+"""
+import threading
+import time
+from kirara_common.metrics import record_request, usage_fields
+from kirara_common.scheduler import estimate_tokens
+from query_utils import get_client, get_model, get_scheduler, save_cached_result, make_result
+
+OPEN_TAG = "<query>"
+CLOSE_TAG = "</query>"
+# 最初のクエリより前に許す文字数 (「以下のクエリを作成しました」などの前置き)
+MAX_PREAMBLE_CHARS = 400
+# クエリとクエリの間に許す文字数 (空白を除く。見出しや番号など)
+MAX_GAP_CHARS = 120
+# 1つのクエリの最大文字数 (超えたらタグが閉じないとみなす)
+MAX_QUERY_CHARS = 1000
+
+_enabled = False
+_max_queries = None
+_stats = None
+
+def configure_query_stream(enabled=True, max_queries=None):
+    """
+    プロセス全体のストリーミングモードを設定する
+
+    max_queriesを指定すると、その数のクエリを受け取った時点で生成を打ち切る
+    """
+    global _enabled, _max_queries, _stats
+    _enabled = enabled
+    _max_queries = max_queries or None
+    _stats = StreamStats() if enabled else None
+
+def stream_enabled():
+    return _enabled
+
+class QueryStreamParser:
+    """
+    受信したテキストから<query>タグを順に取り出す
+
+    取り出すクエリは全文に re.findall(r'<query>(.*?)</query>', text, re.DOTALL) を
+    適用した結果と同じになる (text()は打ち切った位置までのテキスト)
+    """
+
+    def __init__(self, max_queries=None):
+        self.max_queries = max_queries
+        self.queries = []
+        # target: 目標数に達した / format: 形式から外れた / None: 最後まで受信した
+        self.stop_reason = None
+        self._parts = []
+        self._pending = ""
+        self._consumed = 0
+
+    def feed(self, delta):
+        """受信したテキストを追加し、新しく閉じたクエリのリストを返す"""
+        if self.stop_reason:
+            return []
+        self._parts.append(delta)
+        self._pending += delta
+        new_queries = []
+        while True:
+            limit = MAX_GAP_CHARS if self.queries else MAX_PREAMBLE_CHARS
+            start = self._pending.find(OPEN_TAG)
+            if start < 0:
+                # 末尾はタグの途中 ("<que" など) かもしれないので、その分は数えない
+                if len(self._pending[:len(self._pending) - len(OPEN_TAG) + 1].strip()) > limit:
+                    self.stop_reason = "format"
+                break
+            if len(self._pending[:start].strip()) > limit:
+                self.stop_reason = "format"
+                break
+            end = self._pending.find(CLOSE_TAG, start + len(OPEN_TAG))
+            if end < 0:
+                if len(self._pending) - start - len(OPEN_TAG) > MAX_QUERY_CHARS + len(CLOSE_TAG):
+                    self.stop_reason = "format"
+                break
+            query = self._pending[start + len(OPEN_TAG):end]
+            self.queries.append(query)
+            new_queries.append(query)
+            self._consumed += end + len(CLOSE_TAG)
+            self._pending = self._pending[end + len(CLOSE_TAG):]
+            if self.max_queries and len(self.queries) >= self.max_queries:
+                self.stop_reason = "target"
+                break
+        return new_queries
+
+    def received_text(self):
+        return "".join(self._parts)
+
+    def text(self):
+        """受信したテキスト (目標数で打ち切った場合は最後のクエリの閉じタグまで)"""
+        text = self.received_text()
+        return text[:self._consumed] if self.stop_reason == "target" else text
+
+class StreamStats:
+    """ストリーミングしたリクエストの最初のクエリまでの時間 (TTFQ) と打ち切りの集計"""
+
+    def __init__(self):
+        self.requests = 0
+        self.stops = {"target": 0, "format": 0}
+        self.ttfq = []
+        self.received_tokens = []
+        # 最後まで生成された応答の出力トークン数 (打ち切らなかった場合の長さの推定に使う)
+        self.full_tokens = []
+        self._lock = threading.Lock()
+
+    def add(self, stop_reason, ttfq, completion_tokens):
+        with self._lock:
+            self.requests += 1
+            if ttfq is not None:
+                self.ttfq.append(ttfq)
+            if stop_reason:
+                self.stops[stop_reason] += 1
+                self.received_tokens.append(completion_tokens)
+            else:
+                self.full_tokens.append(completion_tokens)
+
+    def tokens_saved(self):
+        """打ち切りで生成しなかった出力トークン数の推定値 (最後まで生成された応答が無ければNone)"""
+        if not self.full_tokens:
+            return None
+        average = sum(self.full_tokens) / len(self.full_tokens)
+        return sum(max(0.0, average - tokens) for tokens in self.received_tokens)
+
+    def report(self):
+        if not self.requests:
+            return
+        ttfq = sorted(self.ttfq)
+        p50 = ttfq[len(ttfq) // 2] if ttfq else 0.0
+        p95 = ttfq[min(len(ttfq) - 1, int(len(ttfq) * 0.95))] if ttfq else 0.0
+        print(f"ストリーミング: {self.requests}件  最初のクエリまで p50 {p50:.2f}秒  p95 {p95:.2f}秒  "
+              f"打ち切り: 目標数 {self.stops['target']}件 / 形式外れ {self.stops['format']}件")
+        saved = self.tokens_saved()
+        if saved is None:
+            if self.received_tokens:
+                print("節約した出力トークン数: 最後まで生成された応答が無いため推定できません")
+        else:
+            print(f"節約した出力トークン数 (推定): {saved:.0f} "
+                  f"(最後まで生成された{len(self.full_tokens)}件の平均 {sum(self.full_tokens)/len(self.full_tokens):.0f}トークンとの差)")
+
+def report_stream():
+    """ストリーミングモードで実行した場合は集計を表示する"""
+    if _stats:
+        _stats.report()
+
+class _QueryStream:
+    """1回のストリーミングリクエストの受信状態"""
+
+    def __init__(self, prompt, on_query):
+        self.prompt = prompt
+        self.on_query = on_query
+        self.parser = QueryStreamParser(_max_queries)
+        self.usage = None
+        self.first_query_at = None
+        self.started = time.perf_counter()
+
+    def request_kwargs(self):
+        return {
+            "model": get_model(),
+            "messages": [{"role": "user", "content": self.prompt}],
+            "stream": True,
+            # 最後まで受信した場合は最後のチャンクで実際のトークン数を受け取る
+            "stream_options": {"include_usage": True},
+        }
+
+    def add(self, chunk):
+        """チャンクを処理し、受信を続ける場合はTrueを返す"""
+        if getattr(chunk, "usage", None):
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return True
+        delta = chunk.choices[0].delta.content
+        if delta:
+            for query in self.parser.feed(delta):
+                if self.first_query_at is None:
+                    self.first_query_at = time.perf_counter()
+                if self.on_query:
+                    self.on_query(query)
+        return self.parser.stop_reason is None
+
+    def finish(self, cache_id, timing, error=None, extra_wait=0.0):
+        """
+        メトリクスを記録し、結果を返す (エラーの場合はNone)
+        最後まで受信した場合だけキャッシュに保存する
+        extra_waitはスケジューラーの外での待ち時間 (asyncモードのセマフォ)
+        """
+        request_start = self.started + timing.get("queue_wait", 0.0)
+        timing["queue_wait"] = timing.get("queue_wait", 0.0) + extra_wait
+        if error:
+            print(f"エラー: OpenAI API呼び出し中にエラーが発生しました: {error}")
+            record_request("gen_query", cache_id, get_model(), timing=timing, status="error")
+            return
+
+        # APIレイテンシは最後に受信した (または打ち切った) 時点まで
+        timing["latency"] = time.perf_counter() - request_start
+        ttfq = self.first_query_at - request_start if self.first_query_at else None
+
+        text = self.parser.text()
+        result = make_result(self.prompt, text)
+        stop_reason = self.parser.stop_reason
+        # 打ち切った場合はusageが届かないので、送信・受信したテキストから概算する
+        usage = self.usage or {"prompt_tokens": estimate_tokens(self.prompt),
+                               "completion_tokens": estimate_tokens(self.parser.received_text())}
+        tokens = usage_fields(usage)
+        _stats.add(stop_reason, ttfq, tokens["completion_tokens"])
+        record_request("gen_query", cache_id, get_model(), None, timing,
+                       status="ok" if result["queries"] else "parse_failure", queries=len(result["queries"]),
+                       stream=True, stream_stop=stop_reason, ttfq=ttfq, **tokens)
+        # 打ち切った結果は最後まで生成した結果と同じキーで保存すると、ストリーミングしない実行や
+        # --resumeで完全な結果として読み込まれてしまうため、最後まで受信した場合だけ保存する
+        if cache_id and stop_reason is None:
+            save_cached_result(cache_id, result)
+        return result
+
+def stream_queries(user_query_prompt, cache_id=None, on_query=None):
+    """
+    ストリーミングでクエリを生成する (キャッシュの確認は呼び出し元で行う)
+
+    on_queryは<query>タグが閉じるたびにそのクエリで呼ばれる
+    """
+    stream = _QueryStream(user_query_prompt, on_query)
+    timing = {}
+    try:
+        # 429やタイムアウトはスケジューラーがバックオフして再試行する (受信を始めた後の切断は再試行しない)
+        response = get_scheduler().call(
+            lambda: get_client().chat.completions.create(**stream.request_kwargs()),
+            estimated_tokens=estimate_tokens(user_query_prompt),
+            timing=timing,
+        )
+        try:
+            for chunk in response:
+                if not stream.add(chunk):
+                    break
+        finally:
+            # 途中で抜けた場合は接続を閉じ、サーバーに生成を止めさせる
+            response.close()
+    except Exception as e:
+        return stream.finish(cache_id, timing, e)
+    return stream.finish(cache_id, timing)
+
+async def astream_queries(client, user_query_prompt, cache_id=None, on_query=None, extra_wait=0.0):
+    """
+    stream_queries()の非同期版 (clientは共有のAsyncOpenAIクライアント)
+    extra_waitはセマフォの待ち時間 (メトリクスの待ち時間に含める)
+    """
+    stream = _QueryStream(user_query_prompt, on_query)
+    timing = {}
+    try:
+        response = await get_scheduler().acall(
+            lambda: client.chat.completions.create(**stream.request_kwargs()),
+            estimated_tokens=estimate_tokens(user_query_prompt),
+            timing=timing,
+        )
+        try:
+            async for chunk in response:
+                if not stream.add(chunk):
+                    break
+        finally:
+            await response.close()
+    except Exception as e:
+        return stream.finish(cache_id, timing, e, extra_wait)
+    return stream.finish(cache_id, timing, extra_wait=extra_wait)
@@ -0,0 +1,122 @@
+import os
+import re
+import threading
+from pathlib import Path
+from kirara_common.scheduler import RequestScheduler
+from kirara_common.cache_store import open_cache
+from kirara_common.backend_pool import get_pool
+
+# キャッシュの設定 (CACHE_BACKEND=sqliteで単一ファイルのキャッシュを使う)
+CACHE_DIR = Path("cache")
+CACHE_NAMESPACE = "gen_query"
+
+_client = None
+_scheduler = None
+_cache = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """
+    プロセス全体で共有するOpenAIクライアント (接続プールを使い回す)
+    OPENAI_BACKENDSを設定している場合は複数のバックエンドに振り分けるBackendPool
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                # openaiの読み込みは重いため、最初のリクエストで読み込む
+                from openai import OpenAI
+                _client = get_pool() or OpenAI(
+                    base_url=os.environ.get("OPENAI_BASE_URL"),
+                    api_key=os.environ.get("OPENAI_API_KEY"),
+                    # 再試行はRequestSchedulerで行う
+                    max_retries=0,
+                )
+    return _client
+
+def get_scheduler():
+    """プロセス全体で共有するRequestScheduler (流量制限と再試行)"""
+    global _scheduler
+    if _scheduler is None:
+        with _client_lock:
+            if _scheduler is None:
+                _scheduler = RequestScheduler.from_env()
+    return _scheduler
+
+def report_backends():
+    """バックエンドプールを使っている場合は、バックエンドごとの集計を表示する"""
+    pool = get_pool()
+    if pool:
+        pool.report()
+
+def get_model():
+    return os.environ.get("OPENAI_USE_MODEL")
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _client_lock:
+            if _cache is None:
+                _cache = open_cache(CACHE_NAMESPACE, CACHE_DIR, ".json")
+    return _cache
+
+def load_cached_result(cache_id):
+    return get_cache().get(cache_id)
+
+def save_cached_result(cache_id, result):
+    get_cache().put(cache_id, result)
+
+def make_result(user_query_prompt, generated_text):
+    queries = re.findall(r'<query>(.*?)</query>', generated_text, re.DOTALL)
+    return {
+        "queries": queries,
+        "user_query_prompt": user_query_prompt,
+        "generated_text": generated_text
+    }
+
+def plan_generation(data, templates, output_filename, resume=False, concurrency=5, max_chunk_tokens=0,
+                    token_count=None, options=None, notes=()):
+    """
+    APIを呼ばずに、処理するアイテム数・入力トークン数・料金・時間を見積もって表示する (plan サブコマンド)
+
+    templates: knowledgeを空にしたプロンプト (例示が変わる場合は複数渡すと平均を使う)
+    token_count: 記事のインデックスから数え済みのトークン数 (無ければNone) を返す関数 (.kcorpus)
+    """
+    import uuid
+    from chunking import expand_chunks
+    from kirara_common.planning import WorkPlan, count_tokens_many, iter_journal
+
+    plan = WorkPlan(CACHE_NAMESPACE, get_model())
+    plan.notes.extend(notes)
+    # 記事のトークン数をまとめて並列に数え、チャンク分割でもそれを使う
+    texts = [item["text"] for item in data]
+    known = [token_count(index) if token_count else None for index in range(len(texts))]
+    counts = count_tokens_many(text for text, tokens in zip(texts, known) if tokens is None)
+    article_tokens = [counts[text] if tokens is None else tokens for text, tokens in zip(texts, known)]
+    if max_chunk_tokens:
+        items, chunk_stats = expand_chunks(data, max_chunk_tokens, article_tokens.__getitem__)
+        texts = [item["text"] for item in items]
+        item_tokens = [chunk_stats.chunk_tokens[index] for index in range(len(items))]
+        plan.notes.append(f"チャンク分割: {chunk_stats.chunked_articles}/{chunk_stats.articles}件の記事を"
+                          f"{chunk_stats.chunks}個のチャンクに分割")
+    else:
+        item_tokens = article_tokens
+    plan.total = len(texts)
+
+    cache_ids = [str(uuid.uuid5(uuid.NAMESPACE_URL, text)) for text in texts]
+    done = set()
+    if resume:
+        done = {part["index"] for part in iter_journal(f"{output_filename}.journal.jsonl")
+                if part["index"] < len(cache_ids) and cache_ids[part["index"]] == part.get("cache_id")}
+        plan.skip("完了済み (ジャーナル)", len(done))
+    unfinished = [index for index in range(len(texts)) if index not in done]
+    cached = get_cache().existing(cache_ids[index] for index in unfinished)
+    pending = [index for index in unfinished if cache_ids[index] not in cached]
+    plan.skip("キャッシュ済み", len(unfinished) - len(pending))
+    plan.pending_items = len(pending)
+
+    template_tokens = count_tokens_many(templates)
+    overhead = round(sum(template_tokens[template] for template in templates) / len(templates))
+    plan.count_prompts(overhead, [(texts[index],) for index in pending],
+                       known_tokens={texts[index]: item_tokens[index] for index in pending})
+    plan.report(concurrency, **(options or {}))
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+from pathlib import Path
+
+def knowledge_id(text):
+    """knowledgeテキストの内容ハッシュ (compact形式でレコードから参照するID)"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def make_query_id(cache_id, position, query):
+    """
+    内容から決まるクエリID (knowledgeのキャッシュID・アイテム内の位置・クエリ本文から導出)
+    再実行しても同じクエリには同じIDが付くため、gen_answerのキャッシュがそのまま使える
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{cache_id}:{position}:{query}"))
+
+def make_query_records(cache_id, result, knowledge_ref):
+    """生成結果からクエリのレコードを作る (knowledge_refはtextまたはknowledge_id、chunk_id)"""
+    return [
+        {
+            "id": make_query_id(cache_id, position, query),
+            **knowledge_ref,
+            "query": query
+        }
+        for position, query in enumerate(result["queries"])
+    ]
+
+def dump_json_array(records, f, indent=2):
+    """json.dump(list, f, indent=2)と同じ形式で、レコードを1件ずつ書き出す"""
+    first = True
+    for record in records:
+        text = json.dumps(record, ensure_ascii=False, indent=indent)
+        text = "\n".join(" " * indent + line for line in text.split("\n"))
+        f.write("[\n" if first else ",\n")
+        f.write(text)
+        first = False
+    f.write("[]" if first else "\n]")
+
+def dump_records(records, f, filename):
+    """拡張子が.jsonlなら1行1レコード、それ以外はJSON配列で書き出す"""
+    if Path(filename).suffix == '.jsonl':
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    else:
+        dump_json_array(records, f)
+
+class ResultWriter:
+    """
+    完了したアイテムの結果を到着順に進捗ジャーナル (追記のみのJSONL) へ書き込み、
+    最後に入力順 (アイテムのインデックス順) で出力ファイルを組み立てる
+    出力ファイル名の拡張子が.jsonlならJSONL、それ以外はJSON配列で書き出す
+
+    メモリには各アイテムのジャーナル内の位置だけを保持する
+    途中で異常終了してもジャーナルに完了済みの結果が残り、
+    resume=Trueで開くとそれを読み込んで続きから処理できる
+
+    knowledge_filenameを指定するとcompact形式になり、knowledgeテキストは
+    knowledge_filename (JSONL) に1度だけ書き出され、各レコードはknowledge_idで参照する
+    """
+
+    def __init__(self, output_filename, text_and_prompt_filename, knowledge_filename=None,
+                 resume=False, cache_ids=None):
+        self.output_filename = output_filename
+        self.text_and_prompt_filename = text_and_prompt_filename
+        self.knowledge_filename = knowledge_filename
+        self._knowledge = None
+        self._knowledge_ids = set()
+        if knowledge_filename:
+            # 既存のknowledgeテーブルには追記する (IDだけを読み込む)
+            if os.path.exists(knowledge_filename):
+                with open(knowledge_filename, 'r', encoding='utf-8') as f:
+                    self._knowledge_ids = {json.loads(line)["id"] for line in f if line.strip()}
+            self._knowledge = open(knowledge_filename, 'a', encoding='utf-8')
+        self.journal_filename = f"{output_filename}.journal.jsonl"
+        self._offsets = {}
+        self._lock = threading.Lock()
+        self.num_queries = 0
+        self.query_counts = {}
+        if resume and os.path.exists(self.journal_filename):
+            self._journal = open(self.journal_filename, 'r+b')
+            self._load_journal(cache_ids)
+        else:
+            self._journal = open(self.journal_filename, 'w+b')
+
+    def _load_journal(self, cache_ids):
+        """
+        既存のジャーナルから完了済みのアイテムを読み込む
+        入力が変わってキャッシュIDが一致しないアイテムは無視し、
+        異常終了で途中まで書かれた最後の行は切り捨てる
+        """
+        offset = 0
+        for line in self._journal:
+            try:
+                part = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            index = part["index"]
+            if cache_ids is None or (index < len(cache_ids) and cache_ids[index] == part.get("cache_id")):
+                self._offsets[index] = (offset, len(line))
+                self.num_queries += len(part["queries"])
+                self.query_counts[index] = len(part["queries"])
+            offset += len(line)
+        self._journal.truncate(offset)
+        print(f"進捗ジャーナルから{len(self._offsets)}件の完了済みアイテムを読み込みました")
+
+    def completed(self):
+        """ジャーナルに記録済みのアイテムのインデックス (呼ぶたびに集合を作るため、ループの外で1度だけ呼ぶ)"""
+        return set(self._offsets)
+
+    def add(self, index, item, result, cache_id):
+        """index番目のアイテムの結果を書き出す (複数スレッドから呼び出してよい)"""
+        if self._knowledge:
+            doc_id = knowledge_id(item["text"])
+            knowledge_ref = {"knowledge_id": doc_id}
+        else:
+            knowledge_ref = {"text": item["text"]}
+        # チャンク分割された記事では、どのチャンクから生成したクエリかを記録する
+        if "chunk_id" in item:
+            knowledge_ref["chunk_id"] = item["chunk_id"]
+        part = {
+            "index": index,
+            "cache_id": cache_id,
+            "queries": make_query_records(cache_id, result, knowledge_ref),
+            "text_and_prompt": {
+                **knowledge_ref,
+                "user_query_prompt": result["user_query_prompt"],
+                "generated_text": result["generated_text"]
+            },
+        }
+        line = (json.dumps(part, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            if self._knowledge and doc_id not in self._knowledge_ids:
+                self._knowledge.write(json.dumps({"id": doc_id, "text": item["text"]}, ensure_ascii=False) + "\n")
+                self._knowledge.flush()
+                self._knowledge_ids.add(doc_id)
+            self._journal.seek(0, os.SEEK_END)
+            offset = self._journal.tell()
+            self._journal.write(line)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._offsets[index] = (offset, len(line))
+            self.num_queries += len(part["queries"])
+            self.query_counts[index] = len(part["queries"])
+
+    def _iter_journal(self):
+        for index in sorted(self._offsets):
+            offset, length = self._offsets[index]
+            self._journal.seek(offset)
+            yield json.loads(self._journal.read(length))
+
+    def finalize(self):
+        """入力順で出力ファイルを書き出し、ジャーナルを削除する"""
+        with self._lock:
+            with open(self.output_filename, 'w', encoding='utf-8') as f:
+                dump_records(
+                    (query for part in self._iter_journal() for query in part["queries"]), f, self.output_filename)
+            with open(self.text_and_prompt_filename, 'w', encoding='utf-8') as f:
+                dump_records((part["text_and_prompt"] for part in self._iter_journal()), f,
+                             self.text_and_prompt_filename)
+            self._journal.close()
+            os.remove(self.journal_filename)
+            if self._knowledge:
+                self._knowledge.close()
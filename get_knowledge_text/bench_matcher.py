@@ -0,0 +1,81 @@
+import argparse
+import json
+import time
+from itertools import islice
+from matcher import KeywordMatcher
+
+def load_sample_texts(sample_file, num_articles):
+    """ベンチマーク用の日本語テキストを読み込む (ファイル指定がなければデータセットから先頭N件)"""
+    if sample_file:
+        with open(sample_file, 'r', encoding='utf-8') as f:
+            if sample_file.endswith('.jsonl'):
+                articles = [json.loads(line) for line in islice(f, num_articles)]
+            else:
+                articles = json.load(f)[:num_articles]
+        return [article['text'] for article in articles]
+
+    from datasets import load_dataset
+    dataset = load_dataset('wikimedia/wikipedia', '20231101.ja', split='train', streaming=True)
+    return [article['text'] for article in islice(dataset, num_articles)]
+
+def legacy_matches(text, keywords_and, keywords_or, keywords_not):
+    """従来のwiki.pyと同じ、キーワードごとに本文を走査する判定"""
+    return (all(keyword in text for keyword in keywords_and)
+            and all(any(keyword in text for keyword in group) for group in keywords_or)
+            and not any(keyword in text for keyword in keywords_not))
+
+def measure(func, texts, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = [func(text) for text in texts]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sample', type=str, default=None, help='サンプル記事ファイル (wiki.json / wiki.jsonl)')
+    parser.add_argument('--num-articles', type=int, default=2000)
+    parser.add_argument('--keywords', type=str, default='keywords.json')
+    parser.add_argument('--extra-keywords', type=int, default=0,
+                        help='orグループに追加するダミーのカテゴリ文字列の数 (キーワード数に対するスケーリング確認用)')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with open(args.keywords, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    keywords_and = config.get('and', [])
+    keywords_or = config.get('or', [])
+    if keywords_or and isinstance(keywords_or[0], str):
+        keywords_or = [keywords_or]
+    keywords_not = config.get('not', [])
+    if args.extra_keywords:
+        keywords_or = [keywords_or[0] + [f"まんがタイム{i}号の4コマ漫画作品" for i in range(args.extra_keywords)]] + keywords_or[1:]
+
+    texts = load_sample_texts(args.sample, args.num_articles)
+    total_chars = sum(len(text) for text in texts)
+    num_keywords = len(keywords_and) + sum(len(group) for group in keywords_or) + len(keywords_not)
+    print(f"記事数: {len(texts)}  文字数: {total_chars}  キーワード数: {num_keywords}")
+
+    legacy_time, legacy_result = measure(
+        lambda text: legacy_matches(text, keywords_and, keywords_or, keywords_not), texts, args.repeat)
+    print(f"従来 (in 判定):  {legacy_time:.3f}秒  {total_chars/legacy_time/1e6:.1f}M文字/秒")
+
+    backends = ['substring', 'regex']
+    try:
+        import ahocorasick  # noqa: F401
+        backends.append('ahocorasick')
+    except ImportError:
+        pass
+
+    for backend in backends:
+        matcher = KeywordMatcher(keywords_and, keywords_or, keywords_not, backend=backend)
+        elapsed, result = measure(matcher.matches, texts, args.repeat)
+        status = "一致" if result == legacy_result else "不一致"
+        print(f"{backend:12s}:  {elapsed:.3f}秒  {total_chars/elapsed/1e6:.1f}M文字/秒  "
+              f"(x{legacy_time/elapsed:.2f}, 判定結果: {status})")
+
+if __name__ == "__main__":
+    main()
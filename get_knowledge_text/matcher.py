@@ -0,0 +1,95 @@
+import json
+import re
+
+try:
+    import ahocorasick  # pyahocorasick (依存関係だが、無い環境でも部分文字列検索で動く)
+except ImportError:
+    ahocorasick = None
+
+class KeywordMatcher:
+    """
+    全キーワードを1つのオートマトンにまとめ、記事本文を1回の走査で分類する
+
+    条件:
+    - and: すべてのキーワードを含む
+    - or:  各グループからいずれか1つ以上のキーワードを含む (グループは複数指定可)
+    - not: いずれのキーワードも含まない
+    """
+
+    def __init__(self, keywords_and=(), keywords_or=(), keywords_not=(), backend=None):
+        self.keywords_and = list(keywords_and)
+        # orは単一のリストでもリストのリストでも受け付ける
+        groups = list(keywords_or)
+        if groups and isinstance(groups[0], str):
+            groups = [groups]
+        self.or_groups = [list(group) for group in groups]
+        self.keywords_not = list(keywords_not)
+
+        keywords = set(self.keywords_and) | set(self.keywords_not)
+        for group in self.or_groups:
+            keywords |= set(group)
+        # 長いものから並べ、同じ位置から始まるキーワードは最長のものを優先する
+        self.keywords = sorted(keywords, key=lambda k: (-len(k), k))
+
+        # あるキーワードの出現は、その部分文字列であるキーワードの出現も意味する
+        self._implied = {
+            k: [other for other in self.keywords if other in k]
+            for k in self.keywords
+        }
+
+        # pyahocorasickが無い環境では、CPythonのC実装の部分文字列検索の方が
+        # 正規表現の選択よりも速いため、キーワードごとのin判定を使う
+        if backend is None:
+            backend = 'ahocorasick' if ahocorasick is not None else 'substring'
+        self.backend = backend
+        if backend == 'substring':
+            pass
+        elif backend == 'ahocorasick':
+            self._automaton = ahocorasick.Automaton()
+            for k in self.keywords:
+                self._automaton.add_word(k, k)
+            self._automaton.make_automaton()
+        elif backend == 'regex':
+            # 先読みにすることで重なり合う出現もすべて拾う
+            self._pattern = re.compile('(?=(' + '|'.join(map(re.escape, self.keywords)) + '))')
+        else:
+            raise ValueError(f"未対応のバックエンドです: {backend}")
+
+    @classmethod
+    def from_config(cls, config_path, backend=None):
+        """JSON設定ファイル ({"and": [...], "or": [...], "not": [...]}) から生成する"""
+        with open(config_path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        return cls(config.get('and', []), config.get('or', []), config.get('not', []), backend=backend)
+
+    def _iter_matches(self, text):
+        if self.backend == 'ahocorasick':
+            for _, keyword in self._automaton.iter(text):
+                yield keyword
+        else:
+            for m in self._pattern.finditer(text):
+                yield m.group(1)
+
+    def find(self, text):
+        """本文に含まれるキーワードの集合を返す"""
+        if self.backend == 'substring':
+            return {k for k in self.keywords if k in text}
+        found = set()
+        for keyword in self._iter_matches(text):
+            if keyword not in found:
+                found.update(self._implied[keyword])
+        return found
+
+    def matches(self, text):
+        """本文が条件に一致するか判定する"""
+        if self.backend == 'substring':
+            # 条件が確定した時点で打ち切る
+            return (all(k in text for k in self.keywords_and)
+                    and all(any(k in text for k in group) for group in self.or_groups)
+                    and not any(k in text for k in self.keywords_not))
+        found = self.find(text)
+        if any(k in found for k in self.keywords_not):
+            return False
+        if not all(k in found for k in self.keywords_and):
+            return False
+        return all(any(k in found for k in group) for group in self.or_groups)
@@ -0,0 +1,169 @@
+import argparse
+import hashlib
+import json
+import os
+import uuid
+from pathlib import Path
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def article_cache_id(text):
+    """gen_queryのキャッシュID (チャンク分割したレコードのchunk_idは "キャッシュID#チャンク番号")"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, text))
+
+def article_key(article):
+    """記事の識別キー (Wikipedia記事はid、手動入力記事などidが無いものはタイトル)"""
+    return str(article.get('id') or article['title'])
+
+def load_articles(filename):
+    with open(filename, 'r', encoding='utf-8') as f:
+        if Path(filename).suffix == '.jsonl':
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+def load_manifest(manifest_filename):
+    if not os.path.exists(manifest_filename):
+        return {}
+    with open(manifest_filename, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_manifest(manifest, manifest_filename):
+    tmp_filename = f"{manifest_filename}.tmp"
+    with open(tmp_filename, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_filename, manifest_filename)
+
+def build_manifest(articles):
+    return {
+        article_key(article): {'title': article['title'], 'hash': content_hash(article['text']),
+                               'cache_id': article_cache_id(article['text'])}
+        for article in articles
+    }
+
+def diff_articles(articles, manifest):
+    """
+    新しい記事一覧とマニフェストを比較し、追加・変更・削除された記事を返す
+
+    Returns:
+        (added, changed, removed) のタプル
+        added/changedは記事レコードのリスト、removedはマニフェストのエントリのリスト
+        (changedの記事の古いハッシュもremovedに含める)
+    """
+    added = []
+    changed = []
+    removed = []
+    seen = set()
+    for article in articles:
+        key = article_key(article)
+        seen.add(key)
+        entry = manifest.get(key)
+        if entry is None:
+            added.append(article)
+        elif entry['hash'] != content_hash(article['text']):
+            changed.append(article)
+            removed.append({'key': key, **entry})
+    for key, entry in manifest.items():
+        if key not in seen:
+            removed.append({'key': key, **entry})
+    return added, changed, removed
+
+def run_diff(args):
+    articles = load_articles(args.input)
+    manifest = load_manifest(args.manifest)
+    added, changed, removed = diff_articles(articles, manifest)
+
+    # 差分ファイルはgen_queryの入力としてそのまま使える
+    with open(args.delta, 'w', encoding='utf-8') as f:
+        json.dump(added + changed, f, ensure_ascii=False, indent=4)
+    with open(args.removed, 'w', encoding='utf-8') as f:
+        json.dump(removed, f, ensure_ascii=False, indent=4)
+
+    if not args.dry_run:
+        save_manifest(build_manifest(articles), args.manifest)
+
+    print(f"追加: {len(added)}件  変更: {len(changed)}件  削除: {len(removed) - len(changed)}件")
+    print(f"差分記事を '{args.delta}' に、古くなった記事を '{args.removed}' に保存しました。")
+
+def is_stale(record, stale_hashes, stale_cache_ids):
+    """
+    レコードが古くなった記事に由来するか
+    - チャンク分割したレコード: knowledgeはチャンクの本文なので、chunk_idから記事のキャッシュIDを取り出して照合する
+    - compact形式: knowledge_id (本文の内容ハッシュ) をそのまま照合する
+    - flat形式: text / knowledge の内容ハッシュを照合する
+    """
+    if record.get('chunk_id'):
+        return record['chunk_id'].split('#')[0] in stale_cache_ids
+    if 'knowledge_id' in record:
+        return record['knowledge_id'] in stale_hashes
+    return content_hash(record.get('text', record.get('knowledge', ''))) in stale_hashes
+
+def prune_knowledge(filename, stale_ids):
+    """compact形式のknowledgeテーブル (JSONL) から、古くなった文書を取り除く"""
+    with open(filename, 'r', encoding='utf-8') as f:
+        docs = [json.loads(line) for line in f if line.strip()]
+    kept = [doc for doc in docs if doc['id'] not in stale_ids]
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, 'w', encoding='utf-8') as f:
+        for doc in kept:
+            f.write(json.dumps(doc, ensure_ascii=False) + '\n')
+    os.replace(tmp_filename, filename)
+    print(f"knowledgeテーブルから{len(docs) - len(kept)}件の文書を削除しました ('{filename}')")
+
+def run_prune(args):
+    """古くなった記事 (削除・変更前) を元にしたクエリや回答のレコードを取り除く"""
+    with open(args.removed, 'r', encoding='utf-8') as f:
+        removed = json.load(f)
+    stale_hashes = {entry['hash'] for entry in removed}
+    stale_cache_ids = {entry['cache_id'] for entry in removed if entry.get('cache_id')}
+
+    records = load_articles(args.target)
+    kept = []
+    pruned = []
+    for record in records:
+        (pruned if is_stale(record, stale_hashes, stale_cache_ids) else kept).append(record)
+    if len(stale_cache_ids) < len(removed) and any(record.get('chunk_id') for record in records):
+        print("警告: cache_idの無い古いマニフェストのエントリがあります。"
+              "チャンク分割したレコードはそれらの記事と照合できないため、残っている可能性があります")
+
+    output = args.output or args.target
+    with open(output, 'w', encoding='utf-8') as f:
+        if Path(output).suffix == '.jsonl':
+            for record in kept:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        else:
+            json.dump(kept, f, ensure_ascii=False, indent=2)
+    print(f"{len(pruned)}件のレコードを削除しました ('{output}')")
+
+    if args.knowledge:
+        # 記事全体の文書に加え、削除したレコードだけが参照していたチャンクの文書も取り除く
+        # (残したレコードが参照している文書は、同じ本文の別の記事のものかもしれないので残す)
+        kept_ids = {record['knowledge_id'] for record in kept if 'knowledge_id' in record}
+        stale_ids = stale_hashes | {record['knowledge_id'] for record in pruned if 'knowledge_id' in record}
+        prune_knowledge(args.knowledge, stale_ids - kept_ids)
+
+def main():
+    parser = argparse.ArgumentParser(description='記事リビジョンに基づく差分更新')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    diff_parser = subparsers.add_parser('diff', help='マニフェストと比較して差分を出力する')
+    diff_parser.add_argument('input', type=str, help='新しい記事ファイル (wiki.json / wiki.jsonl / syudou.json)')
+    diff_parser.add_argument('--manifest', type=str, default='manifest.json')
+    diff_parser.add_argument('--delta', type=str, default='wiki_delta.json', help='追加・変更された記事の出力先')
+    diff_parser.add_argument('--removed', type=str, default='wiki_removed.json', help='古くなった記事の出力先')
+    diff_parser.add_argument('--dry-run', action='store_true', help='マニフェストを更新しない')
+    diff_parser.set_defaults(func=run_diff)
+
+    prune_parser = subparsers.add_parser('prune', help='古くなった記事に由来するレコードを削除する')
+    prune_parser.add_argument('target', type=str, help='generated_queries.json や generated_answers.jsonl')
+    prune_parser.add_argument('--removed', type=str, default='wiki_removed.json')
+    prune_parser.add_argument('--output', type=str, default=None, help='出力先 (デフォルト: 上書き)')
+    prune_parser.add_argument('--knowledge', type=str, default=None,
+                              help='compact形式のknowledgeテーブル (knowledge.jsonl)。古くなった文書を取り除く')
+    prune_parser.set_defaults(func=run_prune)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
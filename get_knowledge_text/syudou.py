@@ -1,50 +1,262 @@
+import argparse
+import hashlib
+import itertools
 import json
 import os
+import re
+import sys
+from pathlib import Path
+
+DEFAULT_STORE = 'syudou.jsonl'
+# 以前の形式 (JSON配列を毎回書き直していたファイル)
+LEGACY_FILENAME = 'syudou.json'
+# ディレクトリから取り込むファイル (.json / .jsonl は記事レコードのリストとして読む)
+TEXT_SUFFIXES = ('.txt', '.md')
+RECORD_SUFFIXES = ('.json', '.jsonl')
+MAX_TITLE_LENGTH = 40
+
+# Markdownの見出し (# 見出し) とwikitextの見出し (== 見出し ==)
+HEADING_MARKUP = re.compile(r'^(?:#+\s*(.+?)\s*#*|=+\s*(.+?)\s*=+)$')
+SENTENCE_END = re.compile(r'[。．]')
+
+def clean_text(text):
+    """改行コードとBOM、前後の空行を揃える (行頭のインデントは残す)"""
+    text = text.lstrip('\ufeff').replace('\r\n', '\n').replace('\r', '\n')
+    return text.strip('\n').rstrip()
+
+def content_hash(text):
+    """本文の内容ハッシュ (refresh.py・gen_queryのknowledge_idと同じ値)"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def derive_title(text, fallback=None):
+    """
+    本文からタイトルを決める
+
+    最初の空でない行が見出し (Markdown / wikitext) か短い行ならそれを使い、
+    文章の行ならfallback (ファイル名など) 、無ければ最初の文を切り詰めて使う
+    """
+    first_line = next((line.strip() for line in text.split('\n') if line.strip()), '')
+    match = HEADING_MARKUP.match(first_line)
+    if match:
+        return (match.group(1) or match.group(2))[:MAX_TITLE_LENGTH]
+    if first_line and len(first_line) <= MAX_TITLE_LENGTH and not SENTENCE_END.search(first_line):
+        return first_line
+    if fallback:
+        return fallback
+    sentence = SENTENCE_END.split(first_line, 1)[0]
+    return sentence if len(sentence) <= MAX_TITLE_LENGTH else sentence[:MAX_TITLE_LENGTH] + '…'
+
+def make_article(text, title=None, source='', fallback_title=None):
+    text = clean_text(text)
+    return {
+        'id': content_hash(text),
+        'title': title or derive_title(text, fallback_title),
+        'text': text,
+        'source': source,
+    }
+
+class ArticleStore:
+    """
+    手動で集めた記事を追記のみのJSONLに保存する
+
+    内容ハッシュの索引 (<store>.index、1行1件の "ハッシュ\\t記事の終わりの位置") も追記のみで持ち、
+    開くときは索引だけを読んで重複を判定する (記事ファイル全体は読み直さない)
+    索引の最後の位置より後ろに記事がある場合 (記事の追記後・索引の追記前に中断した場合や
+    索引が無い場合) はその部分だけを読んで索引に追加し、途中まで書かれた最後の行は切り捨てる
+    """
+
+    def __init__(self, filename=DEFAULT_STORE):
+        self.filename = filename
+        self.index_filename = f"{filename}.index"
+        self.hashes = set()
+        self.added = 0
+        self.duplicates = 0
+        self._index = open(self.index_filename, 'a+b')
+        self._file = open(filename, 'a+b')
+        end, recovered = self._recover(self._load_index())
+        self._file.truncate(end)
+        self._file.seek(0, os.SEEK_END)
+        for entry in recovered:
+            self._index.write(entry)
+        if recovered:
+            print(f"索引に{len(recovered)}件の記事を追加しました")
+
+    def _load_index(self):
+        """索引を読み込み、索引が指している記事ファイルの位置を返す"""
+        self._index.seek(0)
+        valid = 0
+        end = 0
+        for line in self._index:
+            parts = line.rstrip(b'\n').split(b'\t')
+            if not line.endswith(b'\n') or len(parts) != 2:
+                break
+            self.hashes.add(parts[0].decode('ascii'))
+            end = int(parts[1])
+            valid += len(line)
+        if end > os.path.getsize(self.filename):
+            # 記事ファイルが索引より短い (別の方法で編集された) 場合は作り直す
+            self.hashes.clear()
+            valid = end = 0
+        self._index.truncate(valid)
+        return end
+
+    def _recover(self, end):
+        """endより後ろの記事を読み、(正しく書き終わっている位置, 索引に追加する行) を返す"""
+        recovered = []
+        self._file.seek(end)
+        for line in self._file:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                article = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            end += len(line)
+            digest = content_hash(article['text'])
+            self.hashes.add(digest)
+            recovered.append(f"{digest}\t{end}\n".encode('ascii'))
+        return end, recovered
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, article):
+        """記事を追記する (本文が空か、同じ本文の記事が既にあれば追記せずFalseを返す)"""
+        if not article['text']:
+            return False
+        digest = content_hash(article['text'])
+        if digest in self.hashes:
+            self.duplicates += 1
+            return False
+        self._file.write((json.dumps(article, ensure_ascii=False) + '\n').encode('utf-8'))
+        self._index.write(f"{digest}\t{self._file.tell()}\n".encode('ascii'))
+        self.hashes.add(digest)
+        self.added += 1
+        return True
+
+    def close(self):
+        # 記事ファイルを先に書き切ってから索引を書く (中断しても索引が記事より先に進まない)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._index.flush()
+        os.fsync(self._index.fileno())
+        self._index.close()
+
+def iter_record_file(path):
+    """記事レコードのファイル (JSON配列またはJSONL) を1件ずつ読む"""
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        if path.suffix == '.jsonl':
+            records = (json.loads(line) for line in f if line.strip())
+        else:
+            records = json.load(f)
+        for record in records:
+            yield make_article(record['text'], record.get('title'), record.get('source', ''))
+
+def iter_text_stream(stream, separator):
+    """区切り行 (separatorだけの行) で区切られた複数の記事を読む"""
+    lines = []
+    for line in stream:
+        if line.rstrip('\r\n') == separator:
+            if ''.join(lines).strip():
+                yield make_article(''.join(lines))
+            lines = []
+        else:
+            lines.append(line)
+    if ''.join(lines).strip():
+        yield make_article(''.join(lines))
+
+def iter_paths(paths):
+    """引数のファイル・ディレクトリから取り込むファイルを順に返す (ディレクトリ内は名前順)"""
+    for path in map(Path, paths):
+        if path.is_dir():
+            yield from sorted(p for p in path.rglob('*') if p.is_file() and p.suffix in TEXT_SUFFIXES + RECORD_SUFFIXES)
+        else:
+            yield path
+
+def iter_sources(paths, separator):
+    """取り込む記事を1件ずつ返す ('-'は標準入力)"""
+    for path in iter_paths(paths):
+        if str(path) == '-':
+            # 1行目が{で始まればJSONL、それ以外は区切り行で区切られたテキスト
+            first = sys.stdin.readline()
+            lines = itertools.chain([first], sys.stdin)
+            if first.lstrip('\ufeff').startswith('{'):
+                for line in lines:
+                    if line.strip():
+                        record = json.loads(line)
+                        yield make_article(record['text'], record.get('title'), record.get('source', ''))
+            else:
+                yield from iter_text_stream(lines, separator)
+        elif path.suffix in RECORD_SUFFIXES:
+            yield from iter_record_file(path)
+        else:
+            with open(path, 'r', encoding='utf-8-sig') as f:
+                yield make_article(f.read(), fallback_title=path.stem)
+
+def open_store(filename):
+    """記事ストアを開く (デフォルトの保存先を初めて作るときは以前の形式のsyudou.jsonを取り込む)"""
+    migrate = (Path(filename).name == DEFAULT_STORE and not os.path.exists(filename)
+               and os.path.exists(Path(filename).with_name(LEGACY_FILENAME)))
+    store = ArticleStore(filename)
+    if migrate:
+        with open(Path(filename).with_name(LEGACY_FILENAME), 'r', encoding='utf-8') as f:
+            for article in json.load(f):
+                # 以前の形式で自動で付けたタイトル (本文の最初の10文字) は付け直す
+                title = article.get('title')
+                if title == article['text'][:10]:
+                    title = None
+                store.add(make_article(article['text'], title, article.get('source', '')))
+        print(f"'{LEGACY_FILENAME}' から{store.added}件の記事を取り込みました")
+    return store
 
 def main():
-    articles = input_articles()
-    
-    # 既存のデータを読み込む（存在する場合）
-    existing_data = []
-    if os.path.exists('syudou.json'):
-        with open('syudou.json', 'r', encoding='utf-8') as f:
-            existing_data = json.load(f)
-    
-    # 新しいデータを追加して保存
-    combined_data = existing_data + articles
-    with open('syudou.json', 'w', encoding='utf-8') as f:
-        json.dump(combined_data, f, ensure_ascii=False, indent=4)
+    parser = argparse.ArgumentParser(description='手動で集めた記事をsyudou.jsonlに追加する')
+    parser.add_argument('paths', nargs='*',
+                        help='取り込むファイル・ディレクトリ (.txt / .md は1ファイル1記事、.json / .jsonl は記事レコード、'
+                             '- は標準入力)。省略すると対話入力')
+    parser.add_argument('--store', type=str, default=DEFAULT_STORE, help='記事の保存先 (JSONL)')
+    parser.add_argument('--separator', type=str, default='---',
+                        help='標準入力のテキストで記事を区切る行')
+    args = parser.parse_args()
+
+    store = open_store(args.store)
+    try:
+        articles = iter_sources(args.paths, args.separator) if args.paths else input_articles()
+        for article in articles:
+            if store.add(article) and args.paths and store.added % 1000 == 0:
+                print(f"取り込み中: {store.added}件")
+    finally:
+        store.close()
+    print(f"{store.added}件の記事を '{args.store}' に追加しました (重複: {store.duplicates}件、合計: {len(store)}件)")
 
 def input_articles():
     """
     ユーザーが手動で記事本文を入力する（複数行対応）
     """
-    articles = []
+    count = 0
     print("記事本文を入力してください ('q'で終了)")
-    
+
     while True:
         print("新しい記事を開始します ('q'で終了)")
         lines = []
-        
+
         while True:
-            line = input("> ").strip()
-            if line.lower() == 'q':
+            # 行頭のインデントを残すため、終了の判定だけ空白を除いて行う
+            try:
+                line = input("> ")
+            except EOFError:
+                line = 'q'
+            if line.strip().lower() == 'q':
                 break
             lines.append(line)
-        
-        if not lines:
+
+        if not clean_text('\n'.join(lines)):
             break
-            
-        text = '\n'.join(lines)
-        articles.append({
-            'title': text[:10],  # 最初の10文字をタイトルに
-            'text': text,
-            'source': ""
-        })
-        
-        print(f"{len(articles)}件目の記事を追加しました。\n")
-    
-    return articles
+
+        count += 1
+        yield make_article('\n'.join(lines))
+        print(f"{count}件目の記事を追加しました。\n")
 
 if __name__ == "__main__":
     main()
@@ -1,43 +1,180 @@
 from datasets import load_dataset
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from matcher import KeywordMatcher
+from kirara_common.sharding import Shard, sources_filename
+import argparse
 import re
 import json
+import os
+
+DATASET_NAME = 'wikimedia/wikipedia'
+DATASET_CONFIG = '20231101.ja'
+
+# 検索キーワードの設定ファイル (and/or/notグループ)
+DEFAULT_KEYWORDS_CONFIG = Path(__file__).parent / 'keywords.json'
 
 def main():
-    articles = extract_kirara_articles()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stream', action='store_true',
+                        help='parquetシャードを逐次読み込み、複数プロセスでフィルタしてJSONLに書き出す')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='--stream時のプロセス数')
+    parser.add_argument('--output', type=str, default=None,
+                        help='出力ファイル (デフォルト: wiki.json / --stream時はwiki.jsonl)')
+    parser.add_argument('--keywords', type=str, default=str(DEFAULT_KEYWORDS_CONFIG),
+                        help='検索キーワードの設定ファイル')
+    parser.add_argument('--shard', type=str, default=None,
+                        help='--stream時に複数のマシンで分担する (i/N)。パスがこのシャードに入るparquetファイルだけを処理する')
+    args = parser.parse_args()
+
+    shard = None
+    if args.shard:
+        if not args.stream:
+            parser.error('--shardは--streamと一緒に指定してください')
+        try:
+            shard = Shard.parse(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+
+    # 依存関係を入れずに実行した場合は、キーワードの数に比例する照合になることを知らせる
+    backend = get_matcher(args.keywords).backend
+    if backend != 'ahocorasick':
+        print(f"警告: pyahocorasickがインストールされていないため、キーワードを{backend}で照合します "
+              f"(キーワードの数に比例して遅くなります。uv syncでインストールされます)")
+
+    if args.stream:
+        output = args.output or 'wiki.jsonl'
+        if shard:
+            output = shard.filename(output)
+        count = extract_kirara_articles_stream(output, max_workers=args.workers, keywords_config=args.keywords,
+                                               shard=shard)
+        print(f"{count}件の記事を '{output}' に保存しました。")
+        return
+
+    articles = extract_kirara_articles(args.keywords)
     # for article in articles:
     #     print(f"Title: {article['title']}")
     #     print(f"URL: {article['source']}")
     #     print("-" * 50)
-        
+
     # JSONファイルとして保存
-    with open('wiki.json', 'w', encoding='utf-8') as f:
+    with open(args.output or 'wiki.json', 'w', encoding='utf-8') as f:
         json.dump(articles, f, ensure_ascii=False, indent=4)
 
-def extract_kirara_articles():
+_matchers = {}
+
+def get_matcher(keywords_config=DEFAULT_KEYWORDS_CONFIG):
+    """設定ファイルごとにKeywordMatcherを1度だけ構築する (ワーカープロセスごとに保持)"""
+    key = str(keywords_config)
+    if key not in _matchers:
+        _matchers[key] = KeywordMatcher.from_config(keywords_config)
+    return _matchers[key]
+
+def is_kirara_article(text, keywords_config=DEFAULT_KEYWORDS_CONFIG):
+    """記事本文がキーワード条件に一致するか判定する"""
+    return get_matcher(keywords_config).matches(text)
+
+def to_record(article_id, title, text):
+    return {
+        'id': article_id,
+        'title': title,
+        'text': text,
+        'source': f"https://ja.wikipedia.org/wiki/{title}"
+    }
+
+def extract_kirara_articles(keywords_config=DEFAULT_KEYWORDS_CONFIG):
     """
     Wikimedia/Wikipediaの日本語サブセットから
     『まんがタイムきらら』と『4コマ漫画作品』に関連する記事を抽出する
     """
     # データセットのロード
-    dataset = load_dataset('wikimedia/wikipedia', '20231101.ja')
-    
-    # 検索キーワード
-    keywords_and = ['4コマ漫画作品']
-    keywords_or = ['まんがタイムきららの4コマ漫画作品', 'まんがタイムKRコミックスのアニメ作品', 'まんがタイムきららフォワード']
-    
+    dataset = load_dataset(DATASET_NAME, DATASET_CONFIG)
+    matcher = get_matcher(keywords_config)
+
     # キーワードを含む記事をフィルタリング
     filtered_articles = []
     for article in dataset['train']:
         text = article['text']
-        if all(keyword in text for keyword in keywords_and) and any(keyword in text for keyword in keywords_or):
-            filtered_articles.append({
-                'title': article['title'],
-                'text': text,
-                'source': f"https://ja.wikipedia.org/wiki/{article['title']}"
-            })
-
-    
+        if matcher.matches(text):
+            filtered_articles.append(to_record(article['id'], article['title'], text))
+
+
     return filtered_articles
 
+def list_parquet_shards():
+    """データセットのparquetシャードのパス一覧をシャード順に取得する"""
+    from huggingface_hub import HfFileSystem
+
+    fs = HfFileSystem()
+    return sorted(fs.glob(f"datasets/{DATASET_NAME}/{DATASET_CONFIG}/*.parquet"))
+
+def filter_parquet_shard(shard_path, keywords_config=DEFAULT_KEYWORDS_CONFIG, batch_size=1000):
+    """
+    1つのparquetシャードをバッチ単位で読み込み、一致した記事だけを返す
+    (ProcessPoolExecutorのワーカーで実行される)
+    """
+    import pyarrow.parquet as pq
+    from huggingface_hub import hf_hub_download
+
+    filename = shard_path.split(f"datasets/{DATASET_NAME}/", 1)[1]
+    local_path = hf_hub_download(DATASET_NAME, filename, repo_type='dataset')
+
+    matcher = get_matcher(keywords_config)
+    matched = []
+    parquet_file = pq.ParquetFile(local_path)
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=['id', 'title', 'text']):
+        ids = batch.column('id').to_pylist()
+        titles = batch.column('title').to_pylist()
+        texts = batch.column('text').to_pylist()
+        for article_id, title, text in zip(ids, titles, texts):
+            if matcher.matches(text):
+                matched.append(to_record(article_id, title, text))
+    return matched
+
+def iter_kirara_articles_stream(max_workers=None, keywords_config=DEFAULT_KEYWORDS_CONFIG, shard=None, sources=None):
+    """
+    parquetシャードを並列にフィルタし、一致した記事を1件ずつ返す
+    出力順はextract_kirara_articles()と同じ (シャード順・シャード内の行順)
+
+    shard (--shard i/N) を指定すると、パスがそのシャードに入るparquetファイルだけを処理する
+    sourcesにdictを渡すと、全parquetファイルの一覧と処理したファイルごとの記事数を記録する
+    (merge_shards.pyで元の順に結合するために使う)
+    """
+    all_shards = list_parquet_shards()
+    shards = [path for path in all_shards if path in shard] if shard else all_shards
+    if sources is not None:
+        sources.update({"shard": str(shard) if shard else None, "all_files": all_shards, "files": []})
+    print(f"{len(shards)}個のシャードを処理します" + (f" (全{len(all_shards)}個中)" if shard else ""))
+
+    count = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # mapは投入順に結果を返すため、完了したシャードから順に返せる
+        for i, matched in enumerate(executor.map(partial(filter_parquet_shard, keywords_config=keywords_config), shards)):
+            yield from matched
+            count += len(matched)
+            if sources is not None:
+                sources["files"].append({"path": shards[i], "articles": len(matched)})
+            print(f"シャード処理済み: {i+1}/{len(shards)} (累計 {count}件)")
+
+def write_sources(output_filename, sources):
+    with open(sources_filename(output_filename), 'w', encoding='utf-8') as f:
+        json.dump(sources, f, ensure_ascii=False, indent=2)
+
+def extract_kirara_articles_stream(output_filename, max_workers=None, keywords_config=DEFAULT_KEYWORDS_CONFIG,
+                                   shard=None):
+    """一致した記事をJSONLへ逐次書き出す (shardを指定した場合は処理したparquetファイルの一覧も書き出す)"""
+    count = 0
+    sources = {} if shard else None
+    with open(output_filename, 'w', encoding='utf-8') as f:
+        for article in iter_kirara_articles_stream(max_workers, keywords_config, shard, sources):
+            f.write(json.dumps(article, ensure_ascii=False) + '\n')
+            f.flush()
+            count += 1
+    if shard:
+        write_sources(output_filename, sources)
+    return count
+
 if __name__ == "__main__":
     main()
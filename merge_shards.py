@@ -0,0 +1,302 @@
+"""
+--shard i/N で分担して実行したシャードごとの出力とキャッシュを1つに結合する
+
+出力は分担せずに実行した場合と同じ順 (入力の順) に並べ、次を確認する
+- 足りないシャードのファイル (結合せずに終了する)
+- 複数のシャード (または同じシャード内) に出てくる同じID (最初のものだけを残す)
+- 入力に無いアイテムの出力 (結合しない)
+- 出力の無い入力アイテム (クエリが生成されなかった記事、回答の無いクエリ)
+いずれかがあれば終了コード1で終わる (--allow-missingでは出力の無いアイテムは警告のみ)
+
+使い方 (依存パッケージはgen_queryの環境に揃っている):
+    python merge_shards.py extract get_knowledge_text/wiki.jsonl --shards 4
+    python merge_shards.py query gen_query/generated_queries.json --shards 4 --input gen_query/wiki.json \\
+        --text-and-prompt gen_query/text_and_prompt.json --cache node1/cache node2/cache --cache-into gen_query/cache
+    python merge_shards.py answer gen_answer/generated_answers.jsonl --shards 4 \\
+        --input gen_query/generated_queries.json
+"""
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+for stage_dir in ("gen_query", "gen_answer", "get_knowledge_text"):
+    sys.path.insert(0, str(ROOT / stage_dir))
+
+from kirara_common.sharding import content_key, record_key, shard_filename, sources_filename
+
+# ステージごとのキャッシュの名前空間と拡張子 (DirectoryCacheの場合)
+CACHE_FORMATS = {"query": ("gen_query", ".json"), "answer": ("gen_answer", ".jsonl")}
+# 確認結果に表示するIDの数
+MAX_EXAMPLES = 5
+
+def iter_records(filename):
+    """JSONLなら1行ずつ、JSONなら配列を読み込んで返す"""
+    with open(filename, 'r', encoding='utf-8') as f:
+        if Path(filename).suffix == '.jsonl':
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(f)
+
+def write_records(records, filename):
+    """各ステージと同じ形式 (.jsonlなら1行1レコード、それ以外はJSON配列) で書き出す"""
+    from results import dump_records
+    with open(filename, 'w', encoding='utf-8') as f:
+        dump_records(records, f, filename)
+
+def shard_files(filename, count):
+    """シャードごとのファイル名 (無いファイルがあれば終了する)"""
+    files = [shard_filename(filename, index, count) for index in range(count)]
+    missing = [name for name in files if not os.path.exists(name)]
+    for name in missing:
+        print(f"エラー: シャードの出力 '{name}' がありません")
+    if missing:
+        sys.exit(1)
+    return files
+
+class MergeCheck:
+    """結合時の確認結果 (重複したID・入力に無いアイテム・出力の無いアイテム)"""
+
+    def __init__(self, name):
+        self.name = name
+        self.duplicates = []
+        self.unexpected = []
+        self.missing = []
+
+    def problems(self, allow_missing=False):
+        return bool(self.duplicates or self.unexpected or (self.missing and not allow_missing))
+
+    def report(self):
+        for label, ids in (("重複したID", self.duplicates), ("入力に無いアイテム", self.unexpected),
+                           ("出力の無い入力アイテム", self.missing)):
+            if ids:
+                examples = ", ".join(str(i) for i in ids[:MAX_EXAMPLES])
+                print(f"  {self.name}: {label} {len(ids)}件 (例: {examples})")
+
+def merge_in_order(files, keys, key_of, id_of, check):
+    """
+    シャードのファイルのレコードをキーごとにまとめて返す (キー -> レコードのリスト、ファイル内の順を保つ)
+
+    入力に同じ本文のアイテムが複数ある場合は、分担しない実行と同じく同じシャードが同じIDを繰り返し出力するため、
+    同じファイル内で繰り返されたIDは重複として数えない
+    """
+    expected = set(keys)
+    groups = {}
+    owners = {}
+    for index, filename in enumerate(files):
+        for record in iter_records(filename):
+            record_id = id_of(record)
+            if record_id in owners:
+                if owners[record_id] != index:
+                    check.duplicates.append(record_id)
+                continue
+            owners[record_id] = index
+            key = key_of(record)
+            if key not in expected:
+                check.unexpected.append(record_id)
+                continue
+            groups.setdefault(key, []).append(record)
+    check.missing = list(dict.fromkeys(key for key in keys if key not in groups))
+    return groups
+
+def ordered(keys, groups, once=False):
+    """入力の順にレコードを返す (同じキーが複数あれば、onceでなければそれぞれの位置で繰り返す)"""
+    done = set()
+    for key in keys:
+        if key in groups and not (once and key in done):
+            done.add(key)
+            yield from groups[key]
+
+def open_cache_path(path, namespace, suffix):
+    """キャッシュのディレクトリ、またはSQLiteのファイルを開く"""
+    from kirara_common.cache_store import DirectoryCache, SQLiteCache
+    path = Path(path)
+    if path.is_dir() or (not path.exists() and path.suffix not in ('.sqlite3', '.sqlite', '.db')):
+        return DirectoryCache(path, suffix)
+    return SQLiteCache(path, namespace)
+
+def merge_caches(sources, target_path, stage, batch_size=1000):
+    """
+    シャードのキャッシュを1つにまとめる
+    キーは内容から決まるため、同じキーの値が違う場合は結合先の値を残し、件数を表示する
+    """
+    namespace, suffix = CACHE_FORMATS[stage]
+    target = open_cache_path(target_path, namespace, suffix)
+    added = conflicts = 0
+
+    def flush(batch):
+        nonlocal added, conflicts
+        existing = target.get_many(target.existing(batch))
+        new_items = []
+        for key, value in batch.items():
+            if key not in existing:
+                new_items.append((key, value))
+            elif existing[key] != value:
+                conflicts += 1
+        if hasattr(target, "put_many"):
+            target.put_many(new_items)
+        else:
+            for key, value in new_items:
+                target.put(key, value)
+        added += len(new_items)
+
+    for source_path in sources:
+        batch = {}
+        for key, value in open_cache_path(source_path, namespace, suffix).items():
+            batch[key] = value
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = {}
+        flush(batch)
+    print(f"キャッシュ: {added}件を '{target_path}' に追加しました" + (f" (値の違う同じキー: {conflicts}件)" if conflicts else ""))
+
+def load_articles(input_filename):
+    """gen_queryの入力 (JSON / JSONL / .kcorpus)"""
+    if Path(input_filename).suffix == '.kcorpus':
+        from kirara_common.corpus_store import CorpusStore
+        return CorpusStore(input_filename)
+    return list(iter_records(input_filename))
+
+def query_item_keys(input_filename, max_chunk_tokens):
+    """gen_queryの作業アイテム (チャンク分割後) のキーを入力順に返す"""
+    data = load_articles(input_filename)
+    if not max_chunk_tokens:
+        if hasattr(data, "content_hash"):
+            return [data.content_hash(i) for i in range(len(data))]
+        return [content_key(item["text"]) for item in data]
+    from chunking import expand_chunks
+    token_count = data.known_token_count if hasattr(data, "known_token_count") else None
+    items, _ = expand_chunks(data, max_chunk_tokens, token_count)
+    return [content_key(item["text"]) for item in items]
+
+def merge_extract(args):
+    """
+    wiki.py --stream --shard の出力を、全parquetファイルの順 (分担しない場合と同じ順) に結合する
+    各シャードの出力は担当したparquetファイルの順に並んでいるため、記録した記事数ずつ取り出す
+    """
+    files = shard_files(args.output, args.shards)
+    manifests = []
+    for filename in files:
+        if not os.path.exists(sources_filename(filename)):
+            print(f"エラー: '{sources_filename(filename)}' がありません (抽出が途中で終了した可能性があります)")
+            sys.exit(1)
+        with open(sources_filename(filename), 'r', encoding='utf-8') as f:
+            manifests.append(json.load(f))
+    all_files = manifests[0]["all_files"]
+    if any(manifest["all_files"] != all_files for manifest in manifests):
+        print("エラー: シャードごとにparquetファイルの一覧が違います (データセットが更新された可能性があります)")
+        sys.exit(1)
+
+    check = MergeCheck("記事")
+    # parquetファイル -> それを処理したシャードと記事数 (同じファイルを複数のシャードが処理した場合は最初のものを使う)
+    owners = {}
+    for index, manifest in enumerate(manifests):
+        for source in manifest["files"]:
+            owners.setdefault(source["path"], []).append((index, source["articles"]))
+    check.missing = [path for path in all_files if path not in owners]
+
+    readers = [iter_records(filename) for filename in files]
+    seen = set()
+    count = 0
+    with open(args.output, 'w', encoding='utf-8') as f:
+        for path in all_files:
+            for owner, (index, articles) in enumerate(owners.get(path, [])):
+                for _ in range(articles):
+                    article = next(readers[index], None)
+                    if article is None:
+                        print(f"エラー: '{files[index]}' の記事数が記録より少なくなっています")
+                        sys.exit(1)
+                    if owner > 0 or article["id"] in seen:
+                        check.duplicates.append(article["id"])
+                        continue
+                    seen.add(article["id"])
+                    f.write(json.dumps(article, ensure_ascii=False) + '\n')
+                    count += 1
+    for index, reader in enumerate(readers):
+        if next(reader, None) is not None:
+            check.unexpected.append(files[index])
+    print(f"{args.shards}個のシャードから{count}件の記事を '{args.output}' に結合しました")
+    return [check]
+
+def merge_query(args):
+    keys = query_item_keys(args.input, args.max_chunk_tokens)
+    checks = []
+
+    check = MergeCheck("クエリ")
+    groups = merge_in_order(shard_files(args.output, args.shards), keys, record_key, lambda r: r["id"], check)
+    write_records(ordered(keys, groups), args.output)
+    print(f"{args.shards}個のシャードから{sum(len(g) for g in groups.values())}件のクエリを '{args.output}' に結合しました")
+    checks.append(check)
+
+    if args.text_and_prompt:
+        check = MergeCheck("text_and_prompt")
+        groups = merge_in_order(shard_files(args.text_and_prompt, args.shards), keys, record_key, record_key, check)
+        # 出力の無いアイテムはクエリの確認で表示する
+        check.missing = []
+        write_records(ordered(keys, groups), args.text_and_prompt)
+        checks.append(check)
+    if args.knowledge:
+        # compact形式のknowledgeテーブルは同じknowledgeを1度だけ持つ
+        check = MergeCheck("knowledge")
+        groups = merge_in_order(shard_files(args.knowledge, args.shards), keys, lambda r: r["id"], lambda r: r["id"],
+                                check)
+        check.missing = []
+        write_records(ordered(keys, groups, once=True), args.knowledge)
+        checks.append(check)
+    return checks
+
+def merge_answer(args):
+    query_ids = [query_data["id"] for query_data in iter_records(args.input)]
+    check = MergeCheck("回答")
+    groups = merge_in_order(shard_files(args.output, args.shards), query_ids, lambda r: r["id"], lambda r: r["id"],
+                            check)
+    write_records(ordered(query_ids, groups), args.output)
+    print(f"{args.shards}個のシャードから{len(groups)}件の回答を '{args.output}' に結合しました")
+    return [check]
+
+def main():
+    parser = argparse.ArgumentParser(description='--shardで分担して実行した出力とキャッシュを入力順に結合する')
+    subparsers = parser.add_subparsers(dest='stage', required=True)
+    extract_parser = subparsers.add_parser('extract', help='wiki.py --stream --shard の出力を結合する')
+    query_parser = subparsers.add_parser('query', help='gen_query (main.py / jimba.py) の出力を結合する')
+    answer_parser = subparsers.add_parser('answer', help='gen_answer.py の出力を結合する')
+    for sub in (extract_parser, query_parser, answer_parser):
+        sub.add_argument('output', type=str, help='結合先 (--shardを付けずに実行した場合の出力ファイル名)')
+        sub.add_argument('--shards', type=int, required=True, help='シャードの数 (--shard i/N のN)')
+        sub.add_argument('--allow-missing', action='store_true',
+                         help='出力の無い入力アイテムがあっても終了コード0で終わる')
+    for sub in (query_parser, answer_parser):
+        sub.add_argument('--input', type=str, required=True, help='各シャードに渡した入力ファイル (並び順の基準)')
+        sub.add_argument('--cache', type=str, nargs='+', default=[],
+                         help='結合するシャードのキャッシュ (ディレクトリまたはSQLiteのファイル)')
+        sub.add_argument('--cache-into', type=str, default=None, help='キャッシュの結合先')
+    query_parser.add_argument('--max-chunk-tokens', type=int, default=0, help='各シャードに指定した--max-chunk-tokens')
+    query_parser.add_argument('--text-and-prompt', type=str, default=None, help='text_and_promptの結合先')
+    query_parser.add_argument('--knowledge', type=str, default=None, help='compact形式のknowledgeテーブルの結合先')
+    args = parser.parse_args()
+
+    if getattr(args, "cache", None) and not args.cache_into:
+        parser.error('--cacheには--cache-intoが必要です')
+    if args.shards < 1:
+        parser.error('--shardsは1以上にしてください')
+
+    checks = {"extract": merge_extract, "query": merge_query, "answer": merge_answer}[args.stage](args)
+    if getattr(args, "cache", None):
+        merge_caches(args.cache, args.cache_into, args.stage)
+
+    if any(check.problems(args.allow_missing) for check in checks):
+        print("確認で問題が見つかりました:")
+        for check in checks:
+            check.report()
+        sys.exit(1)
+    for check in checks:
+        if check.missing:
+            check.report()
+    print("確認: 足りないシャード・重複したID・入力に無いアイテムはありません")
+
+if __name__ == "__main__":
+    main()
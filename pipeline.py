@@ -0,0 +1,421 @@
+"""
+抽出 (get_knowledge_text) → クエリ生成 (gen_query) → 回答生成 (gen_answer) を1つのプロセスで重ねて実行する
+
+ステージ間は上限付きのキューでつなぎ、記事のクエリが生成されたらすぐに回答生成へ流す
+下流が詰まると上流はキューが空くまで待つ (バックプレッシャー)
+ステージの構成はJSONの設定ファイル (pipeline.json) で指定する
+
+使い方 (依存パッケージはgen_queryの環境に揃っている):
+    uv run --project gen_query python pipeline.py pipeline.json
+    uv run --project gen_query python pipeline.py pipeline.json --only answer
+"""
+import argparse
+import importlib
+import json
+import queue
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+for stage_dir in ("gen_query", "gen_answer", "get_knowledge_text"):
+    sys.path.insert(0, str(ROOT / stage_dir))
+
+# ステージの種類 -> 上流のステージの種類
+STAGE_TYPES = {"extract": None, "query": "extract", "answer": "query"}
+# 各ステージを単独で実行したときと同じキャッシュを使う
+DEFAULT_CACHE_DIRS = {"query": "gen_query/cache", "answer": "gen_answer/cache"}
+DONE = object()
+
+def iter_records(filename):
+    """JSONLなら1行ずつ、JSONなら配列を読み込んで返す"""
+    with open(filename, 'r', encoding='utf-8') as f:
+        if Path(filename).suffix == '.jsonl':
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(f)
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+class StageStats:
+    """ステージごとの処理件数とアイテムあたりの処理時間"""
+
+    def __init__(self):
+        self.items_in = 0
+        self.items_out = 0
+        self.errors = 0
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def add(self, latency, num_outputs):
+        with self._lock:
+            self.items_in += 1
+            self.items_out += num_outputs
+            self.latencies.append(latency)
+
+    def error(self):
+        with self._lock:
+            self.items_in += 1
+            self.errors += 1
+
+    def summary(self, elapsed):
+        return {
+            "items_in": self.items_in,
+            "items_out": self.items_out,
+            "errors": self.errors,
+            "throughput": self.items_out / elapsed if elapsed else 0.0,
+            "latency_p50": percentile(self.latencies, 0.5),
+            "latency_p95": percentile(self.latencies, 0.95),
+        }
+
+class JsonlWriter:
+    def __init__(self, filename):
+        self._file = open(filename, 'w', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+class Node:
+    """
+    パイプラインの1ステージ
+    入力キューからレコードを取り出してhandlerで処理し、結果を下流の全ステージの入力キューへ渡す
+    """
+
+    def __init__(self, name, config, queue_size):
+        self.name = name
+        self.type = config["type"]
+        self.config = config
+        self.concurrency = 1 if self.type == "extract" else config.get("concurrency", 1)
+        self.inbox = queue.Queue(maxsize=queue_size)
+        self.upstream = None
+        self.downstream = []
+        self.stats = StageStats()
+        self.handler = None
+        self.output = None
+        # --shardでparquetから抽出した場合の、処理したparquetファイルと記事数
+        self.sources = None
+        self._running = self.concurrency
+        self._lock = threading.Lock()
+
+    def emit(self, t0, record):
+        if self.output:
+            self.output.write(record)
+        for child in self.downstream:
+            # 下流のキューが一杯なら空くまで待つ
+            child.inbox.put((t0, record))
+
+    def worker(self, on_final):
+        try:
+            while True:
+                envelope = self.inbox.get()
+                if envelope is DONE:
+                    break
+                t0, record = envelope
+                start = time.perf_counter()
+                emitted = []
+
+                # handlerは処理の途中で得られた出力をsendで先に下流へ渡せる (ストリーミングしたクエリなど)
+                def send(output):
+                    emitted.append(output)
+                    self.emit(t0, output)
+                    if not self.downstream:
+                        on_final(t0)
+
+                try:
+                    outputs = self.handler(record, send)
+                except Exception as e:
+                    print(f"エラー: ステージ '{self.name}' の処理中にエラーが発生しました: {e}")
+                    outputs = None
+                if outputs is None and not emitted:
+                    self.stats.error()
+                    continue
+                for output in outputs or []:
+                    send(output)
+                self.stats.add(time.perf_counter() - start, len(emitted))
+        finally:
+            with self._lock:
+                self._running -= 1
+                last = self._running == 0
+            # 最後のワーカーが終了を下流に伝える
+            if last:
+                for child in self.downstream:
+                    for _ in range(child.concurrency):
+                        child.inbox.put(DONE)
+
+    def feed(self, records):
+        """上流のステージが無い場合に、入力ファイルなどからレコードを投入する"""
+        try:
+            for record in records:
+                self.inbox.put((time.perf_counter(), record))
+        except Exception as e:
+            print(f"エラー: ステージ '{self.name}' の入力の読み込み中にエラーが発生しました: {e}")
+        finally:
+            for _ in range(self.concurrency):
+                self.inbox.put(DONE)
+
+def load_config(config_filename, only=None):
+    """
+    設定ファイルを読み込み、実行するステージを上流から順に返す
+
+    onlyを指定した場合はそのステージだけを実行し、上流が実行されないステージは
+    設定の"input"からレコードを読み込む
+    """
+    with open(config_filename, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    base_dir = Path(config_filename).resolve().parent
+    queue_size = config.get("queue_size", 64)
+    stages = config["stages"]
+    names = only or list(stages)
+
+    nodes = {}
+    for name in names:
+        if name not in stages:
+            raise ValueError(f"設定に無いステージです: {name}")
+        stage = dict(stages[name])
+        if stage.get("type") not in STAGE_TYPES:
+            raise ValueError(f"ステージ '{name}' の種類が不正です: {stage.get('type')}")
+        # パスは設定ファイルからの相対パスとする
+        if stage["type"] in DEFAULT_CACHE_DIRS:
+            stage.setdefault("cache_dir", DEFAULT_CACHE_DIRS[stage["type"]])
+        for key in ("input", "output", "knowledge", "examples", "cache_dir"):
+            if stage.get(key):
+                stage[key] = str(base_dir / stage[key])
+        nodes[name] = Node(name, stage, queue_size)
+
+    for node in nodes.values():
+        after = node.config.get("after")
+        if after in nodes:
+            if nodes[after].type != STAGE_TYPES[node.type]:
+                raise ValueError(f"ステージ '{node.name}' ({node.type}) は '{after}' ({nodes[after].type}) の後に置けません")
+            node.upstream = nodes[after]
+            nodes[after].downstream.append(node)
+        elif node.type != "extract" and not node.config.get("input"):
+            raise ValueError(f"ステージ '{node.name}' には上流のステージか\"input\"が必要です")
+
+    # 上流から順に並べる (種類の順序が決まっているため循環はできない)
+    order = list(STAGE_TYPES)
+    return sorted(nodes.values(), key=lambda node: order.index(node.type)), queue_size
+
+def make_extract_handler(node):
+    return lambda article, send: [article]
+
+def extract_source(node, shard=None):
+    if node.config.get("input"):
+        return iter_records(node.config["input"])
+    from wiki import iter_kirara_articles_stream
+    # --shardではparquetファイル単位で分担し、結合用に処理したファイルを記録する
+    node.sources = {} if shard else None
+    return iter_kirara_articles_stream(node.config.get("workers"), shard=shard, sources=node.sources)
+
+def shard_source(node, shard):
+    """最上流のステージに投入するレコード (--shard時は内容ハッシュがこのシャードに入るものだけ)"""
+    if node.type == "extract" and not node.config.get("input"):
+        return extract_source(node, shard)
+    from kirara_common.sharding import record_key
+    records = extract_source(node) if node.type == "extract" else iter_records(node.config["input"])
+    return (record for record in records if record_key(record) in shard) if shard else records
+
+def make_query_handler(node):
+    import query_utils
+    from chunking import expand_chunks
+    from results import make_query_id, make_query_records
+
+    query_utils.CACHE_DIR = Path(node.config["cache_dir"])
+    # main.py (デフォルト) またはjimba.pyのプロンプトを使う
+    prompt_module = importlib.import_module(node.config.get("prompt", "main"))
+    example_seed = node.config.get("seed")
+    if node.config.get("prompt") == "jimba":
+        from example_pool import configure_example_pool
+        configure_example_pool(local_file=node.config.get("examples"))
+    max_chunk_tokens = node.config.get("max_chunk_tokens")
+    if node.config.get("stream"):
+        # 応答をストリーミングで受け取り、取り出したクエリから回答ステージへ渡す
+        from query_stream import configure_query_stream
+        configure_query_stream(max_queries=node.config.get("max_queries"))
+
+    def handle(article, send):
+        items = expand_chunks([article], max_chunk_tokens)[0] if max_chunk_tokens else [article]
+        records = []
+        sent = 0
+        failed = False
+        for item in items:
+            cache_id = str(uuid.uuid5(uuid.NAMESPACE_URL, item["text"]))
+            knowledge_ref = {"text": item["text"]}
+            if "chunk_id" in item:
+                knowledge_ref["chunk_id"] = item["chunk_id"]
+            streamed = []
+
+            def on_query(query):
+                # ストリーミングで取り出したクエリは応答の完了を待たずに回答ステージへ渡す
+                send({"id": make_query_id(cache_id, len(streamed), query), **knowledge_ref, "query": query})
+                streamed.append(query)
+
+            if example_seed is not None:
+                result = prompt_module.process_item(item, cache_id, example_seed, on_query)
+            else:
+                result = prompt_module.process_item(item, cache_id, on_query=on_query)
+            sent += len(streamed)
+            if not result:
+                failed = True
+                continue
+            records.extend(make_query_records(cache_id, result, knowledge_ref)[len(streamed):])
+        # 全てのチャンクで失敗した場合だけエラーとして数える
+        return None if failed and not records and not sent else records
+    return handle
+
+def make_answer_handler(node, resume=False):
+    import gen_answer
+    import query_utils
+    from kirara_common.cache_store import open_cache
+    from knowledge_store import KnowledgeTable
+    from kirara_common.metrics import record_cache_hit
+    from streaming import AnswerAppender
+
+    client, use_model = gen_answer.create_client()
+    # APIキーを共有するため、流量制限はクエリ生成と同じスケジューラーで行う
+    scheduler = query_utils.get_scheduler()
+    cache = open_cache(gen_answer.CACHE_NAMESPACE, node.config["cache_dir"], ".jsonl")
+    knowledge_table = KnowledgeTable(node.config["knowledge"]) if node.config.get("knowledge") else None
+    # 回答は出力ファイルに完了順で追記する (--resumeでは出力済みのIDをスキップする)
+    node.output = AnswerAppender(node.config["output"], resume)
+
+    def handle(query_data, send):
+        if query_data["id"] in node.output.done_ids:
+            return []
+        answer = cache.get(query_data["id"])
+        if answer is not None:
+            record_cache_hit(gen_answer.CACHE_NAMESPACE, query_data["id"])
+        else:
+            answer = gen_answer.process_single_query(query_data, client, use_model, scheduler, knowledge_table)
+            if answer is None:
+                return None
+            cache.put(answer["id"], answer)
+        return [answer]
+    return handle
+
+def run_pipeline(nodes, resume=False, shard=None):
+    from dotenv import load_dotenv
+    load_dotenv(override=True)
+
+    for node in nodes:
+        if node.type == "extract":
+            node.handler = make_extract_handler(node)
+        elif node.type == "query":
+            node.handler = make_query_handler(node)
+        else:
+            if not node.config.get("output"):
+                raise ValueError(f"ステージ '{node.name}' には\"output\"が必要です")
+            node.handler = make_answer_handler(node, resume)
+        if node.config.get("output") and node.type != "answer":
+            node.output = JsonlWriter(node.config["output"])
+
+    start = time.perf_counter()
+    end_to_end = []
+    first_output = []
+    final_lock = threading.Lock()
+
+    def on_final(t0):
+        now = time.perf_counter()
+        with final_lock:
+            end_to_end.append(now - t0)
+            if not first_output:
+                first_output.append(now - start)
+
+    threads = []
+    for node in nodes:
+        for _ in range(node.concurrency):
+            threads.append(threading.Thread(target=node.worker, args=(on_final,), daemon=True))
+        if node.upstream is None:
+            threads.append(threading.Thread(target=node.feed, args=(shard_source(node, shard),), daemon=True))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for node in nodes:
+        if node.output:
+            node.output.close()
+        if node.sources and node.config.get("output"):
+            from wiki import write_sources
+            write_sources(node.config["output"], node.sources)
+
+    elapsed = time.perf_counter() - start
+    return {
+        "elapsed": elapsed,
+        "time_to_first_output": first_output[0] if first_output else None,
+        "outputs": len(end_to_end),
+        "throughput": len(end_to_end) / elapsed if elapsed else 0.0,
+        "latency_p50": percentile(end_to_end, 0.5),
+        "latency_p95": percentile(end_to_end, 0.95),
+        "latency_p99": percentile(end_to_end, 0.99),
+        "stages": {node.name: node.stats.summary(elapsed) for node in nodes},
+    }
+
+def print_report(report):
+    print("\n=== パイプラインの結果 ===")
+    for name, stats in report["stages"].items():
+        print(f"{name}: 入力 {stats['items_in']}件  出力 {stats['items_out']}件  エラー {stats['errors']}件  "
+              f"{stats['throughput']:.2f}件/秒  処理時間 p50 {stats['latency_p50']:.2f}秒 p95 {stats['latency_p95']:.2f}秒")
+    first = report["time_to_first_output"]
+    print(f"全体: {report['outputs']}件を{report['elapsed']:.2f}秒で出力 ({report['throughput']:.2f}件/秒)  "
+          f"最初の出力まで {first if first is not None else 0:.2f}秒")
+    print(f"記事の投入から出力までのレイテンシ: p50 {report['latency_p50']:.2f}秒  "
+          f"p95 {report['latency_p95']:.2f}秒  p99 {report['latency_p99']:.2f}秒")
+
+def main():
+    parser = argparse.ArgumentParser(description='抽出・クエリ生成・回答生成をキューでつないで重ねて実行する')
+    parser.add_argument('config', type=str, nargs='?', default=str(ROOT / 'pipeline.json'), help='設定ファイル')
+    parser.add_argument('--only', type=str, default=None,
+                        help='実行するステージ名 (カンマ区切り、例: query,answer)')
+    parser.add_argument('--resume', action='store_true', help='回答の出力ファイルに記録済みのクエリをスキップする')
+    parser.add_argument('--report', type=str, default=None, help='スループット・レイテンシの出力先 (JSON)')
+    parser.add_argument('--shard', type=str, default=None,
+                        help='複数のマシンで分担する (i/N)。内容ハッシュがこのシャードに入るレコードだけを投入し、'
+                             'ステージごとの出力をシャードごとのファイルにする')
+    args = parser.parse_args()
+
+    shard = None
+    if args.shard:
+        from kirara_common.sharding import Shard
+        try:
+            shard = Shard.parse(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+
+    nodes, queue_size = load_config(args.config, args.only.split(',') if args.only else None)
+    print(f"ステージ: {' → '.join(f'{node.name}({node.concurrency})' for node in nodes)}  キューの上限: {queue_size}")
+    if shard:
+        for node in nodes:
+            if node.config.get("output"):
+                node.config["output"] = shard.filename(node.config["output"])
+    report = run_pipeline(nodes, args.resume, shard)
+    print_report(report)
+    if any(node.type != "extract" for node in nodes):
+        # OPENAI_BACKENDSを設定している場合は、両ステージで共有したプールのバックエンドごとの集計も表示する
+        from kirara_common.backend_pool import get_pool
+        if get_pool():
+            get_pool().report()
+    if any(node.type == "query" and node.config.get("stream") for node in nodes):
+        from query_stream import report_stream
+        report_stream()
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
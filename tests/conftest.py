@@ -0,0 +1,70 @@
+"""
+モックサーバー (bench/mock_openai_server.py) を使ったテストの共通設定
+
+    uv run --project gen_query --with pytest python -m pytest tests
+"""
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+for path in ("bench", "gen_query", "gen_answer", "get_knowledge_text"):
+    sys.path.insert(0, str(ROOT / path))
+
+from mock_openai_server import build_parser, create_server
+
+@pytest.fixture
+def mock_server():
+    """
+    モックサーバーを起動する関数 (引数はmock_openai_server.pyのコマンドライン引数)
+    (base_url, state) を返し、テストの終了時に停止する
+    """
+    servers = []
+
+    def start(*args):
+        options = build_parser().parse_args(["--port", "0", "--stream-interval", "0", *args])
+        server, state = create_server(options)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}/v1", state
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture
+def openai_env(monkeypatch, tmp_path):
+    """OpenAIの環境変数をモックサーバー向けにし、プロセス全体で共有するクライアントなどを作り直す"""
+    from kirara_common import backend_pool, metrics
+
+    def configure(base_url, **env):
+        monkeypatch.setenv("OPENAI_BASE_URL", base_url)
+        monkeypatch.setenv("OPENAI_API_KEY", "dummy")
+        monkeypatch.setenv("OPENAI_USE_MODEL", "gpt-4o-mini")
+        for name in ("OPENAI_BACKENDS", "OPENAI_RPM", "OPENAI_TPM", "CACHE_BACKEND", "METRICS_FILE"):
+            monkeypatch.delenv(name, raising=False)
+        for name, value in env.items():
+            monkeypatch.setenv(name, str(value))
+        monkeypatch.setattr(backend_pool, "_pool", None)
+        monkeypatch.setattr(metrics, "_recorder", None)
+        return tmp_path
+
+    return configure
+
+@pytest.fixture
+def query_env(openai_env, monkeypatch):
+    """gen_queryのクライアント・スケジューラー・キャッシュを作り直し、キャッシュを一時ディレクトリに置く"""
+    import query_utils
+
+    def configure(base_url, **env):
+        tmp_path = openai_env(base_url, **env)
+        monkeypatch.setattr(query_utils, "_client", None)
+        monkeypatch.setattr(query_utils, "_scheduler", None)
+        monkeypatch.setattr(query_utils, "_cache", None)
+        monkeypatch.setattr(query_utils, "CACHE_DIR", tmp_path / "cache")
+        return tmp_path
+
+    return configure
@@ -0,0 +1,158 @@
+import asyncio
+import socket
+import time
+
+import pytest
+
+from kirara_common import backend_pool
+from kirara_common.backend_pool import FAILURE_THRESHOLD, Backend, BackendPool
+from kirara_common.scheduler import RequestScheduler
+
+MESSAGES = [{"role": "user", "content": "<query>タグで囲んだクエリを作成してください"}]
+
+def closed_port_url():
+    """接続を拒否するアドレス (空いているポートを一時的に取って閉じる)"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}/v1"
+
+def make_pool(*backends, **options):
+    return BackendPool([Backend(name, base_url=url, api_key="dummy", model="gpt-4o-mini", **config)
+                        for name, url, config in backends], **options)
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def test_stream_holds_slot_until_consumed(mock_server):
+    base_url, _ = mock_server("--num-queries", "5")
+    pool = make_pool(("mock", base_url, {"max_concurrency": 1}))
+    backend = pool.backends[0]
+
+    response = pool.create(model="gpt-4o-mini", messages=MESSAGES, stream=True)
+    # 受信中はmax_concurrencyの枠を使っている
+    assert backend.outstanding == 1
+    assert pool._acquire(block=False) is None
+
+    text = "".join(chunk.choices[0].delta.content or "" for chunk in response if chunk.choices)
+    assert text.count("<query>") == 5
+    assert backend.outstanding == 0
+    assert backend.successes == 1
+
+def test_closed_stream_releases_slot_without_latency(mock_server):
+    base_url, _ = mock_server("--num-queries", "5")
+    pool = make_pool(("mock", base_url, {"max_concurrency": 1}))
+    backend = pool.backends[0]
+
+    response = pool.create(model="gpt-4o-mini", messages=MESSAGES, stream=True)
+    for _ in response:
+        break
+    response.close()
+    assert backend.outstanding == 0
+    # 打ち切った応答のレイテンシはヘッジの分位点に使わない
+    assert backend.successes == 0
+    assert not pool._latencies
+
+def test_failover_opens_circuit(mock_server):
+    base_url, _ = mock_server()
+    pool = make_pool(("down", closed_port_url(), {"weight": 100}), ("up", base_url, {}))
+    scheduler = RequestScheduler(base_delay=0.01, max_delay=0.05, max_retries=10)
+
+    for _ in range(10):
+        response = scheduler.call(lambda: pool.create(model="gpt-4o-mini", messages=MESSAGES))
+        assert response.choices[0].message.content
+    down, up = pool.backends
+    assert down.trips == 1
+    assert down.failures == 5
+    assert up.successes == 10
+
+def test_fallback_used_only_when_primaries_are_open(mock_server):
+    primary_url, _ = mock_server()
+    fallback_url, fallback_state = mock_server()
+    pool = make_pool(("primary", primary_url, {}), ("fallback", fallback_url, {"fallback": True}))
+
+    pool.create(model="gpt-4o-mini", messages=MESSAGES)
+    assert fallback_state.requests == 0
+    pool.backends[0].open_until = time.monotonic() + 60
+    pool.create(model="gpt-4o-mini", messages=MESSAGES)
+    assert fallback_state.requests == 1
+
+def test_failed_trial_is_retried_after_cooldown(monkeypatch):
+    monkeypatch.setattr(backend_pool, "COOLDOWN", 0.05)
+    pool = make_pool(("primary", closed_port_url(), {}), ("fb", closed_port_url(), {"fallback": True}))
+    primary, fallback = pool.backends
+
+    for _ in range(FAILURE_THRESHOLD):
+        pool._release(pool._acquire(), False)
+    assert primary.is_open(time.monotonic())
+    assert pool._acquire(block=False) is fallback
+    pool._release(fallback, None)
+
+    # 開いている時間が過ぎると1件だけ試し、失敗すると開き直す
+    time.sleep(0.06)
+    assert pool._acquire(block=False) is primary
+    pool._release(primary, False)
+    assert primary.trips == 2
+
+    # 開き直した時間が過ぎたら、もう一度試す
+    time.sleep(0.11)
+    assert pool._acquire(block=False) is primary
+
+def test_async_create_waits_for_released_slot(mock_server):
+    base_url, _ = mock_server("--num-queries", "5")
+    pool = make_pool(("mock", base_url, {"max_concurrency": 1}))
+    response = pool.create(model="gpt-4o-mini", messages=MESSAGES, stream=True)
+
+    async def run():
+        async with pool.async_client() as client:
+            task = asyncio.ensure_future(client.chat.completions.create(model="gpt-4o-mini", messages=MESSAGES))
+            await asyncio.sleep(0.05)
+            # 空きが無い間はポーリングせずに待っている
+            assert not task.done()
+            assert len(pool._async_waiters) == 1
+            response.close()
+            return await asyncio.wait_for(task, timeout=0.5)
+
+    assert asyncio.run(run()).choices[0].message.content
+    assert pool.backends[0].outstanding == 0
+
+def test_hedge_wins_and_closes_losing_stream(mock_server):
+    slow_url, slow_state = mock_server("--latency", "0.5", "--stream-interval", "0.02", "--stream-chunk-chars", "2")
+    fast_url, _ = mock_server()
+    # 最初は重みの大きい遅いバックエンドに送られ、0.05秒後に速いバックエンドへヘッジする
+    pool = make_pool(("slow", slow_url, {"weight": 10}), ("fast", fast_url, {}),
+                     hedge_after=0.05, max_hedge_ratio=1.0)
+    slow, fast = pool.backends
+
+    started = time.perf_counter()
+    response = pool.create(model="gpt-4o-mini", messages=MESSAGES, stream=True)
+    assert time.perf_counter() - started < 0.4
+    assert fast.hedge_wins == 1
+    assert sum(1 for _ in response) > 0
+    assert fast.outstanding == 0
+    # 遅い方の応答が返った時点でストリームが閉じられ、枠が戻る
+    assert wait_until(lambda: slow.outstanding == 0)
+    assert wait_until(lambda: slow_state.stats()["streams_cancelled"] == 1)
+
+def test_async_hedge_cancels_loser(mock_server):
+    slow_url, _ = mock_server("--latency", "0.5")
+    fast_url, _ = mock_server()
+    pool = make_pool(("slow", slow_url, {"weight": 10}), ("fast", fast_url, {}),
+                     hedge_after=0.05, max_hedge_ratio=1.0)
+    slow, fast = pool.backends
+
+    async def run():
+        async with pool.async_client() as client:
+            response = await client.chat.completions.create(model="gpt-4o-mini", messages=MESSAGES, stream=True)
+            chunks = [chunk async for chunk in response]
+            await asyncio.sleep(0)
+            return chunks
+
+    assert asyncio.run(run())
+    assert fast.hedge_wins == 1
+    assert slow.outstanding == 0
+    assert fast.outstanding == 0
+    assert fast.successes == 1
@@ -0,0 +1,83 @@
+import json
+
+from openai import OpenAI
+
+from batch_mode import run_batch
+from knowledge_store import KnowledgeTable
+
+QUERIES = [{"id": f"q{i}", "text": f"きらら作品の記事{i}", "query": f"どんな作品ですか{i}"} for i in range(10)]
+
+def run(base_url, work_dir, queries=QUERIES, **kwargs):
+    client = OpenAI(base_url=base_url, api_key="dummy")
+    answers = []
+    failed = run_batch(queries, client, "gpt-4o-mini", answers.append, KnowledgeTable(),
+                       work_dir=work_dir, poll_interval=0.01, **kwargs)
+    return answers, failed
+
+def test_splits_input_by_request_count(mock_server, tmp_path):
+    base_url, state = mock_server("--batch-delay", "0")
+
+    answers, failed = run(base_url, tmp_path / "batch", max_requests=4)
+
+    assert failed == []
+    assert sorted(answer["id"] for answer in answers) == sorted(query["id"] for query in QUERIES)
+    assert [batch["request_counts"]["total"] for batch in state.batches.values()] == [4, 4, 2]
+    assert not (tmp_path / "batch" / "state.json").exists()
+
+def test_splits_input_by_size(mock_server, tmp_path):
+    base_url, state = mock_server("--batch-delay", "0")
+
+    answers, failed = run(base_url, tmp_path / "batch", max_bytes=2000)
+
+    assert failed == []
+    assert len(answers) == len(QUERIES)
+    assert len(state.batches) > 1
+    for path in (tmp_path / "batch").glob("batch_input_0_*.jsonl"):
+        assert path.stat().st_size <= 2000
+
+def test_oversized_request_fails_without_submitting(mock_server, tmp_path):
+    base_url, state = mock_server("--batch-delay", "0")
+
+    answers, failed = run(base_url, tmp_path / "batch", max_bytes=100)
+
+    assert answers == []
+    assert [query["id"] for query in failed] == [query["id"] for query in QUERIES]
+    assert state.batches == {}
+
+def test_failed_requests_are_resubmitted(mock_server, tmp_path):
+    base_url, state = mock_server("--batch-delay", "0", "--batch-failure-rate", "0.5", "--seed", "1")
+
+    answers, failed = run(base_url, tmp_path / "batch", max_rounds=5)
+
+    # 失敗したIDだけが次のラウンドで再投入される
+    totals = [batch["request_counts"]["total"] for batch in state.batches.values()]
+    assert totals[0] == len(QUERIES)
+    assert totals == sorted(totals, reverse=True)
+    assert len(totals) > 1
+    assert len(answers) + len(failed) == len(QUERIES)
+    assert not {answer["id"] for answer in answers} & {query["id"] for query in failed}
+
+def test_resumes_submitted_batches_from_state(mock_server, tmp_path):
+    base_url, state = mock_server("--batch-delay", "0")
+    client = OpenAI(base_url=base_url, api_key="dummy")
+    work_dir = tmp_path / "batch"
+    work_dir.mkdir()
+    # 前回の実行で先頭の4件だけを投入したところで中断した状態 (1バッチだけを記録していた形式)
+    input_file = work_dir / "previous.jsonl"
+    input_file.write_text("".join(json.dumps({
+        "custom_id": query["id"], "method": "POST", "url": "/v1/chat/completions",
+        "body": {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": query["query"]}]},
+    }) + "\n" for query in QUERIES[:4]), encoding="utf-8")
+    with open(input_file, "rb") as f:
+        uploaded = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(input_file_id=uploaded.id, endpoint="/v1/chat/completions",
+                                  completion_window="24h")
+    (work_dir / "state.json").write_text(json.dumps({"batch_id": batch.id, "ids": [q["id"] for q in QUERIES[:4]]}))
+
+    answers, failed = run(base_url, work_dir)
+
+    assert failed == []
+    assert sorted(answer["id"] for answer in answers) == sorted(query["id"] for query in QUERIES)
+    # 投入済みの4件は再投入せず、残りの6件だけを新しいバッチにする
+    assert [b["request_counts"]["total"] for b in state.batches.values()] == [4, 6]
+    assert not (work_dir / "state.json").exists()
@@ -0,0 +1,42 @@
+import random
+
+import dedup_queries
+from dedup_queries import cluster_queries
+
+def test_clusters_near_duplicates():
+    texts = [
+        "ごちうさの主人公は誰ですか",
+        "ごちうさの主人公は誰ですか？",
+        "ごちうさの主人公は 誰ですか",
+        "けいおん！の舞台はどこですか",
+    ]
+
+    assert cluster_queries(texts) == [0, 0, 0, 3]
+
+def test_groups_are_compared_separately():
+    texts = ["ごちうさの主人公は誰ですか"] * 2
+
+    assert cluster_queries(texts, groups=["a", "b"]) == [0, 1]
+
+def test_signature_without_numpy_matches_numpy(monkeypatch):
+    texts = ["ごちうさの主人公は誰ですか", "けいおん！の舞台はどこですか"]
+    expected = [dedup_queries.MinHasher().signature(text) for text in texts]
+    monkeypatch.setattr(dedup_queries, "np", None)
+    hasher = dedup_queries.MinHasher()
+
+    assert [hasher.signature(text) for text in texts] == expected
+
+def test_bucket_comparisons_are_capped(monkeypatch):
+    # 共通部分が長く、LSHでは同じバケットに入りやすいが重複ではないクエリ
+    rng = random.Random(0)
+    texts = ["この作品の主人公が所属している部活動の名前は" + "".join(rng.choice("あいうえおかきくけこさしすせそたちつてと") for _ in range(8))
+             for _ in range(300)]
+    calls = []
+    similarity = dedup_queries.estimated_similarity
+    monkeypatch.setattr(dedup_queries, "estimated_similarity", lambda a, b: calls.append(1) or similarity(a, b))
+    bands, _ = dedup_queries.optimal_bands(0.7, 128)
+
+    cluster_queries(texts, max_leaders=1)
+
+    # 1つのクエリを比較するのは、バンドごとに最大max_leaders個の代表だけ
+    assert len(calls) <= len(texts) * bands * 1
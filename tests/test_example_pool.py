@@ -0,0 +1,40 @@
+import json
+import sys
+
+import pytest
+
+import jimba
+from example_pool import ExamplePool
+
+def test_failed_load_raises_and_is_not_cached(monkeypatch):
+    # datasetsを読み込めない環境 (オフラインでデータセットを取得できない場合と同じく読み込みに失敗する)
+    monkeypatch.setitem(sys.modules, "datasets", None)
+    pool = ExamplePool()
+
+    with pytest.raises(RuntimeError, match="--examples"):
+        pool.sample(3)
+    # 空のプールを覚えておかない
+    assert pool._instructions is None
+
+def test_too_few_examples_raise(tmp_path):
+    examples = tmp_path / "examples.json"
+    examples.write_text(json.dumps(["例1"], ensure_ascii=False), encoding="utf-8")
+
+    with pytest.raises(RuntimeError):
+        ExamplePool(local_file=examples).sample(3)
+
+def test_jimba_stops_without_examples(mock_server, query_env, monkeypatch, tmp_path, capsys):
+    base_url, state = mock_server()
+    query_env(base_url)
+    monkeypatch.setattr(jimba, "load_dotenv", lambda **kwargs: None)
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "wiki.json").write_text(json.dumps([{"text": "きらら作品の記事"}], ensure_ascii=False),
+                                        encoding="utf-8")
+    (tmp_path / "examples.json").write_text("[]", encoding="utf-8")
+    monkeypatch.setattr(sys, "argv", ["jimba.py", "wiki.json", "--examples", "examples.json"])
+
+    jimba.main()
+
+    assert "例示が1件もありません" in capsys.readouterr().out
+    assert state.requests == 0
+    assert not (tmp_path / "generated_queries.json").exists()
@@ -0,0 +1,42 @@
+import pytest
+
+import gen_answer
+from answer_cache import AnswerCache
+from knowledge_store import KnowledgeTable
+
+QUERIES = [
+    {"id": "flat", "text": "きらら作品の記事", "query": "どんな作品ですか"},
+    # knowledgeテーブルに無いknowledge_id (チャンク分割したクエリに.kcorpusを渡した場合など)
+    {"id": "missing", "knowledge_id": "0" * 64, "query": "どんな作品ですか"},
+]
+
+@pytest.fixture
+def answer_env(mock_server, openai_env, monkeypatch):
+    base_url, state = mock_server()
+    tmp_path = openai_env(base_url)
+    monkeypatch.setattr(gen_answer, "CACHE_DIR", tmp_path / "cache")
+    monkeypatch.setattr(gen_answer, "load_dotenv", lambda **kwargs: None)
+    return tmp_path, state
+
+@pytest.mark.parametrize("group_mode", [False, True])
+def test_missing_knowledge_fails_only_that_query(answer_env, group_mode):
+    answers = gen_answer.generate_answers(QUERIES, KnowledgeTable(), group_mode=group_mode, workers=2)
+
+    assert [answer["id"] for answer in answers] == ["flat"]
+    assert answers[0]["answer"].startswith("モック回答")
+
+def test_multi_question_answers_are_cached_per_question(answer_env, monkeypatch):
+    tmp_path, state = answer_env
+    queries = [{"id": f"q{i}", "text": "きらら作品の記事", "query": f"どんな作品ですか{i}"} for i in range(3)]
+    answer_cache = AnswerCache(tmp_path / "answers.sqlite3")
+
+    first = gen_answer.generate_answers(queries, KnowledgeTable(), group_mode=True, multi_question=True,
+                                        answer_cache=answer_cache)
+    requests = state.requests
+    # 応答キャッシュを使わず、回答キャッシュだけで答えられるかを確かめる
+    monkeypatch.setattr(gen_answer, "CACHE_DIR", tmp_path / "cache_second")
+    second = gen_answer.generate_answers(queries, KnowledgeTable(), group_mode=True, answer_cache=answer_cache)
+
+    assert requests == 1
+    assert state.requests == requests
+    assert [answer["answer"] for answer in second] == [answer["answer"] for answer in first]
@@ -0,0 +1,49 @@
+import json
+import sys
+
+import pytest
+
+import main
+import query_stream
+import query_utils
+
+ARTICLES = [{"title": f"作品{i}", "text": f"作品{i}はまんがタイムきららの4コマ漫画作品である。", "source": ""}
+            for i in range(6)]
+
+@pytest.fixture
+def run_main(mock_server, query_env, monkeypatch, tmp_path):
+    """gen_queryのmain.pyを一時ディレクトリで実行し、出力を読み込む関数"""
+    base_url, _ = mock_server("--num-queries", "3")
+    query_env(base_url)
+    monkeypatch.setattr(main, "load_dotenv", lambda **kwargs: None)
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "wiki.json").write_text(json.dumps(ARTICLES, ensure_ascii=False), encoding="utf-8")
+
+    def run(name, *options):
+        # 実行ごとにキャッシュを分け、前の実行の結果を読まないようにする
+        monkeypatch.setattr(query_utils, "_client", None)
+        monkeypatch.setattr(query_utils, "_scheduler", None)
+        monkeypatch.setattr(query_utils, "_cache", None)
+        monkeypatch.setattr(query_utils, "CACHE_DIR", tmp_path / f"cache_{name}")
+        output = f"{name}_queries.json"
+        monkeypatch.setattr(sys, "argv", ["main.py", *options, "wiki.json", output, f"{name}_text_and_prompt.json"])
+        main.main()
+        with open(output, encoding="utf-8") as f:
+            return json.load(f)
+
+    yield run
+    query_stream.configure_query_stream(False)
+
+def test_async_engine_matches_thread_pool(run_main):
+    threaded = run_main("thread", "--concurrency", "3")
+    async_ = run_main("async", "--async", "--concurrency", "3")
+
+    assert len(threaded) == len(ARTICLES) * 3
+    assert all(record["query"].startswith("モッククエリ") for record in threaded)
+    assert async_ == threaded
+
+def test_async_stream_matches_thread_pool(run_main):
+    threaded = run_main("thread", "--concurrency", "3")
+    streamed = run_main("async_stream", "--async", "--stream-queries", "--concurrency", "3")
+
+    assert streamed == threaded
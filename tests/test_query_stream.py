@@ -0,0 +1,53 @@
+import uuid
+
+import pytest
+
+import query_stream
+import query_utils
+
+PROMPT = "きらら作品について<query>タグで囲んだクエリを作成してください"
+
+@pytest.fixture
+def stream_mode():
+    def configure(max_queries=None):
+        query_stream.configure_query_stream(True, max_queries)
+    yield configure
+    query_stream.configure_query_stream(False)
+
+def test_stream_stops_at_max_queries(mock_server, query_env, stream_mode):
+    base_url, state = mock_server("--num-queries", "10", "--ramble-chars", "2000", "--stream-chunk-chars", "2")
+    query_env(base_url)
+    stream_mode(max_queries=2)
+    received = []
+
+    result = query_stream.stream_queries(PROMPT, on_query=received.append)
+
+    assert len(result["queries"]) == 2
+    assert received == result["queries"]
+    assert result["generated_text"].endswith("</query>")
+    assert query_stream._stats.stops["target"] == 1
+
+def test_stream_matches_full_generation(mock_server, query_env, stream_mode):
+    base_url, _ = mock_server("--num-queries", "5")
+    query_env(base_url)
+    stream_mode()
+
+    result = query_stream.stream_queries(PROMPT)
+    response = query_utils.get_client().chat.completions.create(
+        model=query_utils.get_model(), messages=[{"role": "user", "content": PROMPT}])
+
+    assert result == query_utils.make_result(PROMPT, response.choices[0].message.content)
+
+def test_truncated_stream_is_not_cached(mock_server, query_env, stream_mode):
+    base_url, _ = mock_server("--num-queries", "10")
+    query_env(base_url)
+    cache_id = str(uuid.uuid5(uuid.NAMESPACE_URL, PROMPT))
+
+    # 打ち切った結果を最後まで生成した結果と同じキーで保存しない
+    stream_mode(max_queries=2)
+    assert len(query_stream.stream_queries(PROMPT, cache_id=cache_id)["queries"]) == 2
+    assert query_utils.load_cached_result(cache_id) is None
+
+    stream_mode()
+    assert len(query_stream.stream_queries(PROMPT, cache_id=cache_id)["queries"]) == 10
+    assert len(query_utils.load_cached_result(cache_id)["queries"]) == 10
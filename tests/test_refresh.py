@@ -0,0 +1,38 @@
+import json
+from argparse import Namespace
+
+import refresh
+
+def write_jsonl(path, records):
+    path.write_text("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records), encoding="utf-8")
+
+def read_jsonl(path):
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines() if line.strip()]
+
+def test_prune_compact_and_chunked_records(tmp_path):
+    old = {"id": "1", "title": "古い記事", "text": "古い本文"}
+    kept = {"id": "2", "title": "残る記事", "text": "残る本文"}
+    manifest = refresh.build_manifest([old, kept])
+    removed = tmp_path / "removed.json"
+    removed.write_text(json.dumps([{"key": "1", **manifest["1"]}]), encoding="utf-8")
+
+    old_id = refresh.content_hash(old["text"])
+    kept_id = refresh.content_hash(kept["text"])
+    chunk_id = refresh.content_hash("古い本文のチャンク")
+    records = [
+        {"id": "a", "knowledge_id": old_id, "query": "q"},
+        {"id": "b", "knowledge_id": kept_id, "query": "q"},
+        {"id": "c", "knowledge_id": chunk_id, "chunk_id": f"{refresh.article_cache_id(old['text'])}#0", "query": "q"},
+        {"id": "d", "text": "古い本文のチャンク", "chunk_id": f"{refresh.article_cache_id(old['text'])}#0", "query": "q"},
+        {"id": "e", "text": "古い本文", "query": "q"},
+    ]
+    target = tmp_path / "generated_answers.jsonl"
+    write_jsonl(target, records)
+    knowledge = tmp_path / "knowledge.jsonl"
+    write_jsonl(knowledge, [{"id": old_id, "text": old["text"]}, {"id": kept_id, "text": kept["text"]},
+                            {"id": chunk_id, "text": "古い本文のチャンク"}])
+
+    refresh.run_prune(Namespace(target=str(target), removed=str(removed), output=None, knowledge=str(knowledge)))
+
+    assert [record["id"] for record in read_jsonl(target)] == ["b"]
+    assert [doc["id"] for doc in read_jsonl(knowledge)] == [kept_id]
@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+from kirara_common.scheduler import RequestScheduler
+
+def test_interrupted_call_releases_slot():
+    scheduler = RequestScheduler(max_concurrency=1)
+
+    def interrupted():
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        scheduler.call(interrupted)
+    assert scheduler.limiter.in_flight == 0
+    # 枠が返っていれば次の呼び出しは待たずに進む
+    assert scheduler.call(lambda: "ok") == "ok"
+
+def test_cancelled_acall_releases_slot():
+    scheduler = RequestScheduler(max_concurrency=1)
+
+    async def run():
+        task = asyncio.ensure_future(scheduler.acall(lambda: asyncio.sleep(10)))
+        await asyncio.sleep(0.01)
+        assert scheduler.limiter.in_flight == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert scheduler.limiter.in_flight == 0
+
+        async def answer():
+            return "ok"
+        return await asyncio.wait_for(scheduler.acall(answer), timeout=1.0)
+
+    assert asyncio.run(run()) == "ok"